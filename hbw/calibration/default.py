@@ -11,7 +11,8 @@ from columnflow.calibration.cms.jets import jec, jer
 from columnflow.production.cms.seeds import deterministic_seeds
 from columnflow.util import maybe_import
 
-from hbw.calibration.jet import jec_nominal, bjet_regression
+from hbw.calibration.jet import jec_nominal, jec_batched, bjet_regression_flat
+from hbw.production.jet_shift_deltas import jet_shift_fields, get_jet_shift_storage, encode_jet_shift_deltas
 
 ak = maybe_import("awkward")
 
@@ -23,6 +24,8 @@ logger = law.logger.get_logger(__name__)
     uses={deterministic_seeds},
     produces={deterministic_seeds},
     skip_jecunc=True,
+    # evaluate all jec uncertainty sources together instead of one after another (opt-in)
+    batch_jecunc=False,
     bjet_regression=True,
 )
 def base(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
@@ -32,6 +35,10 @@ def base(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     for calibrator_inst in self.calibrators:
         events = self[calibrator_inst](events, **kwargs)
 
+    # optionally store shifted jets as deltas relative to the nominal jets
+    if self.jet_shift_storage == "delta":
+        events = encode_jet_shift_deltas(events)
+
     return events
 
 
@@ -45,11 +52,13 @@ def base_init(self: Calibrator) -> None:
 
     if self.dataset_inst.is_data or self.skip_jecunc:
         self.calibrators.append(jec_nominal)
+    elif self.batch_jecunc:
+        self.calibrators.append(jec_batched)
     else:
         self.calibrators.append(jec)
 
     if self.bjet_regression:
-        self.calibrators.append(bjet_regression)
+        self.calibrators.append(bjet_regression_flat)
 
     # run JER only on MC
     # and not for 2022 (TODO: update as soon as JER is done for Summer22)
@@ -59,6 +68,21 @@ def base_init(self: Calibrator) -> None:
     self.uses |= set(self.calibrators)
     self.produces |= set(self.calibrators)
 
+    # when shifted jets are stored as deltas, the full shifted jet columns declared by the
+    # calibrators are not written, which is why produced columns are not checked
+    self.jet_shift_storage = get_jet_shift_storage(self.config_inst)
+    if self.jet_shift_storage == "delta":
+        shift_tags = {"jec"} if {jec, jec_batched} & set(self.calibrators) else set()
+        if jer in self.calibrators:
+            shift_tags.add("jer")
+        self.produces |= {
+            f"Jet.{field}_{shift_inst.name}_delta"
+            for shift_inst in self.config_inst.shifts
+            if shift_inst.has_tag(shift_tags)
+            for field in jet_shift_fields
+        }
+        self.check_produced_columns = False
+
 
 default = base.derive("default", cls_dict=dict(skip_jecunc=False, bjet_regression=False))
 skip_jecunc = base.derive("skip_jecunc", cls_dict=dict(skip_jecunc=True, bjet_regression=False))
@@ -8,11 +8,15 @@ from __future__ import annotations
 
 import functools
 
-from columnflow.util import maybe_import, try_float
+from columnflow.util import maybe_import, try_float, InsertableDict
 from columnflow.columnar_util import set_ak_column
-from columnflow.calibration.cms.jets import jec
+from columnflow.calibration.cms.jets import (
+    jec, get_evaluators, get_jec_file_default, get_jec_config_default,
+)
 from columnflow.calibration import calibrator, Calibrator
 
+from hbw.production.compiled_corrections import compile_correction, CompiledCorrectionStack, CorrectionFile
+from hbw.util import njit, flat_record_buffers, from_flat_buffer, set_flat_record_fields, set_ak_columns
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -29,6 +33,191 @@ set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
 jec_nominal = jec.derive("jec_nominal", cls_dict={"uncertainty_sources": []})
 
 
+@njit
+def _jec_shifts_kernel(offsets, pt, mass, phi, met_mask, unc, met_pt, met_phi):
+    # shifted jet pt and mass of all uncertainty sources in a single pass over the flat jet buffers,
+    # with the shifts of the jets in the met_mask being propagated to the MET
+    n_sources = unc.shape[1]
+    start = offsets[0]
+    jet_shifts = np.zeros((n_sources, 4, len(pt)), dtype=np.float32)
+    met_shifts = np.empty((n_sources, 4, len(offsets) - 1), dtype=np.float32)
+    dpx = np.empty(n_sources, dtype=np.float64)
+    dpy = np.empty(n_sources, dtype=np.float64)
+
+    for ev in range(len(offsets) - 1):
+        dpx[:] = 0.0
+        dpy[:] = 0.0
+        for i in range(offsets[ev], offsets[ev + 1]):
+            cos_phi, sin_phi = np.cos(phi[i]), np.sin(phi[i])
+            for s in range(n_sources):
+                u = unc[i - start, s]
+                jet_shifts[s, 0, i] = pt[i] * (1.0 + u)
+                jet_shifts[s, 1, i] = pt[i] * (1.0 - u)
+                jet_shifts[s, 2, i] = mass[i] * (1.0 + u)
+                jet_shifts[s, 3, i] = mass[i] * (1.0 - u)
+                if len(met_mask) and met_mask[i - start]:
+                    # change of the jet pt (up variation), the down variation being mirrored
+                    dpt = np.float64(jet_shifts[s, 0, i]) - pt[i]
+                    dpx[s] += dpt * cos_phi
+                    dpy[s] += dpt * sin_phi
+
+        if not len(met_mask):
+            continue
+        met_px, met_py = met_pt[ev] * np.cos(met_phi[ev]), met_pt[ev] * np.sin(met_phi[ev])
+        for s in range(n_sources):
+            met_shifts[s, 0, ev] = np.sqrt((met_px - dpx[s])**2 + (met_py - dpy[s])**2)
+            met_shifts[s, 1, ev] = np.sqrt((met_px + dpx[s])**2 + (met_py + dpy[s])**2)
+            met_shifts[s, 2, ev] = np.arctan2(met_py - dpy[s], met_px - dpx[s])
+            met_shifts[s, 3, ev] = np.arctan2(met_py + dpy[s], met_px + dpx[s])
+
+    return jet_shifts, met_shifts
+
+
+@calibrator(
+    uses={
+        jec_nominal,
+        "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.rawFactor",
+    },
+    produces={jec_nominal},
+    # custom uncertainty sources, defaults to config when empty
+    uncertainty_sources=None,
+    # minimum raw pt and maximum abs eta of jets whose shifts are propagated to MET, same as in jec
+    min_pt_met_prop=15.0,
+    max_eta_met_prop=5.2,
+    # function to determine the correction file
+    get_jec_file=get_jec_file_default,
+    # function to determine the jec configuration dict
+    get_jec_config=get_jec_config_default,
+)
+def jec_batched(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Variant of the :py:class:`~columnflow.calibration.cms.jets.jec` calibrator that evaluates all
+    jet energy uncertainty sources together. The nominal correction is applied via
+    :py:class:`jec_nominal`. The uncertainties of all sources are then looked up at once from
+    the stacked, compiled corrections, sharing the jet inputs, and all shifted jet pt and mass
+    columns (and the propagated MET) are computed in a single compiled pass and added in one step.
+    """
+    events = self[jec_nominal](events, **kwargs)
+
+    if not self.sources:
+        return events
+
+    # raw jet pt as computed in jec_nominal, or obtained from the raw factor
+    has_pt_raw = "pt_raw" in events.Jet.fields
+    offsets, buffers = flat_record_buffers(
+        events.Jet,
+        ["pt", "eta", "phi", "mass", "pt_raw" if has_pt_raw else "rawFactor"],
+    )
+    start, stop = offsets[0], offsets[-1]
+    pt_raw = (
+        buffers["pt_raw"][start:stop]
+        if has_pt_raw
+        else buffers["pt"][start:stop] * (1 - buffers["rawFactor"][start:stop])
+    )
+
+    # uncertainties of all sources, evaluated with the raw jet pt, same as in jec
+    eta = buffers["eta"][start:stop]
+    variable_map = {
+        "JetEta": eta,
+        "JetPt": pt_raw,
+    }
+    unc = self.junc_stack(*(variable_map[inp.name] for inp in self.junc_stack.inputs))
+
+    # jets whose shifts are propagated to MET
+    met_mask = np.zeros(0, dtype=bool)
+    met_pt = met_phi = np.zeros(0, dtype=np.float32)
+    if self.propagate_met:
+        met_mask = (pt_raw > self.min_pt_met_prop) & (np.abs(eta) < self.max_eta_met_prop)
+        met_pt = ak.to_numpy(events.MET.pt)
+        met_phi = ak.to_numpy(events.MET.phi)
+
+    jet_shifts, met_shifts = _jec_shifts_kernel(
+        offsets,
+        buffers["pt"],
+        buffers["mass"],
+        buffers["phi"],
+        met_mask,
+        unc,
+        met_pt,
+        met_phi,
+    )
+
+    # add all shifted columns at once
+    jet_columns = {}
+    met_columns = {}
+    for s, name in enumerate(self.sources):
+        for d, direction in enumerate(("up", "down")):
+            jet_columns[f"pt_jec_{name}_{direction}"] = jet_shifts[s, d]
+            jet_columns[f"mass_jec_{name}_{direction}"] = jet_shifts[s, 2 + d]
+            met_columns[f"pt_jec_{name}_{direction}"] = met_shifts[s, d]
+            met_columns[f"phi_jec_{name}_{direction}"] = met_shifts[s, 2 + d]
+
+    events = set_ak_column(events, "Jet", set_flat_record_fields(events.Jet, offsets, jet_columns))
+    if self.propagate_met:
+        events = set_ak_column(events, "MET", set_ak_columns(events.MET, met_columns))
+
+    return events
+
+
+@jec_batched.init
+def jec_batched_init(self: Calibrator) -> None:
+    self.sources = self.uncertainty_sources
+    if self.sources is None:
+        self.sources = self.get_jec_config().uncertainty_sources
+    self.sources = list(self.sources)
+
+    # the MET is propagated when it is also done for the nominal correction
+    self.propagate_met = jec_nominal.propagate_met
+
+    # add shifted jet variables
+    self.produces |= {
+        f"Jet.{shifted_var}_jec_{junc_name}_{junc_dir}"
+        for shifted_var in ("pt", "mass")
+        for junc_name in self.sources
+        for junc_dir in ("up", "down")
+    }
+
+    # add shifted MET variables
+    if self.propagate_met:
+        self.uses |= {"MET.pt", "MET.phi"}
+        self.produces |= {
+            f"MET.{shifted_var}_jec_{junc_name}_{junc_dir}"
+            for shifted_var in ("pt", "phi")
+            for junc_name in self.sources
+            for junc_dir in ("up", "down")
+        }
+
+
+@jec_batched.requires
+def jec_batched_requires(self: Calibrator, reqs: dict) -> None:
+    if "external_files" in reqs:
+        return
+
+    from columnflow.tasks.external import BundleExternalFiles
+    reqs["external_files"] = BundleExternalFiles.req(self.task)
+
+
+@jec_batched.setup
+def jec_batched_setup(self: Calibrator, reqs: dict, inputs: dict, reader_targets: InsertableDict) -> None:
+    if not self.sources:
+        return
+
+    # load and compile the uncertainty corrections of all sources (only stored as MC keys)
+    import correctionlib
+    content = CorrectionFile(self.get_jec_file(reqs["external_files"].files).load(formatter="gzip"))
+    correction_set = correctionlib.CorrectionSet.from_string(content.content.decode("utf-8"))
+
+    jec_cfg = self.get_jec_config()
+    junc_keys = [
+        f"{jec_cfg.campaign}_{jec_cfg.version}_MC_{name}_{jec_cfg.jet_type}"
+        for name in self.sources
+    ]
+    self.junc_stack = CompiledCorrectionStack([
+        compile_correction(correction, content)
+        for correction in get_evaluators(correction_set, junc_keys)
+    ])
+
+
 @calibrator(
     uses={
         "Jet.pt", "Jet.mass", "Jet.btagDeepFlavB", "Jet.bRegCorr",
@@ -75,3 +264,88 @@ def bjet_regression(
     events = set_ak_column_f32(events, "Jet.mass", jet_mass)
 
     return events
+
+
+@njit
+def _bjet_regression_kernel(offsets, pt, mass, btag, b_reg_corr, jet_mask, min_pt, btag_wp, apply_btag_wp):
+    # regressed pt and mass in a single pass over the flat jet buffers (indexed by the offsets); the
+    # btag cut is skipped entirely when not *apply_btag_wp*, so that also jets with nan scores pass
+    jet_pt = np.empty(len(pt), dtype=np.float32)
+    jet_mass = np.empty(len(mass), dtype=np.float32)
+    start = offsets[0]
+    for i in range(start, offsets[-1]):
+        if (
+            pt[i] > min_pt and
+            (not apply_btag_wp or btag[i] > btag_wp) and
+            (len(jet_mask) == 0 or jet_mask[i - start])
+        ):
+            jet_pt[i] = pt[i] * b_reg_corr[i]
+            jet_mass[i] = mass[i] * b_reg_corr[i]
+        else:
+            jet_pt[i] = pt[i]
+            jet_mass[i] = mass[i]
+
+    return jet_pt, jet_mass
+
+
+@calibrator(
+    uses={
+        "Jet.pt", "Jet.mass", "Jet.btagDeepFlavB", "Jet.bRegCorr",
+    },
+    produces={"Jet.pt", "Jet.mass"},
+    btag_wp="medium",
+    # minimum jet pt for the regression to be applied
+    min_pt=20.0,
+)
+def bjet_regression_flat(
+    self: Calibrator,
+    events: ak.Array,
+    jet_mask: ak.Array | None = None,
+    **kwargs,
+):
+    """
+    Variant of :py:class:`bjet_regression` that computes the regressed jet pt and mass in a single
+    compiled pass over the flat jet buffers. The new columns share the offsets of the original jets
+    and are not copied again when stored. The btag working point is resolved once in the setup.
+
+    :param events: Awkward array containing events to process
+    :param jet_mask: Optional awkward array containing a mask on which to apply the bjet regression.
+        Jet.pt > min_pt and, when btag_wp is set, Jet-btagDeepFlavB > btag_wp is always required
+    """
+    offsets, buffers = flat_record_buffers(events.Jet, ["pt", "mass", "btagDeepFlavB", "bRegCorr"])
+
+    # flat optional mask, aligned with the first jet of the chunk
+    flat_jet_mask = (
+        np.zeros(0, dtype=bool)
+        if jet_mask is None
+        else ak.to_numpy(ak.flatten(jet_mask, axis=1)).astype(bool, copy=False)
+    )
+
+    jet_pt, jet_mass = _bjet_regression_kernel(
+        offsets,
+        buffers["pt"],
+        buffers["mass"],
+        buffers["btagDeepFlavB"],
+        buffers["bRegCorr"],
+        flat_jet_mask,
+        self.min_pt,
+        self.btag_wp_value,
+        self.apply_btag_wp,
+    )
+    events = set_ak_column(events, "Jet.pt", from_flat_buffer(offsets, jet_pt))
+    events = set_ak_column(events, "Jet.mass", from_flat_buffer(offsets, jet_mass))
+
+    return events
+
+
+@bjet_regression_flat.setup
+def bjet_regression_flat_setup(self: Calibrator, reqs: dict, inputs: dict, reader_targets) -> None:
+    # resolve the btag working point, compared in single precision like the btag scores; without a
+    # working point, no btag cut is applied (as in bjet_regression)
+    self.apply_btag_wp = bool(self.btag_wp)
+    btag_wp = 0.0
+    if self.apply_btag_wp:
+        btag_wp = self.btag_wp
+        if not try_float(self.btag_wp):
+            btag_wp = self.config_inst.x.btag_working_points.deepjet[self.btag_wp]
+    self.btag_wp_value = np.float32(btag_wp)
@@ -19,13 +19,17 @@ power of 10 | category block
 5: gen-level leptons (not combined with other categories)
 """
 
+from __future__ import annotations
+
+import itertools
+import math
 from collections import OrderedDict
+from typing import Callable, Iterator
 
 import law
 
 from time import time
 
-from columnflow.config_util import create_category_combinations
 from columnflow.ml import MLModel
 from hbw.util import call_once_on_config
 
@@ -210,10 +214,309 @@ def kwargs_fn(root_cats):
     return kwargs
 
 
+class LazyCategoryCombinations(object):
+    """
+    Lazy replacement of columnflow's *create_category_combinations*. Instead of building all
+    combinations of the *category_blocks* when setting up the *config*, only the root categories of
+    the blocks are indexed. Combined categories (e.g. ``"sr__1e__resolved__1b"``) are created, together
+    with their parent categories, when they are looked up via :py:meth:`get_category`, while
+    :py:meth:`walk_categories`, :py:meth:`get_leaf_categories` and :py:meth:`complete_all` create all
+    combinations at once. Names are decoded via the *root_cats* naming of *name_fn* and ids via the
+    id-sum scheme of *kwargs_fn*.
+
+    The methods of the *config* itself are not changed, so combined categories that are not created
+    yet are unknown to them. Leaf categories can be enumerated without creating any category via
+    :py:meth:`iter_leaf_categories`.
+    """
+
+    def __init__(
+        self,
+        config: od.Config,
+        category_blocks: OrderedDict[str, list[od.Category]],
+        name_fn: Callable = name_fn,
+        kwargs_fn: Callable = kwargs_fn,
+    ):
+        super().__init__()
+
+        self.config = config
+        self.category_blocks = OrderedDict(category_blocks)
+        self.name_fn = name_fn
+        self.kwargs_fn = kwargs_fn
+
+        # root categories and their blocks
+        self.root_blocks = {
+            cat.name: block
+            for block, cats in self.category_blocks.items()
+            for cat in cats
+        }
+        self.root_cats = {
+            cat.name: cat
+            for cats in self.category_blocks.values()
+            for cat in cats
+        }
+
+        # created combined categories and names of categories with a complete subtree
+        self.categories = {}
+        self.complete = set()
+        self.all_complete = False
+
+    def __len__(self) -> int:
+        # number of all combined categories, including the ones that are not created yet
+        n_cats = [len(cats) for cats in self.category_blocks.values()]
+        return sum(
+            math.prod(n)
+            for n_blocks in range(2, len(n_cats) + 1)
+            for n in itertools.combinations(n_cats, n_blocks)
+        )
+
+    def _ordered(self, root_cats: dict[str, od.Category]) -> OrderedDict[str, od.Category]:
+        return OrderedDict(
+            (block, root_cats[block])
+            for block in self.category_blocks
+            if block in root_cats
+        )
+
+    def decode_name(self, name: str) -> OrderedDict[str, od.Category] | None:
+        """
+        Returns the root categories per block of the combined category *name*, or *None* if it does
+        not refer to a combined category.
+        """
+        parts = name.split("__")
+        if len(parts) < 2 or any(part not in self.root_blocks for part in parts):
+            return None
+
+        root_cats = {self.root_blocks[part]: self.root_cats[part] for part in parts}
+        if len(root_cats) != len(parts):
+            return None
+
+        root_cats = self._ordered(root_cats)
+        return root_cats if self.name_fn(root_cats) == name else None
+
+    def decode_id(self, cat_id: int) -> OrderedDict[str, od.Category] | None:
+        """
+        Returns the root categories per block of the combined category with id *cat_id*, which is
+        the sum of the ids of its root categories, or *None* if it does not refer to a combined
+        category.
+        """
+        blocks = list(self.category_blocks.items())
+        # maximum id that can still be added by all following blocks, used to prune the search
+        max_rest = list(itertools.accumulate([max(c.id for c in cats) for _, cats in blocks][::-1]))[::-1] + [0]
+
+        def search(i: int, rest: int, root_cats: dict) -> dict | None:
+            if rest == 0 and len(root_cats) >= 2:
+                return root_cats
+            if i == len(blocks) or rest < 0 or rest > max_rest[i]:
+                return None
+            block, cats = blocks[i]
+            for cat in cats:
+                result = search(i + 1, rest - cat.id, {**root_cats, block: cat})
+                if result:
+                    return result
+            return search(i + 1, rest, root_cats)
+
+        root_cats = search(0, cat_id, {})
+        return self._ordered(root_cats) if root_cats else None
+
+    def decode(self, obj) -> OrderedDict[str, od.Category] | None:
+        if isinstance(obj, od.Category):
+            obj = obj.name
+        if isinstance(obj, str):
+            return self.decode_name(obj)
+        if isinstance(obj, int):
+            return self.decode_id(obj)
+        return None
+
+    def create(self, root_cats: OrderedDict[str, od.Category]) -> od.Category:
+        """
+        Returns the combined category of *root_cats*, creating it and all its parent categories
+        if needed, but not its subtree.
+        """
+        if len(root_cats) == 1:
+            return list(root_cats.values())[0]
+
+        cat_name = self.name_fn(root_cats)
+        if cat_name in self.categories:
+            return self.categories[cat_name]
+
+        kwargs = self.kwargs_fn(root_cats)
+        kwargs.setdefault("selection", [c.selection for c in root_cats.values()])
+        cat = self.categories[cat_name] = od.Category(name=cat_name, **kwargs)
+
+        # connect to all direct parents
+        for parent_blocks in itertools.combinations(root_cats, len(root_cats) - 1):
+            parent_cat = self.create(OrderedDict((block, root_cats[block]) for block in parent_blocks))
+            parent_cat.add_category(cat)
+
+        return cat
+
+    def complete_subtree(self, root_cats: OrderedDict[str, od.Category]) -> None:
+        """
+        Creates all combined categories in the subtree of the category of *root_cats*.
+        """
+        cat_name = self.name_fn(root_cats)
+        if self.all_complete or cat_name in self.complete:
+            return
+
+        for block, cats in self.category_blocks.items():
+            if block in root_cats:
+                continue
+            for cat in cats:
+                child_root_cats = self._ordered({**root_cats, block: cat})
+                self.create(child_root_cats)
+                self.complete_subtree(child_root_cats)
+
+        self.complete.add(cat_name)
+
+    def complete_all(self) -> None:
+        """
+        Creates all combined categories.
+        """
+        if self.all_complete:
+            return
+
+        t0 = time()
+        for block, cats in self.category_blocks.items():
+            for cat in cats:
+                self.complete_subtree(OrderedDict([(block, cat)]))
+        self.all_complete = True
+        logger.info(f"Number of produced category insts: {len(self.categories)} (took {(time() - t0):.3f}s)")
+
+    def get_category(self, obj: str | int | od.Category) -> od.Category:
+        """
+        Returns the category *obj* of the config, given by name, id or instance. Combined categories
+        are created with their parent categories if needed.
+        """
+        root_cats = self.decode(obj)
+        if root_cats is not None:
+            return self.create(root_cats)
+        return self.config.get_category(obj)
+
+    def has_category(self, obj: str | int | od.Category) -> bool:
+        """
+        Returns whether the category *obj* is known to the config or is a combined category, without
+        creating it.
+        """
+        return self.decode(obj) is not None or self.config.has_category(obj)
+
+    def walk_categories(self, *args, **kwargs):
+        """
+        Creates all combined categories and walks through the categories of the config.
+        """
+        self.complete_all()
+        return self.config.walk_categories(*args, **kwargs)
+
+    def get_leaf_categories(self) -> list[od.Category]:
+        """
+        Creates all combined categories and returns the leaf categories of the config.
+        """
+        self.complete_all()
+        return self.config.get_leaf_categories()
+
+    def iter_leaf_categories(self) -> Iterator[tuple[str, dict]]:
+        """
+        Generator that yields the name and a dictionary with *id* and *selection* of all leaf
+        categories of the config, without creating any combined category.
+        """
+        # leaf categories that are not part of the combinations
+        seen = set()
+        for cat, _, children in self.config.walk_categories():
+            if cat.name in seen or cat.name in self.root_cats or cat.name in self.categories:
+                children.clear()
+                continue
+            seen.add(cat.name)
+            if not children:
+                yield cat.name, {"id": cat.id, "selection": cat.selection}
+
+        # combinations of all blocks
+        for cats in itertools.product(*self.category_blocks.values()):
+            root_cats = OrderedDict(zip(self.category_blocks, cats))
+            kwargs = self.kwargs_fn(root_cats)
+            yield self.name_fn(root_cats), {
+                "id": kwargs["id"],
+                "selection": kwargs.get("selection", [c.selection for c in cats]),
+            }
+
+
+def add_lazy_category_combinations(
+    config: od.Config,
+    category_blocks: OrderedDict[str, list[od.Category]],
+    name_fn: Callable = name_fn,
+    kwargs_fn: Callable = kwargs_fn,
+) -> LazyCategoryCombinations:
+    """
+    Adds lazy combinations of the *category_blocks* to the *config* (see
+    :py:class:`LazyCategoryCombinations`) and stores them in the auxiliary data of the *config*.
+    """
+    lazy_cats = LazyCategoryCombinations(config, category_blocks, name_fn=name_fn, kwargs_fn=kwargs_fn)
+    config.x.lazy_category_combinations = lazy_cats
+    return lazy_cats
+
+
+def iter_leaf_categories(config: od.Config) -> Iterator[tuple[str, dict]]:
+    """
+    Generator that yields the name and a dictionary with *id* and *selection* of all leaf categories
+    of the *config*, without creating lazy combined categories.
+    """
+    lazy_cats = config.x("lazy_category_combinations", None)
+    if lazy_cats is not None:
+        yield from lazy_cats.iter_leaf_categories()
+        return
+
+    for cat in config.get_leaf_categories():
+        yield cat.name, {"id": cat.id, "selection": cat.selection}
+
+
+def get_category(config: od.Config, obj: str | int | od.Category) -> od.Category:
+    """
+    Returns the category *obj* of the *config*, creating it and its parents when it is a lazy
+    combined category.
+    """
+    lazy_cats = config.x("lazy_category_combinations", None)
+    if lazy_cats is not None:
+        return lazy_cats.get_category(obj)
+    return config.get_category(obj)
+
+
+def has_category(config: od.Config, obj: str | int | od.Category) -> bool:
+    """
+    Returns whether the category *obj* is known to the *config*, including lazy combined categories.
+    """
+    lazy_cats = config.x("lazy_category_combinations", None)
+    if lazy_cats is not None:
+        return lazy_cats.has_category(obj)
+    return config.has_category(obj)
+
+
+def walk_categories(config: od.Config, *args, **kwargs):
+    """
+    Walks through all categories of the *config*, after creating all lazy combined categories.
+    """
+    complete_category_combinations(config)
+    return config.walk_categories(*args, **kwargs)
+
+
+def get_leaf_categories(config: od.Config) -> list[od.Category]:
+    """
+    Returns all leaf categories of the *config*, after creating all lazy combined categories.
+    """
+    complete_category_combinations(config)
+    return config.get_leaf_categories()
+
+
+def complete_category_combinations(config: od.Config) -> None:
+    """
+    Creates all lazy combined categories of the *config*, if any.
+    """
+    lazy_cats = config.x("lazy_category_combinations", None)
+    if lazy_cats is not None:
+        lazy_cats.complete_all()
+
+
 @call_once_on_config()
-def add_categories_production(config: od.Config) -> None:
+def add_categories_production(config: od.Config, lazy: bool = False) -> None:
     """
-    Adds categories to a *config*, that are typically produced in `ProduceColumns`.
+    Adds categories to a *config*, that are typically produced in `ProduceColumns`. When *lazy*,
+    combined categories are only created on demand (see :py:class:`LazyCategoryCombinations`).
     """
     if config.has_tag("add_categories_ml_called"):
         logger.warning("We should not call *add_categories_production* when also building ML categories")
@@ -252,18 +555,14 @@ def add_categories_production(config: od.Config) -> None:
         "b": [config.get_category("1b"), config.get_category("2b")],
     })
     t0 = time()
-    n_cats = create_category_combinations(
-        config,
-        category_blocks,
-        name_fn=name_fn,
-        kwargs_fn=kwargs_fn,
-        skip_existing=False,  # there should be no existing sub-categories
-    )
-    logger.info(f"Number of produced category insts: {n_cats} (took {(time() - t0):.3f}s)")
+    lazy_cats = add_lazy_category_combinations(config, category_blocks, name_fn=name_fn, kwargs_fn=kwargs_fn)
+    logger.info(f"Number of lazy category combinations: {len(lazy_cats)} (took {(time() - t0):.3f}s)")
+    if not lazy:
+        lazy_cats.complete_all()
 
 
 @call_once_on_config()
-def add_categories_ml(config, ml_model_inst):
+def add_categories_ml(config, ml_model_inst, lazy: bool = False):
     if config.has_tag("add_categories_production_called"):
         raise Exception("We should not call *add_categories_production* when also building ML categories")
     #
@@ -313,7 +612,7 @@ def add_categories_ml(config, ml_model_inst):
     # create combination of categories
     #
 
-    # NOTE: building this many categories takes forever: has to be improved...
+    # NOTE: building this many categories takes forever, so they can be created on demand when *lazy*
     category_blocks = OrderedDict({
         "lepid": [config.get_category("sr"), config.get_category("fake")],
         # "met": [config.get_category("highmet"), config.get_category("lowmet")],
@@ -331,12 +630,8 @@ def add_categories_ml(config, ml_model_inst):
     # })
 
     t0 = time()
-    # create combination of categories
-    n_cats = create_category_combinations(
-        config,
-        category_blocks,
-        name_fn=name_fn,
-        kwargs_fn=kwargs_fn,
-        skip_existing=True,
-    )
-    logger.info(f"Number of produced ml category insts: {n_cats} (took {(time() - t0):.3f}s)")
+    # create lazy combination of categories, only creating all of them when not *lazy*
+    lazy_cats = add_lazy_category_combinations(config, category_blocks, name_fn=name_fn, kwargs_fn=kwargs_fn)
+    logger.info(f"Number of lazy ml category combinations: {len(lazy_cats)} (took {(time() - t0):.3f}s)")
+    if not lazy:
+        lazy_cats.complete_all()
@@ -225,6 +225,14 @@ def add_config(
         "jet_type": jet_type,
     })
 
+    # storage of the shifted jet pt and mass columns of JEC and JER variations, either "full"
+    # or "delta" (compact deltas relative to the nominal jets, see hbw.production.jet_shift_deltas)
+    cfg.x.jet_shift_storage = "full"
+
+    # threshold of the large_weights_killer in pre_selection, either "chunk" (quantile of each chunk) or
+    # "dataset" (quantile of the whole dataset, obtained from the stats of the weight_sketch selector)
+    cfg.x.large_weights_threshold_mode = "chunk"
+
     # JEC uncertainty sources propagated to btag scale factors
     # (names derived from contents in BTV correctionlib file)
     cfg.x.btag_sf_jec_sources = [
@@ -410,6 +418,16 @@ def add_config(
 
     with open(os.path.join(thisdir, "jec_sources.yaml"), "r") as f:
         all_jec_sources = yaml.load(f, yaml.Loader)["names"]
+
+    # shifted jets are either read directly or reconstructed from their deltas
+    if cfg.x.jet_shift_storage == "delta":
+        jet_shift_aliases = {
+            "Jet.pt_shift_delta": "Jet.pt_{name}_delta",
+            "Jet.mass_shift_delta": "Jet.mass_{name}_delta",
+        }
+    else:
+        jet_shift_aliases = {"Jet.pt": "Jet.pt_{name}", "Jet.mass": "Jet.mass_{name}"}
+
     for jec_source in cfg.x.jec["uncertainty_sources"]:
         idx = all_jec_sources.index(jec_source)
         cfg.add_shift(
@@ -426,15 +444,11 @@ def add_config(
             tags={"jec"},
             aux={"jec_source": jec_source},
         )
-        add_shift_aliases(
-            cfg,
-            f"jec_{jec_source}",
-            {"Jet.pt": "Jet.pt_{name}", "Jet.mass": "Jet.mass_{name}"},
-        )
+        add_shift_aliases(cfg, f"jec_{jec_source}", jet_shift_aliases)
 
     cfg.add_shift(name="jer_up", id=6000, type="shape", tags={"jer"})
     cfg.add_shift(name="jer_down", id=6001, type="shape", tags={"jer"})
-    add_shift_aliases(cfg, "jer", {"Jet.pt": "Jet.pt_{name}", "Jet.mass": "Jet.mass_{name}"})
+    add_shift_aliases(cfg, "jer", jet_shift_aliases)
 
     def make_jme_filename(jme_aux, sample_type, name, era=None):
         """
@@ -692,6 +706,7 @@ def add_config(
         "cf.CalibrateEvents": "common1",
         "cf.SelectEvents": reduce_version,
         "cf.MergeSelectionStats": reduce_version,
+        "hbw.MergeSelectionStatsArrays": reduce_version,
         "cf.MergeSelectionMasks": reduce_version,
         "cf.ReduceEvents": reduce_version,
         "cf.MergeReductionStats": reduce_version,
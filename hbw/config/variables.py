@@ -127,13 +127,8 @@ def add_feature_variables(config: od.Config) -> None:
         )
 
 
-@call_once_on_config()
-def add_neutrino_variables(config: od.Config) -> None:
-    """
-    Adds variables to a *config* that are produced as part of the `neutrino_reconstruction` producer.
-    """
-
-    for obj in ["Neutrino", "Neutrino1", "Neutrino2"]:
+def _add_neutrino_object_variables(config: od.Config, objects: list[str]) -> None:
+    for obj in objects:
         # pt and phi should be the same as MET, mass should always be 0
         for var in ["pt", "eta", "phi", "mass"]:
             config.add_variable(
@@ -145,12 +140,31 @@ def add_neutrino_variables(config: od.Config) -> None:
             )
 
 
+@call_once_on_config()
+def add_neutrino_variables(config: od.Config) -> None:
+    """
+    Adds variables to a *config* of the Neutrino that is produced by all modes of the
+    `neutrino_reconstruction` producer.
+    """
+    _add_neutrino_object_variables(config, ["Neutrino"])
+
+
+@call_once_on_config()
+def add_neutrino_solution_variables(config: od.Config) -> None:
+    """
+    Adds variables to a *config* of both Neutrino solutions, that are only produced by the
+    `neutrino_reconstruction` producer when not running in the fast mode.
+    """
+    _add_neutrino_object_variables(config, ["Neutrino1", "Neutrino2"])
+
+
 @call_once_on_config()
 def add_top_reco_variables(config: od.Config) -> None:
     """
     Adds variables to a *config* that are produced as part of the `top_reconstruction` producer.
     """
-    # add neutrino variables aswell since the neutrino needs to be reconstructed anyway
+    # add neutrino variables aswell since the neutrino needs to be reconstructed anyway (in the fast
+    # mode, so without both solutions)
     add_neutrino_variables(config)
 
     # add reconstructed top variables
@@ -12,6 +12,7 @@ from columnflow.util import maybe_import, DotDict
 from columnflow.config_util import get_datasets_from_process
 
 import hbw.inference.constants as const  # noqa
+from hbw.config.categories import get_category
 
 
 np = maybe_import("numpy")
@@ -96,7 +97,7 @@ class HBWInferenceModelBase(InferenceModel):
         # get the MLModel inst
         # ml_model_inst = MLModel.get_cls(self.ml_model_name)(self.config_inst)
         for config_category in self.config_categories:
-            cat_inst = self.config_inst.get_category(config_category)
+            cat_inst = get_category(self.config_inst, config_category)
             root_cats = cat_inst.x.root_cats
             lep_channel = root_cats.get("lep")
             if lep_channel not in self.config_inst.x.lepton_channels:
@@ -59,6 +59,9 @@ class MLClassifierBase(MLModel):
 
     dump_arrays: bool = False
 
+    # when True, the ML inputs producer of the training only computes the input_features
+    prune_ml_inputs: bool = False
+
     # parameters to add into the `parameters` attribute and store in a yaml file
     bookkeep_params: int = [
         "processes", "input_features", "validation_fraction", "ml_process_weights",
@@ -104,7 +107,11 @@ class MLClassifierBase(MLModel):
 
     def training_producers(self, config_inst: od.Config, requested_producers: Sequence[str]) -> list[str]:
         # fix MLTraining Phase Space
-        return [config_inst.x.ml_inputs_producer, "event_weights"]
+        ml_inputs_producer = config_inst.x.ml_inputs_producer
+        if self.prune_ml_inputs:
+            from hbw.production.ml_inputs import pruned_ml_inputs
+            ml_inputs_producer = pruned_ml_inputs(ml_inputs_producer, self.input_features).cls_name
+        return [ml_inputs_producer, "event_weights"]
 
     def requires(self, task: law.Task) -> str:
         # Custom requirements (none currently)
@@ -4,13 +4,16 @@
 Set of producers to reconstruct categories at different states of the analysis
 """
 
+from __future__ import annotations
+
 import law
 
+from columnflow.categorization import Categorizer
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import, InsertableDict
-from columnflow.production.categories import category_ids
+from columnflow.columnar_util import set_ak_column
 
-from hbw.config.categories import add_categories_production, add_categories_ml
+from hbw.config.categories import add_categories_production, add_categories_ml, iter_leaf_categories
 from hbw.util import get_subclasses_deep
 
 np = maybe_import("numpy")
@@ -19,16 +22,107 @@ ak = maybe_import("awkward")
 logger = law.logger.get_logger(__name__)
 
 
+@producer(produces={"category_ids"})
+def hbw_category_ids(
+    self: Producer,
+    events: ak.Array,
+    target_events: ak.Array | None = None,
+    **kwargs,
+) -> ak.Array:
+    """
+    Assigns each event an array of category ids, equivalent to columnflow's *category_ids*
+    producer. Instead of evaluating the masks of each (combined) leaf category separately, each
+    categorizer is evaluated exactly once and its mask is stored as one bit of a packed bit field
+    per event. The leaf category ids are then looked up per unique bit pattern, so that the cost
+    scales with the number of root categorizers instead of the number of combined categories.
+    """
+    # evaluate all categorizers once and pack their masks into a bit field
+    bits = np.zeros(len(events), dtype=np.uint64)
+    for bit, categorizer in enumerate(self.categorizers):
+        events, mask = self[categorizer](events, **kwargs)
+        bits |= np.asarray(mask, dtype=np.uint64) << np.uint64(bit)
+
+    # lookup table from unique bit patterns to leaf categories whose required bits are all set
+    patterns, pattern_index = np.unique(bits, return_inverse=True)
+    pattern_match = (patterns[:, None] & self.leaf_bits[None, :]) == self.leaf_bits[None, :]
+    pattern_ids = ak.unflatten(
+        np.broadcast_to(self.leaf_ids, pattern_match.shape)[pattern_match],
+        pattern_match.sum(axis=1),
+    )
+    category_ids = pattern_ids[pattern_index.reshape(-1)]
+
+    # save, optionally on a target events array
+    if target_events is None:
+        target_events = events
+    target_events = set_ak_column(target_events, "category_ids", category_ids, value_type=np.int64)
+
+    return target_events
+
+
+@hbw_category_ids.init
+def hbw_category_ids_init(self: Producer) -> None:
+    # unique categorizers of all leaf categories, each of them corresponding to one bit
+    self.categorizers = []
+    leaf_bits = []
+    leaf_ids = []
+
+    # iterate over leaf categories without creating lazy category combinations
+    for cat_name, cat_kwargs in iter_leaf_categories(self.config_inst):
+        cat_bits = 0
+        # treat all selections as lists of categorizers
+        for sel in law.util.make_list(cat_kwargs["selection"]):
+            if Categorizer.derived_by(sel):
+                categorizer = sel
+            elif Categorizer.has_cls(sel):
+                categorizer = Categorizer.get_cls(sel)
+            else:
+                raise Exception(
+                    f"selection '{sel}' of category '{cat_name}' cannot be resolved to an "
+                    "existing Categorizer object",
+                )
+
+            # the categorizer must be exposed
+            if not categorizer.exposed:
+                raise RuntimeError(
+                    f"cannot use unexposed categorizer '{categorizer}' to evaluate category "
+                    f"{cat_name}",
+                )
+
+            if categorizer not in self.categorizers:
+                self.categorizers.append(categorizer)
+
+                # update dependency sets
+                self.uses.add(categorizer)
+                self.produces.add(categorizer)
+
+            cat_bits |= 1 << self.categorizers.index(categorizer)
+
+        leaf_bits.append(cat_bits)
+        leaf_ids.append(cat_kwargs["id"])
+
+    if len(self.categorizers) > 64:
+        raise Exception(
+            f"{len(self.categorizers)} categorizers found, but at most 64 can be packed into the "
+            "category bit field",
+        )
+
+    self.leaf_bits = np.array(leaf_bits, dtype=np.uint64)
+    self.leaf_ids = np.array(leaf_ids, dtype=np.int64)
+
+
 @producer(
-    uses={category_ids},
-    produces={category_ids},
+    uses={hbw_category_ids},
+    produces={hbw_category_ids},
+    # when True, combined categories are only created on demand via the helpers in hbw.config.categories,
+    # which is sufficient for evaluating category ids, but not for looking them up via the config itself
+    lazy_categories=False,
 )
 def pre_ml_cats(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
     Reproduces category ids before ML Training
     """
     # category ids
-    events = self[category_ids](events, **kwargs)
+    events = self[hbw_category_ids](events, **kwargs)
 
     return events
 
@@ -36,13 +130,15 @@ def pre_ml_cats(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
 @pre_ml_cats.init
 def pre_ml_cats_init(self: Producer) -> None:
     # add categories to config inst
-    add_categories_production(self.config_inst)
+    add_categories_production(self.config_inst, lazy=self.lazy_categories)
 
 
 @producer(
-    uses={category_ids},
-    produces={category_ids},
+    uses={hbw_category_ids},
+    produces={hbw_category_ids},
     ml_model_name=None,
+    # see pre_ml_cats
+    lazy_categories=False,
 )
 def cats_ml(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
@@ -50,7 +146,7 @@ def cats_ml(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     automatically adds `MLEvaluation` to the requirements.
     """
     # category ids
-    events = self[category_ids](events, **kwargs)
+    events = self[hbw_category_ids](events, **kwargs)
 
     return events
 
@@ -75,7 +171,7 @@ def cats_ml_init(self: Producer) -> None:
         self.ml_model_name = "dense_default"
 
     # add categories to config inst
-    add_categories_ml(self.config_inst, self.ml_model_name)
+    add_categories_ml(self.config_inst, self.ml_model_name, lazy=self.lazy_categories)
 
 
 # get all the derived MLModels and instantiate a corresponding producer for each one
@@ -0,0 +1,633 @@
+# coding: utf-8
+
+"""
+Compiler of correctionlib corrections into numpy lookup engines. Binning, multibinning and category
+nodes are translated into bin edges and value tables, that are evaluated via vectorized
+bin searches and gathers, while all other nodes (e.g. formulas) are evaluated with correctionlib.
+Compiled corrections are validated against correctionlib on synthetic inputs and cached on disk.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import pickle
+import hashlib
+import itertools
+from collections import namedtuple
+from typing import Any, Callable
+
+import law
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+
+logger = law.logger.get_logger(__name__)
+
+# version of the compiled representation, part of the cache key
+COMPILER_VERSION = 1
+
+CorrectionInput = namedtuple("CorrectionInput", ["name", "type"])
+
+
+class _Node(object):
+    """
+    Base class of all compiled nodes. Nodes evaluate the correction for the events at positions
+    *idx* of the flat input arrays *args*, using the correctionlib *fallback* where needed.
+    """
+
+    def evaluate(self, args: list, idx: np.ndarray, fallback: Any) -> np.ndarray:
+        raise NotImplementedError
+
+
+class _Constant(_Node):
+
+    def __init__(self, value: float):
+        super().__init__()
+        self.value = float(value)
+
+    def evaluate(self, args, idx, fallback):
+        return np.full(len(idx), self.value)
+
+
+class _Fallback(_Node):
+
+    def evaluate(self, args, idx, fallback):
+        return np.asarray(fallback.evaluate(*(
+            arg[idx] if isinstance(arg, np.ndarray) and arg.ndim else arg
+            for arg in args
+        )), dtype=np.float64)
+
+
+class _Table(_Node):
+    """
+    Base class of nodes that select one of their *children* per event. When all children are
+    constants, the selection is a single gather from the *values* table.
+    """
+
+    def __init__(self, children: list[_Node]):
+        super().__init__()
+        self.children = children
+        self.values = None
+        if all(isinstance(child, _Constant) for child in children):
+            self.values = np.array([child.value for child in children], dtype=np.float64)
+
+    def dispatch(self, keys: np.ndarray, args, idx, fallback) -> np.ndarray:
+        # gather constants directly
+        if self.values is not None:
+            return self.values[keys]
+
+        # evaluate each child on the events that select it
+        out = np.empty(len(idx), dtype=np.float64)
+        order = np.argsort(keys, kind="stable")
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        for key, start, stop in zip(unique_keys, starts, stops):
+            sel = order[start:stop]
+            out[sel] = self.children[key].evaluate(args, idx[sel], fallback)
+        return out
+
+
+class _Axis(object):
+    """
+    Bin edges of one input, either *uniform* as (n, low, high) or as an array of *edges*, with the
+    same bin finding as correctionlib. The *flow* defines the handling of values outside of the
+    edges, either "clamp", "error" or "value" (the flow content of the node is used).
+    """
+
+    # exception raised for values outside of the edges with "error" flow, same as in correctionlib
+    error_cls = RuntimeError
+
+    def __init__(
+        self,
+        input_index: int,
+        flow: str,
+        edges: np.ndarray | None = None,
+        uniform: tuple | None = None,
+    ):
+        super().__init__()
+        self.input_index = input_index
+        self.flow = flow
+        self.edges = edges
+        self.uniform = uniform
+        self.n = uniform[0] if uniform else len(edges) - 1
+
+    def __eq__(self, other: Any) -> bool:
+        return (
+            isinstance(other, _Axis) and
+            (self.input_index, self.flow, self.uniform) == (other.input_index, other.flow, other.uniform) and
+            (self.edges is None) == (other.edges is None) and
+            (self.edges is None or np.array_equal(self.edges, other.edges))
+        )
+
+    def find(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        """
+        Returns the bin indices of *x* and a mask that is *True* for values outside of the edges
+        (*None* when they are clamped).
+        """
+        if self.uniform:
+            n, low, high = self.uniform
+            with np.errstate(invalid="ignore"):
+                bins = np.clip(np.floor(n * (x - low) / (high - low)), -1, n).astype(np.int64)
+            outside = None if self.flow == "clamp" else ~((x >= low) & (x < high))
+        else:
+            bins = np.searchsorted(self.edges, x, side="right") - 1
+            outside = None if self.flow == "clamp" else (bins < 0) | (bins >= self.n) | np.isnan(x)
+
+        if self.flow == "clamp":
+            bins = np.clip(bins, 0, self.n - 1)
+
+        return bins, outside
+
+
+class _KeyAxis(object):
+    """
+    Integer category keys of one input, with the *flow* being "error" when there is no default
+    content and "value" otherwise.
+    """
+
+    # exception raised for keys that do not exist with "error" flow, same as in correctionlib
+    error_cls = IndexError
+
+    def __init__(self, input_index: int, flow: str, keys: list[int]):
+        super().__init__()
+        self.input_index = input_index
+        self.flow = flow
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.n = len(keys)
+
+        # sorted keys for vectorized lookups
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+
+    def __eq__(self, other: Any) -> bool:
+        return (
+            isinstance(other, _KeyAxis) and
+            (self.input_index, self.flow) == (other.input_index, other.flow) and
+            np.array_equal(self.keys, other.keys)
+        )
+
+    def find(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        pos = np.minimum(np.searchsorted(self.sorted_keys, x), self.n - 1)
+        return self.order[pos], self.sorted_keys[pos] != x
+
+
+class _Grid(_Table):
+    """
+    Binning, multibinning and integer category nodes, possibly fused with their children into
+    one node with many *axes*. The content of all bins is stored in row-major order (the first axis
+    being the slowest), followed by the flow (or default) content if any axis has a "value" flow.
+    """
+
+    def __init__(self, axes: list[_Axis | _KeyAxis], children: list[_Node]):
+        super().__init__(children)
+        self.axes = axes
+        self.has_flow_child = any(axis.flow == "value" for axis in axes)
+        self.strides = np.cumprod([1] + [axis.n for axis in axes[:0:-1]])[::-1]
+
+    def find(self, args, idx) -> np.ndarray:
+        """
+        Returns the indices of the children selected by the events at positions *idx*.
+        """
+        keys = np.zeros(len(idx), dtype=np.int64)
+        any_outside = np.zeros(len(idx), dtype=bool) if self.has_flow_child else None
+        for axis, stride in zip(self.axes, self.strides):
+            bins, outside = axis.find(args[axis.input_index][idx])
+            if axis.flow == "error" and np.any(outside):
+                raise axis.error_cls(
+                    f"{np.sum(outside)} values of input {axis.input_index} out of range or without category",
+                )
+            if axis.flow == "value":
+                any_outside |= outside
+            keys += bins * stride
+
+        if self.has_flow_child:
+            keys[any_outside] = len(self.children) - 1
+
+        return keys
+
+    def evaluate(self, args, idx, fallback):
+        return self.dispatch(self.find(args, idx), args, idx, fallback)
+
+
+# maximum number of bins of grids fused from nested nodes
+MAX_FUSED_BINS = 1_000_000
+
+
+def _fuse(node: _Grid) -> _Grid:
+    """
+    Fuses a grid *node* with its children when all of them are grids with identical axes and none
+    of them (including the *node*) has flow content, so that the whole subtree is evaluated with
+    one bin search per axis and a single gather.
+    """
+    if node.has_flow_child:
+        return node
+
+    first = node.children[0]
+    if not isinstance(first, _Grid) or len(node.children) * len(first.children) > MAX_FUSED_BINS:
+        return node
+    for child in node.children:
+        if not isinstance(child, _Grid) or child.has_flow_child or child.axes != first.axes:
+            return node
+
+    return _Grid(node.axes + first.axes, [c for child in node.children for c in child.children])
+
+
+class _Category(_Table):
+    """
+    Category node with string keys, followed by the *default* content, if any. Scalar inputs (e.g.
+    systematics) directly select a single child.
+    """
+
+    def __init__(self, input_index: int, keys: list, children: list[_Node], has_default: bool):
+        super().__init__(children)
+        self.input_index = input_index
+        self.key_index = {key: i for i, key in enumerate(keys)}
+        self.has_default = has_default
+
+    def lookup(self, key) -> int:
+        if key in self.key_index:
+            return self.key_index[key]
+        if not self.has_default:
+            raise IndexError(f"category key {key!r} not found and no default defined")
+        return len(self.key_index)
+
+    def evaluate(self, args, idx, fallback):
+        x = args[self.input_index]
+
+        if not isinstance(x, np.ndarray) or not x.ndim:
+            key = x.item() if isinstance(x, np.ndarray) else x
+            return self.children[self.lookup(key)].evaluate(args, idx, fallback)
+
+        unique_x, inverse = np.unique(x[idx], return_inverse=True)
+        keys = np.array([self.lookup(key.item()) for key in unique_x], dtype=np.int64)[inverse]
+        return self.dispatch(keys, args, idx, fallback)
+
+
+def _compile_content(content: Any, input_index: dict[str, int]) -> _Node:
+    """
+    Translates the json *content* of a correction node into a compiled node.
+    """
+    if isinstance(content, (int, float)):
+        return _Constant(content)
+
+    nodetype = content.get("nodetype")
+
+    if nodetype in ("binning", "multibinning"):
+        flow = content["flow"]
+        if flow == "wrap":
+            return _Fallback()
+
+        inputs = [content["input"]] if nodetype == "binning" else content["inputs"]
+        edges = [content["edges"]] if nodetype == "binning" else content["edges"]
+        axis_flow = flow if flow in ("clamp", "error") else "value"
+        axes = [
+            _Axis(
+                input_index[name],
+                axis_flow,
+                uniform=(_edges["n"], _edges["low"], _edges["high"]),
+            ) if isinstance(_edges, dict) else _Axis(
+                input_index[name],
+                axis_flow,
+                edges=np.asarray(_edges, dtype=np.float64),
+            )
+            for name, _edges in zip(inputs, edges)
+        ]
+
+        children = [_compile_content(child, input_index) for child in content["content"]]
+        if axis_flow == "value":
+            children.append(_compile_content(flow, input_index))
+        return _fuse(_Grid(axes, children))
+
+    if nodetype == "category":
+        keys = [item["key"] for item in content["content"]]
+        children = [_compile_content(item["value"], input_index) for item in content["content"]]
+        has_default = content.get("default") is not None
+        if has_default:
+            children.append(_compile_content(content["default"], input_index))
+
+        # integer categories are grids with one key axis
+        if keys and all(isinstance(key, int) for key in keys):
+            axis = _KeyAxis(input_index[content["input"]], "value" if has_default else "error", keys)
+            return _fuse(_Grid([axis], children))
+
+        return _Category(input_index[content["input"]], keys, children, has_default)
+
+    # formulas, transforms, etc.
+    return _Fallback()
+
+
+def _iter_nodes(node: _Node):
+    yield node
+    for child in getattr(node, "children", []):
+        yield from _iter_nodes(child)
+
+
+def _broadcast_inputs(args: tuple, inputs: list) -> tuple[list, tuple]:
+    """
+    Broadcasts all *args* to flat arrays of the types of the *inputs*, keeping scalar strings as
+    they are, and returns them together with the broadcast shape.
+    """
+    shapes = [np.shape(arg) for arg in args if not isinstance(arg, str)]
+    shape = np.broadcast_shapes(*shapes) if shapes else ()
+    flat_args = []
+    for arg, inp in zip(args, inputs):
+        if isinstance(arg, str) or (inp.type == "string" and not np.ndim(arg)):
+            flat_args.append(arg)
+            continue
+        dtype = {"real": np.float64, "int": np.int64}.get(inp.type)
+        flat_args.append(np.broadcast_to(np.asarray(arg, dtype=dtype), shape).reshape(-1))
+
+    return flat_args, shape
+
+
+class CompiledCorrection(object):
+    """
+    Numpy lookup engine of a correctionlib correction, with the same interface as
+    :py:class:`correctionlib.highlevel.Correction` (*name*, *version*, *inputs*, :py:meth:`evaluate`
+    and calling). Nodes that cannot be compiled are evaluated with the correctionlib *fallback*.
+    """
+
+    def __init__(self, name: str, version: int, inputs: list[CorrectionInput], root: _Node, fallback: Any):
+        super().__init__()
+
+        self.name = name
+        self.version = version
+        self.inputs = inputs
+        self.root = root
+        self.fallback = fallback
+
+    def evaluate(self, *args) -> float | np.ndarray:
+        if len(args) != len(self.inputs):
+            raise ValueError(f"correction '{self.name}' expects {len(self.inputs)} inputs, got {len(args)}")
+
+        flat_args, shape = _broadcast_inputs(args, self.inputs)
+        n = int(np.prod(shape)) if shape else 1
+        values = self.root.evaluate(flat_args, np.arange(n), self.fallback)
+
+        return values.reshape(shape) if shape else float(values[0])
+
+    __call__ = evaluate
+
+
+def _synthetic_inputs(correction: dict, root: _Node, n: int, rng: np.random.Generator) -> list[list]:
+    """
+    Builds sets of synthetic inputs covering all bins, edges, flows and category keys of a
+    *correction*, with two sets per combination of string keys (of which at most 50 are used), one
+    including and one excluding values outside of the bin edges.
+    """
+    inputs = correction["inputs"]
+    edges = {i: [] for i in range(len(inputs))}
+    keys = {i: set() for i in range(len(inputs))}
+    for node in _iter_nodes(root):
+        if isinstance(node, _Grid):
+            for axis in node.axes:
+                if isinstance(axis, _KeyAxis):
+                    keys[axis.input_index] |= set(axis.keys.tolist())
+                elif axis.uniform:
+                    edges[axis.input_index].extend(np.linspace(axis.uniform[1], axis.uniform[2], axis.n + 1))
+                else:
+                    edges[axis.input_index].extend(axis.edges)
+        elif isinstance(node, _Category):
+            keys[node.input_index] |= set(node.key_index)
+
+    numeric, strings = [], []
+    in_range = np.ones(n, dtype=bool)
+    for i, inp in enumerate(inputs):
+        if inp["type"] == "string":
+            numeric.append(None)
+            strings.append(sorted(keys[i]) or [""])
+            continue
+        strings.append([None])
+        if keys[i]:
+            values = rng.choice(sorted(keys[i]), n)
+        elif edges[i]:
+            _edges = np.unique(edges[i])
+            low, high = _edges[0], _edges[-1]
+            margin = 0.1 * (high - low) + 1
+            values = np.concatenate([_edges, rng.uniform(low - margin, high + margin, n)])[:n]
+            rng.shuffle(values)
+            in_range &= (values >= low) & (values < high)
+        else:
+            values = rng.uniform(0, 100, n)
+        numeric.append(values.astype(np.int64) if inp["type"] == "int" else values.astype(np.float64))
+
+    combinations = list(itertools.product(*strings))
+    if len(combinations) > 50:
+        combinations = [combinations[i] for i in rng.choice(len(combinations), 50, replace=False)]
+
+    return [
+        [value if value is not None else numeric[i][mask] for i, value in enumerate(combination)]
+        for combination in combinations
+        for mask in (slice(None), in_range)
+    ]
+
+
+def validate_compiled_correction(
+    compiled: CompiledCorrection,
+    correction: dict,
+    n: int = 2000,
+    rtol: float = 1e-9,
+    seed: int = 0,
+) -> bool:
+    """
+    Validates a *compiled* correction against its correctionlib fallback on synthetic inputs built
+    from the json *correction*. Inputs for which correctionlib raises an exception (e.g. values out
+    of range of binnings without flow) must raise an exception in the compiled correction as well,
+    and at least one set of inputs must be evaluated successfully.
+    """
+    rng = np.random.default_rng(seed)
+    n_compared = 0
+    for args in _synthetic_inputs(correction, compiled.root, n, rng):
+        try:
+            expected = np.asarray(compiled.fallback.evaluate(*args), dtype=np.float64)
+        except Exception:
+            try:
+                compiled.evaluate(*args)
+            except Exception:
+                continue
+            return False
+        try:
+            values = compiled.evaluate(*args)
+        except Exception:
+            return False
+        if not np.allclose(values, expected, rtol=rtol, atol=0, equal_nan=True):
+            return False
+        n_compared += 1
+
+    return n_compared > 0
+
+
+class CorrectionFile(object):
+    """
+    Json *content* of a correctionlib file, that is hashed once and only parsed when needed, so
+    that many corrections of the same file (e.g. the sources of jet energy uncertainties) can be
+    compiled without parsing and hashing the file for each of them.
+    """
+
+    def __init__(self, content: str | bytes):
+        super().__init__()
+
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        self.content = content
+        self.hash = hashlib.sha256(content).hexdigest()
+        self._corrections = None
+
+    def get_correction(self, name: str) -> dict | None:
+        """
+        Returns the json of the correction *name*, or *None* if the file does not contain it or is
+        not of schema version 2.
+        """
+        if self._corrections is None:
+            correction_set = json.loads(self.content)
+            self._corrections = {}
+            if correction_set.get("schema_version") == 2:
+                self._corrections = {corr["name"]: corr for corr in correction_set["corrections"]}
+        return self._corrections.get(name)
+
+
+def compile_correction(
+    correction: Any,
+    content: str | bytes | CorrectionFile,
+    cache_dir: str | None = None,
+    validate: bool = True,
+) -> CompiledCorrection | Any:
+    """
+    Compiles the correctionlib *correction* (a :py:class:`correctionlib.highlevel.Correction`) that
+    is defined in the json *content* of a correction file into a :py:class:`CompiledCorrection`.
+    When compiling many corrections of the same file, the *content* should be passed as a
+    :py:class:`CorrectionFile`, so that it is only parsed and hashed once.
+    The compiled nodes are cached in *cache_dir* (defaults to ``$LAW_HOME/hbw_compiled_corrections``)
+    keyed by the hash of the *content*. When *validate* is *True*, newly compiled corrections are
+    validated against correctionlib. The *correction* itself is returned when it cannot be compiled
+    or fails the validation.
+    """
+    if not isinstance(content, CorrectionFile):
+        content = CorrectionFile(content)
+    if cache_dir is None:
+        cache_dir = law.config.law_home_path("hbw_compiled_corrections")
+
+    cache_path = os.path.join(cache_dir, f"{content.hash}_{correction.name}_v{COMPILER_VERSION}.pkl")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+    else:
+        cached = {"root": None, "inputs": None}
+        json_correction = content.get_correction(correction.name)
+        if json_correction is not None:
+            root = _compile_content(json_correction["data"], {
+                inp["name"]: i for i, inp in enumerate(json_correction["inputs"])
+            })
+            inputs = [CorrectionInput(inp["name"], inp["type"]) for inp in json_correction["inputs"]]
+            compiled = CompiledCorrection(correction.name, correction.version, inputs, root, correction)
+
+            if isinstance(root, _Fallback):
+                logger.info(f"correction '{correction.name}' cannot be compiled, using correctionlib")
+            elif validate and not validate_compiled_correction(compiled, json_correction):
+                logger.warning(f"validation of compiled correction '{correction.name}' failed, using correctionlib")
+            else:
+                cached = {"root": root, "inputs": inputs}
+
+        # store the result atomically, also when the compilation was not successful
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cached, f)
+        os.replace(tmp_path, cache_path)
+
+    if cached["root"] is None:
+        return correction
+
+    return CompiledCorrection(correction.name, correction.version, cached["inputs"], cached["root"], correction)
+
+
+class CompiledCorrectionStack(object):
+    """
+    Evaluates many *corrections* with the same inputs (e.g. the sources of jet energy uncertainties)
+    at once, returning the values with one additional, last dimension for the corrections.
+    Compiled corrections whose content is a grid of constants with the same axes are stacked into
+    one value table, so that the bin search is done once per axis and the values of all of them are
+    obtained with a single gather. All other corrections are evaluated one after another.
+    """
+
+    def __init__(self, corrections: list):
+        super().__init__()
+
+        if not corrections:
+            raise ValueError("at least one correction is required")
+        input_names = {tuple(inp.name for inp in corr.inputs) for corr in corrections}
+        if len(input_names) != 1:
+            raise ValueError(f"corrections must have the same inputs, got {sorted(input_names)}")
+
+        self.corrections = list(corrections)
+        self.inputs = self.corrections[0].inputs
+
+        # groups of stacked corrections as (indices, grid, value table) and indices of all others
+        self.groups = []
+        self.unstacked = []
+        for i, corr in enumerate(self.corrections):
+            root = getattr(corr, "root", None)
+            if not isinstance(root, _Grid) or root.values is None:
+                self.unstacked.append(i)
+                continue
+            for indices, grid, _ in self.groups:
+                if grid.axes == root.axes:
+                    indices.append(i)
+                    break
+            else:
+                self.groups.append(([i], root, None))
+
+        self.groups = [
+            (np.array(indices), grid, np.stack([self.corrections[i].root.values for i in indices], axis=1))
+            for indices, grid, _ in self.groups
+        ]
+
+    def __len__(self) -> int:
+        return len(self.corrections)
+
+    def evaluate(self, *args) -> np.ndarray:
+        if len(args) != len(self.inputs):
+            raise ValueError(f"corrections expect {len(self.inputs)} inputs, got {len(args)}")
+
+        flat_args, shape = _broadcast_inputs(args, self.inputs)
+        n = int(np.prod(shape)) if shape else 1
+        idx = np.arange(n)
+
+        # single group of all corrections
+        if len(self.groups) == 1 and not self.unstacked:
+            _, grid, table = self.groups[0]
+            return table[grid.find(flat_args, idx)].reshape(shape + (len(self),))
+
+        values = np.empty((n, len(self)), dtype=np.float64)
+        for indices, grid, table in self.groups:
+            values[:, indices] = table[grid.find(flat_args, idx)]
+        for i in self.unstacked:
+            values[:, i] = np.asarray(self.corrections[i].evaluate(*args), dtype=np.float64).reshape(-1)
+
+        return values.reshape(shape + (len(self),))
+
+    __call__ = evaluate
+
+
+def derive_compiled_corrector(producer_cls: type, name: str, corrector_attr: str, get_file: Callable) -> type:
+    """
+    Derives a producer class *name* from *producer_cls*, whose setup replaces the correctionlib
+    corrector stored in the attribute *corrector_attr* with its compiled version. *get_file* is
+    called with the producer instance and the bundled external files and should return the
+    target of the correction file.
+    """
+    derived_cls = producer_cls.derive(name)
+    setup_func = producer_cls.setup_func
+
+    @derived_cls.setup
+    def setup(self, reqs: dict, inputs: dict, reader_targets) -> None:
+        if setup_func is not None:
+            setup_func(self, reqs, inputs, reader_targets)
+
+        content = get_file(self, reqs["external_files"].files).load(formatter="gzip")
+        setattr(self, corrector_attr, compile_correction(getattr(self, corrector_attr), content))
+
+    return derived_cls
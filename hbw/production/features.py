@@ -8,12 +8,12 @@ import functools
 
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
-from columnflow.columnar_util import set_ak_column, EMPTY_FLOAT
+from columnflow.columnar_util import set_ak_column
 
 from hbw.production.prepare_objects import prepare_objects
 from hbw.config.variables import add_feature_variables
 from hbw.config.dl.variables import add_dl_variables
-from hbw.util import four_vec
+from hbw.util import four_vec, sanitize_columns
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -37,9 +37,8 @@ def jj_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     events = set_ak_column_f32(events, "jj_pt", jj.pt)
     events = set_ak_column_f32(events, "deltaR_jj", deltaR_jj)
 
-    # fill none values
-    for col in self.produces:
-        events = set_ak_column_f32(events, col, ak.fill_none(events[col], EMPTY_FLOAT))
+    # fill none, nan and inf values
+    events = sanitize_columns(events, self.produces, name=self.cls_name)
     return events
 
 
@@ -62,9 +61,8 @@ def bb_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     m_bb_combined = ak.where(ak.num(events.HbbJet) > 0, events.HbbJet[:, 0].msoftdrop, bb.mass)
     events = set_ak_column_f32(events, "m_bb_combined", m_bb_combined)
 
-    # fill none values
-    for col in self.produces:
-        events = set_ak_column_f32(events, col, ak.fill_none(events[col], EMPTY_FLOAT))
+    # fill none, nan and inf values
+    events = sanitize_columns(events, self.produces, name=self.cls_name)
 
     return events
 
@@ -172,13 +170,12 @@ def dl_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     # Lepton charge
     events = set_ak_column(events, "charge", (events.Lepton.charge))
 
-    # fill none values for dl variables
+    # fill none, nan and inf values for dl variables
     dl_variable_list = [
         "m_bb", "bb_pt", "deltaR_bb", "ll_pt", "m_ll_check", "deltaR_ll", "min_dr_lljj",
         "charge", "MT", "delta_Phi", "E_miss", "m_lljjMET",
     ]
-    for var in dl_variable_list:
-        events = set_ak_column_f32(events, var, ak.fill_none(events[var], EMPTY_FLOAT))
+    events = sanitize_columns(events, dl_variable_list, name=self.cls_name)
 
     return events
 
@@ -8,124 +8,189 @@ from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column, EMPTY_FLOAT
 
+from hbw.util import njit, flat_offsets
+
 
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
 
 
+# names of the particles stored in the gen_hbw_decay column
+gen_hbw_decay_slots = ("h1", "h2", "b1", "b2", "wlep", "whad", "l", "nu", "q1", "q2", "sec1", "sec2")
+
+# validation checks of the decay record, in the order in which they are evaluated
+gen_hbw_decay_checks = (
+    "number of Higgs != 2",
+    "number of bottom quarks from Higgs decay != 2",
+    "number of Ws != 2",
+    "number of quarks from W decays is not dividable by 2",
+    "number of quarks from W decays != 2",
+    "number of leptons from W decays is not dividable by 2",
+    "number of leptons from W decays != 2",
+    "number of W decay products invalid",
+    "two ss bottoms",
+    "two ss Ws",
+    "sign-imbalance for quarks",
+    "sign-imbalance for leptons",
+    # identification of the particles via their charges and flavors
+    "no lepton from W decays",
+    "no neutrino from W decays",
+    "no down-type quark from W decays",
+    "no up-type quark from W decays",
+    "no leptonically decaying W",
+    "no hadronically decaying W",
+    "no bottom quark from Higgs decay",
+    "no bottom antiquark from Higgs decay",
+)
+
+
+@njit
+def _distinct_parent(i, pdg_id, mother):
+    # first parent with a different pdgId (same as coffea's distinctParent)
+    parent = mother[i]
+    while parent >= 0 and pdg_id[parent] == pdg_id[i]:
+        parent = mother[parent]
+    return parent
+
+
+@njit
+def _sign(pdg_id):
+    return 1 if pdg_id > 0 else -1
+
+
+@njit
+def _gen_hbw_decay_kernel(offsets, pdg_id, mother, hard):
+    n_events = len(offsets) - 1
+    indices = np.full((n_events, 12), -1, dtype=np.int64)
+    n_failed = np.zeros(20, dtype=np.int64)
+
+    for ev in range(n_events):
+        start, stop = offsets[ev], offsets[ev + 1]
+        h = np.full(2, -1, dtype=np.int64)
+        w = np.full(2, -1, dtype=np.int64)
+        nh, nb, nw, nq, nl, n_sec = 0, 0, 0, 0, 0, 0
+        sum_b, sum_w, sum_q, sum_l = 0, 0, 0, 0
+        b1, b2, lep, nu, q_d, q_u = -1, -1, -1, -1, -1, -1
+
+        for i in range(start, stop):
+            if not hard[i]:
+                continue
+            abs_id = abs(pdg_id[i])
+
+            # non-Higgs daughters of initial-state particles (not restricted to the hard process)
+            if mother[i] < 0:
+                for j in range(i, stop):
+                    if mother[j] == i and abs(pdg_id[j]) != 25:
+                        if n_sec < 2:
+                            indices[ev, 10 + n_sec] = j
+                        n_sec += 1
+
+            if abs_id == 25:
+                if nh < 2:
+                    h[nh] = i
+                nh += 1
+                continue
+
+            parent = _distinct_parent(i, pdg_id, mother)
+            parent_id = abs(pdg_id[parent]) if parent >= 0 else -1
+
+            if abs_id == 5 and parent_id == 25:
+                nb += 1
+                sum_b += _sign(pdg_id[i])
+                if pdg_id[i] > 0 and b1 < 0:
+                    b1 = i
+                elif pdg_id[i] <= 0 and b2 < 0:
+                    b2 = i
+            elif abs_id == 24 and parent_id == 25:
+                if nw < 2:
+                    w[nw] = i
+                nw += 1
+                sum_w += _sign(pdg_id[i])
+
+            if 1 <= abs_id <= 5 and parent_id == 24:
+                nq += 1
+                sum_q += _sign(pdg_id[i])
+                if abs_id % 2 == 1 and q_d < 0:
+                    q_d = i
+                elif abs_id % 2 == 0 and q_u < 0:
+                    q_u = i
+            elif 11 <= abs_id <= 16 and parent_id == 24:
+                nl += 1
+                sum_l += _sign(pdg_id[i])
+                if abs_id % 2 == 1 and lep < 0:
+                    lep = i
+                elif abs_id % 2 == 0 and nu < 0:
+                    nu = i
+
+        # validation counters
+        failed = np.array([
+            nh != 2, nb != 2, nw != 2, nq % 2 != 0, nq != 2, nl % 2 != 0, nl != 2, nq + nl != 2 * nw,
+            sum_b != 0, sum_w != 0, sum_q != 0, sum_l != 0,
+        ])
+
+        # identify the leptonically and hadronically decaying W via the charge of the lepton
+        w_lep, w_had = -1, -1
+        if lep >= 0:
+            for k in range(min(nw, 2)):
+                if _sign(pdg_id[w[k]]) == _sign(pdg_id[lep]):
+                    if w_lep < 0:
+                        w_lep = w[k]
+                elif w_had < 0:
+                    w_had = w[k]
+
+        slots = np.array([h[0], h[1], b1, b2, w_lep, w_had, lep, nu, q_d, q_u])
+        for k in range(12):
+            n_failed[k] += failed[k]
+        for k, slot in enumerate((6, 7, 8, 9, 4, 5, 2, 3)):
+            n_failed[12 + k] += slots[slot] < 0
+        indices[ev, :10] = slots
+
+    return indices, n_failed
+
+
 @producer
 def gen_hbw_decay_products(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
     Creates column 'gen_hbw_decay', which includes the most relevant particles of a HH->bbWW(qqlnu) decay.
     All sub-fields correspond to individual GenParticles with fields pt, eta, phi, mass and pdgId.
+
+    The decay tree is navigated in a single compiled pass over the flat hard-process gen particles
+    using their mother indices. All validation failures are counted and reported at once.
     """
 
     if self.dataset_inst.is_data or not self.dataset_inst.x("is_hbw", False):
         return events
 
-    # for quick checks
-    def all_or_raise(arr, msg):
-        if not ak.all(arr):
-            raise Exception(f"{msg} in {100 * ak.mean(~arr):.3f}% of cases")
-
     # TODO: for now, this only works for HH->bbWW(qqlnu), but could maybe be generalized to all HH->bbWW decays
 
-    # only consider hard process genparticles
-    gp = events.GenPart
-    gp["index"] = ak.local_index(gp, axis=1)
-    gp = gp[events.GenPart.hasFlags("isHardProcess")]
-    gp = gp[~ak.is_none(gp, axis=1)]
-    abs_id = abs(gp.pdgId)
-
-    # find initial-state particles
-    isp = gp[ak.is_none(gp.parent.pdgId, axis=1)]
-
-    # find all non-Higgs daughter particles from inital state
-    sec = ak.flatten(isp.children, axis=2)
-    sec = sec[abs(sec.pdgId) != 25]
-    sec = ak.pad_none(sec, 2)  # TODO: Not all initial particles are gluons
-    gp_ghost = ak.zip({f: EMPTY_FLOAT for f in sec.fields}, with_name="GenParticle")  # TODO: avoid union type
-    sec = ak.fill_none(sec, gp_ghost, axis=1)  # axis=1 necessary
-
-    # find hard Higgs bosons
-    h = gp[abs_id == 25]
-    nh = ak.num(h, axis=1)
-    all_or_raise(nh == 2, "number of Higgs != 2")
-
-    # bottoms from H decay
-    b = gp[abs_id == 5]
-    b = b[(abs(b.distinctParent.pdgId) == 25)]
-    b = b[~ak.is_none(b, axis=1)]
-    nb = ak.num(b, axis=1)
-    all_or_raise(nb == 2, "number of bottom quarks from Higgs decay != 2")
-
-    # Ws from H decay
-    w = gp[abs_id == 24]
-    w = w[(abs(w.distinctParent.pdgId) == 25)]
-    w = w[~ak.is_none(w, axis=1)]
-    nw = ak.num(w, axis=1)
-    all_or_raise(nw == 2, "number of Ws != 2")
-
-    # non-top quarks from W decays
-    qs = gp[(abs_id >= 1) & (abs_id <= 5)]
-    qs = qs[(abs(qs.distinctParent.pdgId) == 24)]
-    qs = qs[~ak.is_none(qs, axis=1)]
-    nqs = ak.num(qs, axis=1)
-    all_or_raise((nqs % 2) == 0, "number of quarks from W decays is not dividable by 2")
-    all_or_raise(nqs == 2, "number of quarks from W decays != 2")
-
-    # leptons from W decays
-    ls = gp[(abs_id >= 11) & (abs_id <= 16)]
-    ls = ls[(abs(ls.distinctParent.pdgId) == 24)]
-    ls = ls[~ak.is_none(ls, axis=1)]
-    nls = ak.num(ls, axis=1)
-    all_or_raise((nls % 2) == 0, "number of leptons from W decays is not dividable by 2")
-    all_or_raise(nls == 2, "number of leptons from W decays != 2")
-
-    all_or_raise(nqs + nls == 2 * nw, "number of W decay products invalid")
-
-    # check if decay product charges are valid
-    sign = lambda part: (part.pdgId > 0) * 2 - 1
-    all_or_raise(ak.sum(sign(b), axis=1) == 0, "two ss bottoms")
-    all_or_raise(ak.sum(sign(w), axis=1) == 0, "two ss Ws")
-    all_or_raise(ak.sum(sign(qs), axis=1) == 0, "sign-imbalance for quarks")
-    all_or_raise(ak.sum(sign(ls), axis=1) == 0, "sign-imbalance for leptons")
-
-    # identify decay products of W's
-    lepton = ls[abs(ls.pdgId) % 2 == 1][:, 0]
-    neutrino = ls[abs(ls.pdgId) % 2 == 0][:, 0]
-    q_dtype = qs[abs(qs.pdgId) % 2 == 1][:, 0]
-    q_utype = qs[abs(qs.pdgId) % 2 == 0][:, 0]
-
-    # identify the leptonically and hadronically decaying W
-    wlep = w[sign(w) == sign(lepton)][:, 0]
-    whad = w[sign(w) != sign(lepton)][:, 0]
-
-    # identify b1 as particle, b2 as antiparticle
-    b1 = b[sign(b) == 1][:, 0]
-    b2 = b[sign(b) == -1][:, 0]
-
-    # TODO: identify H->bb and H->WW and switch from h1/h2 to hbb/hww
-    # TODO: most fields have type='len(events) * ?genParticle' -> get rid of the '?'
-
-    hhgen = {
-        "h1": h[:, 0],
-        "h2": h[:, 1],
-        "b1": b1,
-        "b2": b2,
-        "wlep": wlep,
-        "whad": whad,
-        "l": lepton,
-        "nu": neutrino,
-        "q1": q_dtype,
-        "q2": q_utype,
-        "sec1": sec[:, 0],
-        "sec2": sec[:, 1],
+    # flat gen particle buffers with mother indices relative to the flat buffer
+    pdg_id, offsets = flat_offsets(events.GenPart.pdgId)
+    mother = ak.to_numpy(ak.flatten(events.GenPart.genPartIdxMother, axis=1)).astype(np.int64)
+    mother = np.where(mother >= 0, mother + np.repeat(offsets[:-1], np.diff(offsets)), -1)
+    hard = ak.to_numpy(ak.flatten(events.GenPart.hasFlags("isHardProcess"), axis=1))
+
+    indices, n_failed = _gen_hbw_decay_kernel(offsets, pdg_id, mother, hard)
+
+    # raise on the first failed check
+    for msg, n in zip(gen_hbw_decay_checks, n_failed):
+        if n:
+            raise Exception(f"{msg} in {100 * n / len(events):.3f}% of cases")
+
+    # gather the fields of all particles, missing secondary particles are set to EMPTY_FLOAT
+    fields = {
+        f: ak.to_numpy(ak.flatten(events.GenPart[f], axis=1)).astype(np.float32)
+        for f in ["pt", "eta", "phi", "mass", "pdgId"]
     }
-    gen_hbw_decay = ak.Array({
-        gp: {f: np.float32(hhgen[gp][f]) for f in ["pt", "eta", "phi", "mass", "pdgId"]} for gp in hhgen.keys()
-    })
-    events = set_ak_column(events, "gen_hbw_decay", gen_hbw_decay)
+    hhgen = {}
+    for k, name in enumerate(gen_hbw_decay_slots):
+        index = indices[:, k]
+        valid = index >= 0
+        hhgen[name] = {}
+        for f, values in fields.items():
+            hhgen[name][f] = np.full(len(events), EMPTY_FLOAT, dtype=np.float32)
+            hhgen[name][f][valid] = values[index[valid]]
+
+    events = set_ak_column(events, "gen_hbw_decay", ak.Array(hhgen))
 
     return events
 
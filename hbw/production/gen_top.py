@@ -10,6 +10,8 @@ from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column
 
+from hbw.util import njit, flat_offsets
+
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
 coffea = maybe_import("coffea")
@@ -18,6 +20,28 @@ maybe_import("coffea.nanoevents.methods.nanoaod")
 logger = law.logger.get_logger(__name__)
 
 
+# statusFlags bit of last copies of gen particles (see coffea's GenParticle.FLAGS)
+IS_LAST_COPY = 1 << 13
+
+
+@njit
+def _gen_parton_top_kernel(offsets, pdg_id, status_flags):
+    # number of last-copy top quarks per event and their local indices
+    n_events = len(offsets) - 1
+    counts = np.zeros(n_events, dtype=np.int64)
+    local_indices = np.empty(len(pdg_id), dtype=np.int64)
+
+    pos = 0
+    for ev in range(n_events):
+        for i in range(offsets[ev], offsets[ev + 1]):
+            if abs(pdg_id[i]) == 6 and status_flags[i] & IS_LAST_COPY:
+                local_indices[pos] = i - offsets[ev]
+                pos += 1
+                counts[ev] += 1
+
+    return counts, local_indices[:pos]
+
+
 @producer(
     uses={"GenPart.pdgId", "GenPart.statusFlags"},
     # requested GenPartonTop columns, passed to the *uses* and *produces*
@@ -32,11 +56,13 @@ def gen_parton_top(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     *produced_top_columns* can be adapted to change the columns that will be produced
     for the GenPartonTop collection.
     """
-    # find parton-level top quarks
-    abs_id = abs(events.GenPart.pdgId)
-    t = events.GenPart[abs_id == 6]
-    t = t[t.hasFlags("isLastCopy")]
-    t = t[~ak.is_none(t, axis=1)]
+    # find parton-level top quarks in a single compiled pass over the flat gen particles
+    pdg_id, offsets = flat_offsets(events.GenPart.pdgId)
+    status_flags = ak.to_numpy(ak.flatten(events.GenPart.statusFlags, axis=1))
+    counts, local_indices = _gen_parton_top_kernel(offsets, pdg_id, status_flags)
+    logger.debug(f"found != 2 parton-level top quarks in {np.sum(counts != 2)} of {len(events)} events")
+
+    t = events.GenPart[ak.unflatten(local_indices, counts)]
 
     # save the column
     events = set_ak_column(events, "GenPartonTop", t)
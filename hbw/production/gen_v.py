@@ -6,13 +6,62 @@ Producers for L1 prefiring weights.
 
 from __future__ import annotations
 
+import law
+
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import, InsertableDict, DotDict
 from columnflow.columnar_util import set_ak_column
 
+from hbw.production.compiled_corrections import compile_correction, CorrectionFile
+from hbw.util import njit, flat_offsets
+
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
+coffea = maybe_import("coffea")
+maybe_import("coffea.nanoevents.methods.vector")
+
+logger = law.logger.get_logger(__name__)
+
+
+# statusFlags bits of gen particles (see coffea's GenParticle.FLAGS)
+IS_HARD_PROCESS = 1 << 7
+IS_LAST_COPY = 1 << 13
+
+# checks of the gen particles per event, counted by gen_v_boson
+gen_v_boson_checks = (
+    "found more than one parton-level Z/W boson",
+    "number of hard process leptons != 2",
+)
+
+
+@njit
+def _gen_v_boson_kernel(offsets, pdg_id, status_flags):
+    # flat indices of the first last-copy Z/W boson and of the two hard process leptons per event,
+    # the latter only when there are exactly two of them
+    n_events = len(offsets) - 1
+    indices = np.full((n_events, 3), -1, dtype=np.int64)
+    n_failed = np.zeros(2, dtype=np.int64)
+
+    for ev in range(n_events):
+        n_v, n_lep = 0, 0
+        for i in range(offsets[ev], offsets[ev + 1]):
+            abs_id = abs(pdg_id[i])
+            if (abs_id == 23 or abs_id == 24) and status_flags[i] & IS_LAST_COPY:
+                if n_v == 0:
+                    indices[ev, 0] = i
+                n_v += 1
+            elif 11 <= abs_id <= 16 and status_flags[i] & IS_HARD_PROCESS:
+                if n_lep < 2:
+                    indices[ev, 1 + n_lep] = i
+                n_lep += 1
+
+        n_failed[0] += n_v > 1
+        if n_lep != 2:
+            n_failed[1] += 1
+            indices[ev, 1:] = -1
+
+    return indices, n_failed
 
 
 @producer(
@@ -27,52 +76,58 @@ ak = maybe_import("awkward")
 def gen_v_boson(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
     Produce gen-level Z or W bosons from `GenParticle` collection.
+
+    The parton-level boson and the hard process leptons are found in a single compiled pass over
+    the flat gen particles. When no boson is found, it is reconstructed from the pair of leptons.
+    Events with more than one boson (the first one is used) or without exactly two leptons are
+    counted and reported as a warning.
     """
-    # try to find parton-level electroweak boson
-    abs_id = abs(events.GenPart.pdgId)
-    v_boson = events.GenPart[((abs_id == 23) | (abs_id == 24))]
-    v_boson = v_boson[v_boson.hasFlags("isLastCopy")]
-    v_boson = v_boson[~ak.is_none(v_boson, axis=1)]
-    if ak.any(ak.num(v_boson) > 1):
-        raise Exception("found more than one parton-level Z/W boson")
-    v_boson = ak.firsts(v_boson)
-
-    # if not found, reconstruct pair of leptons from hard process
-    leptons = events.GenPart[((abs_id >= 11) & (abs_id <= 16))]
-    leptons = leptons[leptons.hasFlags("isHardProcess")]
-    if ak.any(ak.num(leptons) != 2):
-        raise Exception("number of hard process leptons != 2")
-    dilepton_pair = (leptons[:, 0] + leptons[:, 1])
+    pdg_id, offsets = flat_offsets(events.GenPart.pdgId)
+    status_flags = ak.to_numpy(ak.flatten(events.GenPart.statusFlags, axis=1))
+    indices, n_failed = _gen_v_boson_kernel(offsets, pdg_id, status_flags)
+
+    for msg, n in zip(gen_v_boson_checks, n_failed):
+        if n:
+            logger.warning(f"{msg} in {n} of {len(events)} events")
+
+    # events with a boson and events where it is reconstructed from the pair of leptons
+    v_index = indices[:, 0]
+    has_v = v_index >= 0
+    ll_mask = ~has_v & (indices[:, 1] >= 0)
+    l1_index, l2_index = indices[ll_mask, 1], indices[ll_mask, 2]
+
+    # flat gen particle fields
+    def flat_field(field):
+        return ak.to_numpy(ak.flatten(events.GenPart[field], axis=1))
+
+    # dilepton four-vectors
+    fields = {field: flat_field(field) for field in ("pt", "eta", "phi", "mass")}
+    l1, l2 = (
+        ak.zip(
+            {field: values[index] for field, values in fields.items()},
+            with_name="PtEtaPhiMLorentzVector",
+            behavior=coffea.nanoevents.methods.vector.behavior,
+        )
+        for index in (l1_index, l2_index)
+    )
+    dilepton_pair = l1 + l2
 
     # assign PDG ID based on lepton flavors: 23 (Z), +/- 24 (W+/W-)
-    dilepton_pdg_id = ak.zeros_like(dilepton_pair.pt)
-    dilepton_pdg_id = ak.where(
-        abs(leptons.pdgId[:, 0]) == abs(leptons.pdgId[:, 1]),
-        23,
-        dilepton_pdg_id,
+    l1_id, l2_id = pdg_id[l1_index], pdg_id[l2_index]
+    dilepton_pdg_id = np.where(
+        np.abs(l1_id) == np.abs(l2_id),
+        23.0,
+        24.0 * np.where(l1_id % 2, np.sign(l2_id), np.sign(l1_id)),
     )
-    dilepton_pdg_id = ak.where(
-        abs(leptons.pdgId[:, 0]) != abs(leptons.pdgId[:, 1]),
-        24 * ak.where(
-            leptons.pdgId[:, 0] % 2,
-            np.sign(leptons.pdgId[:, 1]),
-            np.sign(leptons.pdgId[:, 0]),
-        ),
-        dilepton_pdg_id,
-    )
-    dilepton_pair["pdgId"] = dilepton_pdg_id
-    # save the column
+
+    # save the columns (as float64, same as before), with zeros for events without boson and pair of leptons
     for field in self.produced_v_columns:
-        value = ak.where(
-            ak.is_none(v_boson),
-            getattr(dilepton_pair, field),
-            getattr(v_boson, field),
-        )
-        events = set_ak_column(
-            events,
-            f"GenVBoson.{field}",
-            ak.fill_none(value, 0.0),
-        )
+        v_values = flat_field(field) if field not in fields else fields[field]
+        ll_values = dilepton_pdg_id if field == "pdgId" else ak.to_numpy(getattr(dilepton_pair, field))
+        value = np.zeros(len(events), dtype=np.float64)
+        value[has_v] = v_values[v_index[has_v]]
+        value[ll_mask] = ll_values
+        events = set_ak_column(events, f"GenVBoson.{field}", value)
 
     return events
 
@@ -222,13 +277,12 @@ def vjets_weight_setup(self: Producer, reqs: dict, inputs: dict, reader_targets:
     # create the L1 prefiring weight evaluator
     import correctionlib
     correctionlib.highlevel.Correction.__call__ = correctionlib.highlevel.Correction.evaluate
-    correction_set = correctionlib.CorrectionSet.from_string(
-        self.get_vjets_reweighting_file(bundle.files).load(formatter="gzip").decode("utf-8"),
-    )
+    content = CorrectionFile(self.get_vjets_reweighting_file(bundle.files).load(formatter="gzip"))
+    correction_set = correctionlib.CorrectionSet.from_string(content.content.decode("utf-8"))
     corrections = self.get_vjets_reweighting_config()
     self.vjets_reweighting_evaluators = {
         obj_name: {
-            key: correction_set[correction_name]
+            key: compile_correction(correction_set[correction_name], content)
             for key, correction_name in corrections_obj.items()
         }
         for obj_name, corrections_obj in corrections.items()
@@ -0,0 +1,112 @@
+# coding: utf-8
+
+"""
+Compact storage of shifted jet columns (e.g. JEC and JER variations) as multiplicative deltas
+relative to the nominal jets. Calibrators store the shifted columns "Jet.{field}_{shift}" as
+"Jet.{field}_{shift}_delta" with the relative deviation (shifted / nominal - 1) in half precision.
+Shifted tasks read the deltas of their shift via the column alias "Jet.{field}_shift_delta"
+and reconstruct the shifted columns with :py:class:`jet_shifts_from_deltas`.
+"""
+
+from __future__ import annotations
+
+import re
+
+from columnflow.production import Producer, producer
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column, remove_ak_column, has_ak_column
+
+from hbw.util import flat_record_buffers, from_flat_buffer
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# jet fields that are varied by the jet shifts
+jet_shift_fields = ("pt", "mass")
+
+# dtype of the stored deltas
+jet_shift_delta_dtype = np.float16
+
+# pattern of shifted jet fields, e.g. "pt_jec_Total_up" or "mass_jer_down"
+_shifted_field_re = re.compile(r"^({})_((jec_.+|jer)_(up|down))$".format("|".join(jet_shift_fields)))
+
+
+def get_jet_shift_storage(config_inst) -> str:
+    """
+    Returns the storage mode of shifted jet columns of a *config_inst*, either "full" (default)
+    or "delta".
+    """
+    storage = config_inst.x("jet_shift_storage", "full")
+    if storage not in ("full", "delta"):
+        raise ValueError(f"unknown jet_shift_storage '{storage}', expected 'full' or 'delta'")
+    return storage
+
+
+def encode_jet_shift_deltas(events: ak.Array) -> ak.Array:
+    """
+    Replaces all shifted jet columns "Jet.{field}_{shift}" of *events* with their relative deviations
+    from the nominal "Jet.{field}" column, stored as "Jet.{field}_{shift}_delta". The deltas share the
+    offsets of the nominal jets.
+    """
+    shifted_fields = [f for f in events.Jet.fields if _shifted_field_re.match(f)]
+    if not shifted_fields:
+        return events
+
+    offsets, buffers = flat_record_buffers(events.Jet, [*jet_shift_fields, *shifted_fields])
+    for shifted_field in shifted_fields:
+        field = _shifted_field_re.match(shifted_field).group(1)
+        nominal, shifted = buffers[field], buffers[shifted_field]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = np.where(nominal != 0, shifted / nominal - 1, 0).astype(jet_shift_delta_dtype)
+        events = remove_ak_column(events, f"Jet.{shifted_field}")
+        events = set_ak_column(events, f"Jet.{shifted_field}_delta", from_flat_buffer(offsets, delta))
+
+    return events
+
+
+def decode_jet_shift_delta(nominal: ak.Array, delta: ak.Array) -> ak.Array:
+    """
+    Reconstructs a shifted jet column from its *nominal* values and the stored *delta*, in single
+    precision.
+    """
+    return nominal * (1 + ak.values_astype(delta, np.float32))
+
+
+@producer(
+    uses={f"Jet.{field}" for field in jet_shift_fields},
+    # produced columns are defined in the init function below
+)
+def jet_shifts_from_deltas(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Reconstructs the shifted jet columns of a task whose shift reads delta-encoded columns via
+    the aliases "Jet.{field}_shift_delta", which are removed afterwards. Only the deltas of that shift
+    are read and decoded. Events are returned unchanged when no deltas are present (e.g. for the
+    nominal shift).
+    """
+    for field in jet_shift_fields:
+        delta_column = f"Jet.{field}_shift_delta"
+        if not has_ak_column(events, delta_column):
+            continue
+
+        shifted = decode_jet_shift_delta(events.Jet[field], events.Jet[f"{field}_shift_delta"])
+        events = remove_ak_column(events, delta_column)
+        events = set_ak_column(events, f"Jet.{field}", shifted, value_type=np.float32)
+
+    return events
+
+
+@jet_shifts_from_deltas.init
+def jet_shifts_from_deltas_init(self: Producer) -> None:
+    # the reconstructed columns are only produced for shifts that read delta-encoded columns, so
+    # that they are stored by the task and used downstream (e.g. in ReduceEvents)
+    shift_inst = getattr(getattr(self, "task", None), "local_shift_inst", None)
+    if not shift_inst:
+        return
+
+    aliases = shift_inst.x("column_aliases", {})
+    self.produces |= {
+        f"Jet.{field}"
+        for field in jet_shift_fields
+        if f"Jet.{field}_shift_delta" in aliases
+    }
@@ -0,0 +1,147 @@
+# coding: utf-8
+
+"""
+Declarative registry of ML input features. Each feature (and each intermediate object or system it
+is built from, e.g. the leading b-jets or the H->bb system) is registered together with the names of
+its dependencies and the columns it uses, so that a producer only needs to compute the requested
+features and the intermediates they share.
+"""
+
+from __future__ import annotations
+
+from collections import namedtuple
+from typing import Any, Callable, Sequence
+
+from columnflow.util import maybe_import
+
+ak = maybe_import("awkward")
+
+MLFeatureNode = namedtuple("MLFeatureNode", ["name", "func", "deps", "uses", "is_feature"])
+
+
+class MLFeatureContext(object):
+    """
+    Container passed to all feature functions, giving access to the *events*, all additional
+    attributes (e.g. the calling *producer*) and, via ``ctx[name]``, to the values of all
+    dependencies that have been computed so far.
+    """
+
+    def __init__(self, events: ak.Array, **attrs):
+        super().__init__()
+
+        self.events = events
+        self.values = {}
+        for attr, value in attrs.items():
+            setattr(self, attr, value)
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.values:
+            raise KeyError(f"'{name}' has not been computed yet, is it declared as a dependency?")
+        return self.values[name]
+
+
+class MLFeatureRegistry(object):
+    """
+    Registry of ML input features and the intermediates they depend on. Features and intermediates
+    are functions receiving a :py:class:`MLFeatureContext` and are registered via :py:meth:`add`
+    with the names of their dependencies *deps* and the columns they *use*:
+
+    .. code-block:: python
+
+        sl_features = MLFeatureRegistry("sl")
+        add = sl_features.add
+
+        add("bjet", lambda ctx: ak.pad_none(ctx.events.Bjet, 2), is_feature=False, uses=four_vec("Bjet"))
+        add("hbb", lambda ctx: ctx["bjet"][:, 0] + ctx["bjet"][:, 1], deps=["bjet"], is_feature=False)
+        add("mli_mbb", lambda ctx: ctx["hbb"].mass, deps=["hbb"])
+
+        values = sl_features.evaluate(events, ["mli_mbb"])
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+
+        self.name = name
+        self.nodes = {}
+
+    def copy(self, name: str) -> MLFeatureRegistry:
+        """
+        Returns a new registry called *name* with all nodes of this registry, that can be extended
+        or overwritten independently.
+        """
+        registry = self.__class__(name)
+        registry.nodes.update(self.nodes)
+        return registry
+
+    def add(
+        self,
+        name: str,
+        func: Callable,
+        deps: Sequence[str] = (),
+        uses: Sequence[str] = (),
+        is_feature: bool = True,
+    ) -> None:
+        """
+        Registers the function *func* as feature or intermediate *name*, replacing existing ones.
+        """
+        self.nodes[name] = MLFeatureNode(name, func, tuple(deps), set(uses), is_feature)
+
+    def remove(self, *names: str) -> None:
+        for name in names:
+            self.nodes.pop(name)
+
+    @property
+    def features(self) -> list[str]:
+        return [name for name, node in self.nodes.items() if node.is_feature]
+
+    def resolve(self, features: Sequence[str] | None = None) -> list[MLFeatureNode]:
+        """
+        Returns the nodes needed to compute the *features* (all features when *None*) in an order
+        in which all dependencies are computed before they are needed.
+        """
+        if features is None:
+            features = self.features
+
+        unknown = [name for name in features if name not in self.nodes or not self.nodes[name].is_feature]
+        if unknown:
+            raise ValueError(f"unknown features in ML feature registry '{self.name}': {unknown}")
+
+        ordered, visiting = {}, set()
+
+        def visit(name: str):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise Exception(f"circular dependency of '{name}' in ML feature registry '{self.name}'")
+            if name not in self.nodes:
+                raise ValueError(f"unknown dependency '{name}' in ML feature registry '{self.name}'")
+            visiting.add(name)
+            for dep in self.nodes[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            ordered[name] = self.nodes[name]
+
+        for name in features:
+            visit(name)
+
+        return list(ordered.values())
+
+    def uses(self, features: Sequence[str] | None = None) -> set[str]:
+        """
+        Returns all columns used to compute the *features* (all features when *None*).
+        """
+        return set().union(*(node.uses for node in self.resolve(features)))
+
+    def evaluate(self, events: ak.Array, features: Sequence[str] | None = None, **attrs) -> dict[str, Any]:
+        """
+        Computes the *features* (all features when *None*) and all intermediates they depend on
+        on *events*. All *attrs* are forwarded to the :py:class:`MLFeatureContext`.
+
+        :return: Dictionary mapping the names of the features to their values.
+        """
+        nodes = self.resolve(features)
+        ctx = MLFeatureContext(events, **attrs)
+        for node in nodes:
+            ctx.values[node.name] = node.func(ctx)
+
+        return {node.name: ctx.values[node.name] for node in nodes if node.is_feature}
@@ -6,486 +6,334 @@ Column production methods related to higher-level features.
 
 from __future__ import annotations
 
-import functools
+from typing import Sequence
+
+import law
 
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
-from columnflow.columnar_util import set_ak_column
 
 from hbw.production.prepare_objects import prepare_objects
+from hbw.production.ml_feature_registry import MLFeatureRegistry
 from hbw.config.ml_variables import add_ml_variables
 from hbw.config.dl.variables import add_dl_ml_variables
 from hbw.config.sl_res.variables import add_sl_res_ml_variables
-from hbw.util import four_vec
+from hbw.util import four_vec, ColumnBatch
+from hbw.production.padded_vectors import PaddedVectors, min_delta_r
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
 
-# helper
-set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
-
 ZERO_PADDING_VALUE = -10
 
 
-@producer(
-    uses={
-        prepare_objects,
-        "HbbJet.msoftdrop",
-        "Jet.btagDeepFlavB", "Bjet.btagDeepFlavB", "Lightjet.btagDeepFlavB",
-    } | four_vec(
-        {"Electron", "Muon", "MET", "Jet", "Bjet", "Lightjet", "HbbJet", "VBFJet"},
-    ),
-    # produced columns set in the init function
-)
-def sl_ml_inputs(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
-    # add behavior and define new collections (e.g. Lepton)
-    events = self[prepare_objects](events, **kwargs)
-
-    # object padding
-    events = set_ak_column(events, "Lightjet", ak.pad_none(events.Lightjet, 2))
-    events = set_ak_column(events, "Bjet", ak.pad_none(events.Bjet, 2))
-    events = set_ak_column(events, "HbbJet", ak.pad_none(events.HbbJet, 1))
-    events = set_ak_column(events, "VBFJet", ak.pad_none(events.VBFJet, 2))
-
-    # low-level features
-    for var in ["pt", "eta", "btagDeepFlavB"]:
-        events = set_ak_column_f32(events, f"mli_b1_{var}", events.Bjet[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_b2_{var}", events.Bjet[:, 1][var])
-        events = set_ak_column_f32(events, f"mli_j1_{var}", events.Lightjet[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_j2_{var}", events.Lightjet[:, 1][var])
+def leading_objects(ctx, collection: str, k: int, fields: Sequence[str] = ()):
+    """
+    Leading *k* objects of a *collection*, either as padded numpy vectors or as padded awkward
+    arrays with coffea behavior, depending on the *padded_vectors* switch of the producer.
+    """
+    if ctx.padded_vectors:
+        return PaddedVectors.from_collection(ctx.events[collection], k, fields=fields)
+    return ak.pad_none(ctx.events[collection], k)
+
+
+def met_vector(ctx):
+    if ctx.padded_vectors:
+        return PaddedVectors.from_record(ctx.events.MET)
+    return ctx.events.MET
+
+
+#
+# single lepton features
+#
+
+sl_ml_features = MLFeatureRegistry("sl")
+add = sl_ml_features.add
+
+# leading objects
+add("bjet", lambda ctx: leading_objects(ctx, "Bjet", 2, ["btagDeepFlavB"]), is_feature=False,
+    uses=four_vec("Bjet", "btagDeepFlavB"))
+add("lightjet", lambda ctx: leading_objects(ctx, "Lightjet", 2, ["btagDeepFlavB"]), is_feature=False,
+    uses=four_vec("Lightjet", "btagDeepFlavB"))
+add("hbbjet", lambda ctx: leading_objects(ctx, "HbbJet", 1, ["msoftdrop"]), is_feature=False,
+    uses=four_vec("HbbJet", "msoftdrop"))
+add("vbfjet", lambda ctx: leading_objects(ctx, "VBFJet", 2), is_feature=False, uses=four_vec("VBFJet"))
+add("lepton", lambda ctx: leading_objects(ctx, "Lepton", 2), is_feature=False, uses=four_vec({"Electron", "Muon"}))
+add("met", met_vector, is_feature=False, uses=four_vec("MET"))
+
+# systems
+add("hbb", lambda ctx: ctx["bjet"][:, 0] + ctx["bjet"][:, 1], deps=["bjet"], is_feature=False)
+add("wjj", lambda ctx: ctx["lightjet"][:, 0] + ctx["lightjet"][:, 1], deps=["lightjet"], is_feature=False)
+# NOTE: we might want to consider neutrino reconstruction or transverse masses instead when including MET
+add("wlnu", lambda ctx: ctx["met"] + ctx["lepton"][:, 0], deps=["met", "lepton"], is_feature=False)
+add("hww", lambda ctx: ctx["wlnu"] + ctx["wjj"], deps=["wlnu", "wjj"], is_feature=False)
+add("hww_vis", lambda ctx: ctx["lepton"][:, 0] + ctx["wjj"], deps=["lepton", "wjj"], is_feature=False)
+add("hh", lambda ctx: ctx["hbb"] + ctx["hww"], deps=["hbb", "hww"], is_feature=False)
+add("hh_vis", lambda ctx: ctx["hbb"] + ctx["hww_vis"], deps=["hbb", "hww_vis"], is_feature=False)
+
+# low-level features
+for var in ["pt", "eta", "btagDeepFlavB"]:
+    for obj, coll, i in [("b1", "bjet", 0), ("b2", "bjet", 1), ("j1", "lightjet", 0), ("j2", "lightjet", 1)]:
+        add(f"mli_{obj}_{var}", lambda ctx, coll=coll, i=i, var=var: ctx[coll][:, i][var], deps=[coll])
+
+add("mli_lep_pt", lambda ctx: ctx["lepton"][:, 0].pt, deps=["lepton"])
+add("mli_lep_eta", lambda ctx: ctx["lepton"][:, 0].eta, deps=["lepton"])
+add("mli_met_pt", lambda ctx: ctx["met"].pt, deps=["met"])
+
+# H->bb FatJet
+for var in ["pt", "eta", "phi", "mass", "msoftdrop"]:
+    add(f"mli_fj_{var}", lambda ctx, var=var: ctx["hbbjet"][:, 0][var], deps=["hbbjet"])
+
+# general
+add("mli_ht", lambda ctx: ak.sum(ctx.events.Jet.pt, axis=1), uses={"Jet.pt"})
+add("mli_lt", lambda ctx: ak.sum(ctx.events.Lepton.pt, axis=1) + ctx["met"].pt, deps=["met"],
+    uses=four_vec({"Electron", "Muon"}))
+add("mli_n_jet", lambda ctx: ak.num(ctx.events.Jet.pt, axis=1), uses={"Jet.pt"})
+
+
+def mindr_jj(ctx):
+    # all possible jet pairs
+    jet_pairs = ak.combinations(ctx.events.Jet, 2)
+    dr = jet_pairs[:, :, "0"].delta_r(jet_pairs[:, :, "1"])
+    return ak.min(dr, axis=1)
 
-    events = set_ak_column_f32(events, "mli_lep_pt", events.Lepton[:, 0].pt)
-    events = set_ak_column_f32(events, "mli_lep_eta", events.Lepton[:, 0].eta)
-    events = set_ak_column_f32(events, "mli_met_pt", events.MET.pt)
 
-    # H->bb FatJet
-    for var in ["pt", "eta", "phi", "mass", "msoftdrop"]:
-        events = set_ak_column_f32(events, f"mli_fj_{var}", events.HbbJet[:, 0][var])
+add("mli_mindr_jj", mindr_jj, uses=four_vec("Jet"))
 
-    # general
-    events = set_ak_column_f32(events, "mli_ht", ak.sum(events.Jet.pt, axis=1))
-    events = set_ak_column_f32(events, "mli_lt", ak.sum(events.Lepton.pt, axis=1) + events.MET.pt)
-    events = set_ak_column_f32(events, "mli_n_jet", ak.num(events.Jet.pt, axis=1))
+# vbf jet pair features
+add("mli_vbf_deta", lambda ctx: abs(ctx["vbfjet"][:, 0].eta - ctx["vbfjet"][:, 1].eta), deps=["vbfjet"])
+add("mli_vbf_invmass", lambda ctx: (ctx["vbfjet"][:, 0] + ctx["vbfjet"][:, 1]).mass, deps=["vbfjet"])
+add("mli_vbf_tag", lambda ctx: ak.sum(ctx.events.VBFJet.pt > 0, axis=1) >= 2, uses={"VBFJet.pt"})
 
-    # all possible jet pairs
-    jet_pairs = ak.combinations(events.Jet, 2)
-    dr = jet_pairs[:, :, "0"].delta_r(jet_pairs[:, :, "1"])
-    events = set_ak_column_f32(events, "mli_mindr_jj", ak.min(dr, axis=1))
-
-    # vbf jet pair features
-    events = set_ak_column_f32(events, "mli_vbf_deta", abs(events.VBFJet[:, 0].eta - events.VBFJet[:, 1].eta))
-    events = set_ak_column_f32(events, "mli_vbf_invmass", (events.VBFJet[:, 0] + events.VBFJet[:, 1]).mass)
-    vbf_tag = ak.sum(events.VBFJet.pt > 0, axis=1) >= 2
-    events = set_ak_column_f32(events, "mli_vbf_tag", vbf_tag)
-
-    # bjets in general
-    # TODO: generalize using selection
-    wp_med = self.config_inst.x.btag_working_points.deepjet.medium
-    events = set_ak_column_f32(events, "mli_n_deepjet", ak.num(events.Jet[events.Jet.btagDeepFlavB > wp_med], axis=1))
-    events = set_ak_column_f32(events, "mli_deepjetsum", ak.sum(events.Jet.btagDeepFlavB, axis=1))
-    events = set_ak_column_f32(events, "mli_b_deepjetsum", ak.sum(events.Bjet.btagDeepFlavB, axis=1))
-    events = set_ak_column_f32(events, "mli_l_deepjetsum", ak.sum(events.Lightjet.btagDeepFlavB, axis=1))
-
-    # hbb features
-    events = set_ak_column_f32(events, "mli_dr_bb", events.Bjet[:, 0].delta_r(events.Bjet[:, 1]))
-    events = set_ak_column_f32(events, "mli_dphi_bb", abs(events.Bjet[:, 0].delta_phi(events.Bjet[:, 1])))
-
-    hbb = events.Bjet[:, 0] + events.Bjet[:, 1]
-    events = set_ak_column_f32(events, "mli_mbb", hbb.mass)
-
-    # wjj features
-    events = set_ak_column_f32(events, "mli_dr_jj", events.Lightjet[:, 0].delta_r(events.Lightjet[:, 1]))
-    events = set_ak_column_f32(events, "mli_dphi_jj", abs(events.Lightjet[:, 0].delta_phi(events.Lightjet[:, 1])))
-
-    wjj = events.Lightjet[:, 0] + events.Lightjet[:, 1]
-    events = set_ak_column_f32(events, "mli_mjj", wjj.mass)
-
-    # wlnu features
-    # NOTE: we might want to consider neutrino reconstruction or transverse masses instead when including MET
-    wlnu = events.MET + events.Lepton[:, 0]
-    events = set_ak_column_f32(events, "mli_mlnu", wlnu.mass)
-    events = set_ak_column_f32(events, "mli_dphi_lnu", abs(events.Lepton[:, 0].delta_phi(events.MET)))
-    events = set_ak_column_f32(events, "mli_dphi_wl", abs(wlnu.delta_phi(events.Lepton[:, 0])))
-
-    # angles to lepton
-    mindr_lb = ak.min(events.Bjet.delta_r(events.Lepton[:, 0]), axis=-1)
-    events = set_ak_column_f32(events, "mli_mindr_lb", mindr_lb)
-
-    mindr_lj = ak.min(events.Lightjet.delta_r(events.Lepton[:, 0]), axis=-1)
-    events = set_ak_column_f32(events, "mli_mindr_lj", mindr_lj)
-
-    # hww features
-    hww = wlnu + wjj
-    hww_vis = events.Lepton[:, 0] + wjj
-
-    events = set_ak_column_f32(events, "mli_mjjlnu", hww.mass)
-    events = set_ak_column_f32(events, "mli_mjjl", hww_vis.mass)
-
-    # hh system angles
-    events = set_ak_column_f32(events, "mli_dphi_bb_jjlnu", abs(hbb.delta_phi(hww)))
-    events = set_ak_column_f32(events, "mli_dr_bb_jjlnu", hbb.delta_r(hww))
-
-    events = set_ak_column_f32(events, "mli_dphi_bb_jjl", abs(hbb.delta_phi(hww_vis)))
-    events = set_ak_column_f32(events, "mli_dr_bb_jjl", hbb.delta_r(hww_vis))
-
-    events = set_ak_column_f32(events, "mli_dphi_bb_nu", abs(hbb.delta_phi(events.MET)))
-    events = set_ak_column_f32(events, "mli_dphi_jj_nu", abs(wjj.delta_phi(events.MET)))
-    events = set_ak_column_f32(events, "mli_dr_bb_l", hbb.delta_r(events.Lepton[:, 0]))
-    events = set_ak_column_f32(events, "mli_dr_jj_l", hbb.delta_r(events.Lepton[:, 0]))
-
-    # hh features
-    hh = hbb + hww
-    hh_vis = hbb + hww_vis
-
-    events = set_ak_column_f32(events, "mli_mbbjjlnu", hh.mass)
-    events = set_ak_column_f32(events, "mli_mbbjjl", hh_vis.mass)
-
-    s_min = (
-        2 * events.MET.pt * ((hh_vis.mass ** 2 + hh_vis.energy ** 2) ** 0.5 -
-        hh_vis.pt * np.cos(hh_vis.delta_phi(events.MET)) + hh_vis.mass ** 2)
+# bjets in general
+# TODO: generalize using selection
+add(
+    "mli_n_deepjet",
+    lambda ctx: ak.num(ctx.events.Jet[
+        ctx.events.Jet.btagDeepFlavB > ctx.producer.config_inst.x.btag_working_points.deepjet.medium
+    ], axis=1),
+    uses={"Jet.btagDeepFlavB"},
+)
+add("mli_deepjetsum", lambda ctx: ak.sum(ctx.events.Jet.btagDeepFlavB, axis=1), uses={"Jet.btagDeepFlavB"})
+add("mli_b_deepjetsum", lambda ctx: ak.sum(ctx.events.Bjet.btagDeepFlavB, axis=1), uses={"Bjet.btagDeepFlavB"})
+add("mli_l_deepjetsum", lambda ctx: ak.sum(ctx.events.Lightjet.btagDeepFlavB, axis=1),
+    uses={"Lightjet.btagDeepFlavB"})
+
+# hbb features
+add("mli_dr_bb", lambda ctx: ctx["bjet"][:, 0].delta_r(ctx["bjet"][:, 1]), deps=["bjet"])
+add("mli_dphi_bb", lambda ctx: abs(ctx["bjet"][:, 0].delta_phi(ctx["bjet"][:, 1])), deps=["bjet"])
+add("mli_mbb", lambda ctx: ctx["hbb"].mass, deps=["hbb"])
+
+# wjj features
+add("mli_dr_jj", lambda ctx: ctx["lightjet"][:, 0].delta_r(ctx["lightjet"][:, 1]), deps=["lightjet"])
+add("mli_dphi_jj", lambda ctx: abs(ctx["lightjet"][:, 0].delta_phi(ctx["lightjet"][:, 1])), deps=["lightjet"])
+add("mli_mjj", lambda ctx: ctx["wjj"].mass, deps=["wjj"])
+
+# wlnu features
+add("mli_mlnu", lambda ctx: ctx["wlnu"].mass, deps=["wlnu"])
+add("mli_dphi_lnu", lambda ctx: abs(ctx["lepton"][:, 0].delta_phi(ctx["met"])), deps=["lepton", "met"])
+add("mli_dphi_wl", lambda ctx: abs(ctx["wlnu"].delta_phi(ctx["lepton"][:, 0])), deps=["wlnu", "lepton"])
+
+# angles to lepton
+add("mli_mindr_lb", lambda ctx: min_delta_r(ctx.events.Bjet, ctx["lepton"][:, 0]), deps=["lepton"],
+    uses=four_vec("Bjet"))
+add("mli_mindr_lj", lambda ctx: min_delta_r(ctx.events.Lightjet, ctx["lepton"][:, 0]), deps=["lepton"],
+    uses=four_vec("Lightjet"))
+
+# hww features
+add("mli_mjjlnu", lambda ctx: ctx["hww"].mass, deps=["hww"])
+add("mli_mjjl", lambda ctx: ctx["hww_vis"].mass, deps=["hww_vis"])
+
+# hh system angles
+add("mli_dphi_bb_jjlnu", lambda ctx: abs(ctx["hbb"].delta_phi(ctx["hww"])), deps=["hbb", "hww"])
+add("mli_dr_bb_jjlnu", lambda ctx: ctx["hbb"].delta_r(ctx["hww"]), deps=["hbb", "hww"])
+add("mli_dphi_bb_jjl", lambda ctx: abs(ctx["hbb"].delta_phi(ctx["hww_vis"])), deps=["hbb", "hww_vis"])
+add("mli_dr_bb_jjl", lambda ctx: ctx["hbb"].delta_r(ctx["hww_vis"]), deps=["hbb", "hww_vis"])
+add("mli_dphi_bb_nu", lambda ctx: abs(ctx["hbb"].delta_phi(ctx["met"])), deps=["hbb", "met"])
+add("mli_dphi_jj_nu", lambda ctx: abs(ctx["wjj"].delta_phi(ctx["met"])), deps=["wjj", "met"])
+add("mli_dr_bb_l", lambda ctx: ctx["hbb"].delta_r(ctx["lepton"][:, 0]), deps=["hbb", "lepton"])
+add("mli_dr_jj_l", lambda ctx: ctx["hbb"].delta_r(ctx["lepton"][:, 0]), deps=["hbb", "lepton"])
+
+# hh features
+add("mli_mbbjjlnu", lambda ctx: ctx["hh"].mass, deps=["hh"])
+add("mli_mbbjjl", lambda ctx: ctx["hh_vis"].mass, deps=["hh_vis"])
+
+
+def s_min(ctx):
+    hh_vis, met = ctx["hh_vis"], ctx["met"]
+    return (
+        2 * met.pt * ((hh_vis.mass ** 2 + hh_vis.energy ** 2) ** 0.5 -
+        hh_vis.pt * np.cos(hh_vis.delta_phi(met)) + hh_vis.mass ** 2)
     ) ** 0.5
-    events = set_ak_column_f32(events, "mli_s_min", s_min)
 
-    # fill nan/none values of all produced columns
-    for col in self.ml_input_columns:
-        events = set_ak_column(events, col, ak.fill_none(ak.nan_to_none(events[col]), ZERO_PADDING_VALUE))
 
-    return events
+add("mli_s_min", s_min, deps=["hh_vis", "met"])
 
 
-@sl_ml_inputs.init
-def sl_ml_inputs_init(self: Producer) -> None:
-    # define ML input separately to self.produces
-    self.config_inst.x.ml_input_columns = self.ml_input_columns = {
-        # event features
-        "mli_ht", "mli_lt", "mli_n_jet", "mli_n_deepjet",
-        "mli_deepjetsum", "mli_b_deepjetsum", "mli_l_deepjetsum",
-        # bb system
-        "mli_dr_bb", "mli_dphi_bb", "mli_mbb",
-        # jj system
-        "mli_dr_jj", "mli_dphi_jj", "mli_mjj",
-        # lnu system
-        "mli_dphi_lnu", "mli_mlnu",
-        # angles to lepton
-        "mli_mindr_lb", "mli_mindr_lj",
-        "mli_dphi_wl",
-        # ww system
-        "mli_mjjlnu", "mli_mjjl",
-        # HH system
-        "mli_dphi_bb_jjlnu", "mli_dr_bb_jjlnu",
-        "mli_dphi_bb_jjl", "mli_dr_bb_jjl", "mli_dphi_bb_nu", "mli_dphi_jj_nu", "mli_dr_bb_l", "mli_dr_jj_l",
-        "mli_mbbjjlnu", "mli_mbbjjl", "mli_mindr_jj",
-        "mli_s_min",
-        # VBF features
-        "mli_vbf_deta", "mli_vbf_invmass", "mli_vbf_tag",
-        # low-level features
-        "mli_lep_pt", "mli_lep_eta", "mli_met_pt",
-    } | set(
-        f"mli_{obj}_{var}"
-        for obj in ["b1", "b2", "j1", "j2"]
-        for var in ["btagDeepFlavB", "pt", "eta"]
-    ) | set(
-        f"mli_{obj}_{var}"
-        for obj in ["fj"]
-        for var in ["pt", "eta", "phi", "mass", "msoftdrop"]
-    )
-    self.produces |= self.ml_input_columns
-
-    # add variable instances to config
-    add_ml_variables(self.config_inst)
+#
+# dilepton features
+#
 
+dl_ml_features = sl_ml_features.copy("dl")
+add = dl_ml_features.add
 
-@producer(
-    uses={
-        prepare_objects,
-        "HbbJet.msoftdrop",
-        "Jet.btagDeepFlavB", "Bjet.btagDeepFlavB",
-    } | four_vec(
-        {"Electron", "Muon", "MET", "Jet", "Bjet", "HbbJet", "VBFJet"},
-    ),
-    # produced columns set in the init function
+# features only used in the single lepton channel
+dl_ml_features.remove(
+    "mli_j1_pt", "mli_j1_eta", "mli_j1_btagDeepFlavB", "mli_j2_pt", "mli_j2_eta", "mli_j2_btagDeepFlavB",
+    "mli_mindr_jj", "mli_l_deepjetsum", "mli_dr_jj", "mli_dphi_jj", "mli_mjj",
+    "mli_mlnu", "mli_dphi_lnu", "mli_dphi_wl", "mli_mindr_lj", "mli_mjjlnu", "mli_mjjl",
+    "mli_dphi_bb_jjlnu", "mli_dr_bb_jjlnu", "mli_dphi_bb_jjl", "mli_dr_bb_jjl", "mli_dphi_jj_nu",
+    "mli_dr_bb_l", "mli_dr_jj_l", "mli_mbbjjlnu", "mli_mbbjjl", "mli_s_min",
 )
-def dl_ml_inputs(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
-    # add behavior and define new collections (e.g. Lepton)
-    events = self[prepare_objects](events, **kwargs)
 
-    # object padding
-    events = set_ak_column(events, "Bjet", ak.pad_none(events.Bjet, 2))
-    events = set_ak_column(events, "HbbJet", ak.pad_none(events.HbbJet, 1))
-    events = set_ak_column(events, "Lepton", ak.pad_none(events.Lepton, 2))
-    events = set_ak_column(events, "VBFJet", ak.pad_none(events.VBFJet, 2))
-
-    # low-level features
-    events = set_ak_column_f32(events, "mli_met_pt", events.MET.pt)
-    for var in ["pt", "eta", "btagDeepFlavB"]:
-        events = set_ak_column_f32(events, f"mli_b1_{var}", events.Bjet[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_b2_{var}", events.Bjet[:, 1][var])
-
-    for var in ["pt", "eta"]:
-        events = set_ak_column_f32(events, f"mli_lep_{var}", events.Lepton[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_lep2_{var}", events.Lepton[:, 1][var])
-
-    # H->bb FatJet
-    for var in ["pt", "eta", "phi", "mass", "msoftdrop"]:
-        events = set_ak_column_f32(events, f"mli_fj_{var}", events.HbbJet[:, 0][var])
-
-    # general
-    events = set_ak_column_f32(events, "mli_ht", ak.sum(events.Jet.pt, axis=1))
-    events = set_ak_column_f32(events, "mli_lt", ak.sum(events.Lepton.pt, axis=1) + events.MET.pt)
-    events = set_ak_column_f32(events, "mli_n_jet", ak.num(events.Jet.pt, axis=1))
-
-    # vbf jet pair features
-    events = set_ak_column_f32(events, "mli_vbf_deta", abs(events.VBFJet[:, 0].eta - events.VBFJet[:, 1].eta))
-    events = set_ak_column_f32(events, "mli_vbf_invmass", (events.VBFJet[:, 0] + events.VBFJet[:, 1]).mass)
-    vbf_tag = ak.sum(events.VBFJet.pt > 0, axis=1) >= 2
-    events = set_ak_column_f32(events, "mli_vbf_tag", vbf_tag)
-
-    # bjets in general
-    wp_med = self.config_inst.x.btag_working_points.deepjet.medium
-    events = set_ak_column_f32(events, "mli_n_deepjet", ak.num(events.Jet[events.Jet.btagDeepFlavB > wp_med], axis=1))
-    events = set_ak_column_f32(events, "mli_deepjetsum", ak.sum(events.Jet.btagDeepFlavB, axis=1))
-    events = set_ak_column_f32(events, "mli_b_deepjetsum", ak.sum(events.Bjet.btagDeepFlavB, axis=1))
-
-    # create ll object and ll variables
-    ll = (events.Lepton[:, 0] + events.Lepton[:, 1])
-    deltaR_ll = events.Lepton[:, 0].delta_r(events.Lepton[:, 1])
-    events = set_ak_column_f32(events, "mli_ll_pt", ll.pt)
-    events = set_ak_column_f32(events, "mli_mll", ll.mass)
-    events = set_ak_column_f32(events, "mli_mllMET", (ll + events.MET[:]).mass)
-    events = set_ak_column_f32(events, "mli_dr_ll", deltaR_ll)
-    events = set_ak_column_f32(events, "mli_dphi_ll", events.Lepton[:, 0].delta_phi(events.Lepton[:, 1]))
+# low-level features
+add("mli_lep2_pt", lambda ctx: ctx["lepton"][:, 1].pt, deps=["lepton"])
+add("mli_lep2_eta", lambda ctx: ctx["lepton"][:, 1].eta, deps=["lepton"])
 
+# create ll object and ll variables
+add("ll", lambda ctx: ctx["lepton"][:, 0] + ctx["lepton"][:, 1], deps=["lepton"], is_feature=False)
+add("mli_ll_pt", lambda ctx: ctx["ll"].pt, deps=["ll"])
+add("mli_mll", lambda ctx: ctx["ll"].mass, deps=["ll"])
+add("mli_mllMET", lambda ctx: (ctx["ll"] + ctx["met"]).mass, deps=["ll", "met"])
+add("mli_dr_ll", lambda ctx: ctx["lepton"][:, 0].delta_r(ctx["lepton"][:, 1]), deps=["lepton"])
+add("mli_dphi_ll", lambda ctx: ctx["lepton"][:, 0].delta_phi(ctx["lepton"][:, 1]), deps=["lepton"])
+
+
+def min_dr_llbb(ctx):
     # minimum deltaR between lep and jet
-    lljj_pairs = ak.cartesian([events.Lepton, events.Bjet], axis=1)
+    lljj_pairs = ak.cartesian([ctx.events.Lepton, ctx.events.Bjet], axis=1)
     lep, jet = ak.unzip(lljj_pairs)
-    min_dr_lljj = (ak.min(lep.delta_r(jet), axis=-1))
-    events = set_ak_column_f32(events, "mli_min_dr_llbb", min_dr_lljj)
+    return ak.min(lep.delta_r(jet), axis=-1)
 
-    # bb pt
-    hbb = events.Bjet[:, 0] + events.Bjet[:, 1]
-    events = set_ak_column_f32(events, "mli_mbb", hbb.pt)
-    events = set_ak_column_f32(events, "mli_dr_bb", events.Bjet[:, 0].delta_r(events.Bjet[:, 1]))
-    events = set_ak_column_f32(events, "mli_dphi_bb", abs(events.Bjet[:, 0].delta_phi(events.Bjet[:, 1])))
-    mindr_lb = ak.min(events.Bjet.delta_r(events.Lepton[:, 0]), axis=-1)
-    events = set_ak_column_f32(events, "mli_mindr_lb", mindr_lb)
 
-    events = set_ak_column_f32(events, "mli_bb_pt", hbb.pt)
-    events = set_ak_column_f32(events, "mli_mbbllMET", (ll + hbb + events.MET[:]).mass)
-    events = set_ak_column_f32(events, "mli_dr_bb_llMET", hbb.delta_r(ll + events.MET[:]))
-    events = set_ak_column_f32(events, "mli_dphi_bb_nu", abs(hbb.delta_phi(events.MET)))
-    events = set_ak_column_f32(events, "mli_dphi_bb_llMET", hbb.delta_phi(ll + events.MET[:]))
+add("mli_min_dr_llbb", min_dr_llbb, uses=four_vec({"Electron", "Muon", "Bjet"}))
 
-    # TODO: variable to reconstruct top quark resonances (e.g. mT(lepton + met + b))
+# bb pt
+add("mli_mbb", lambda ctx: ctx["hbb"].pt, deps=["hbb"])
+add("mli_bb_pt", lambda ctx: ctx["hbb"].pt, deps=["hbb"])
+add("mli_mbbllMET", lambda ctx: (ctx["ll"] + ctx["hbb"] + ctx["met"]).mass, deps=["ll", "hbb", "met"])
+add("mli_dr_bb_llMET", lambda ctx: ctx["hbb"].delta_r(ctx["ll"] + ctx["met"]), deps=["hbb", "ll", "met"])
+add("mli_dphi_bb_llMET", lambda ctx: ctx["hbb"].delta_phi(ctx["ll"] + ctx["met"]), deps=["hbb", "ll", "met"])
 
-    # fill nan/none values of all produced columns
-    for col in self.ml_columns:
-        events = set_ak_column(events, col, ak.fill_none(ak.nan_to_none(events[col]), ZERO_PADDING_VALUE))
+# TODO: variable to reconstruct top quark resonances (e.g. mT(lepton + met + b))
 
-    return events
 
+#
+# resonant single lepton features
+#
 
-@dl_ml_inputs.init
-def dl_ml_inputs_init(self: Producer) -> None:
-    # define ML input separately to self.produces
-    self.ml_columns = {
-        # event features
-        "mli_ht", "mli_lt", "mli_n_jet", "mli_n_deepjet",
-        "mli_deepjetsum", "mli_b_deepjetsum",
-        # bb system
-        "mli_dr_bb", "mli_dphi_bb", "mli_mbb", "mli_bb_pt",
-        "mli_mindr_lb",
-        # ll system
-        "mli_mll", "mli_dr_ll", "mli_dphi_ll", "mli_ll_pt",
-        "mli_min_dr_llbb",
-        "mli_dphi_bb_nu", "mli_dphi_bb_llMET", "mli_mllMET",
-        "mli_mbbllMET", "mli_dr_bb_llMET",
-        # VBF features
-        "mli_vbf_deta", "mli_vbf_invmass", "mli_vbf_tag",
-        # low-level features
-        "mli_met_pt",
-    } | set(
-        f"mli_{obj}_{var}"
-        for obj in ["b1", "b2"]
-        for var in ["pt", "eta", "btagDeepFlavB"]
-    ) | set(
-        f"mli_{obj}_{var}"
-        for obj in ["lep", "lep2"]
-        for var in ["pt", "eta"]
-    ) | set(
-        f"mli_{obj}_{var}"
-        for obj in ["fj"]
-        for var in ["pt", "eta", "phi", "mass", "msoftdrop"]
-    )
-    self.produces |= self.ml_columns
+sl_res_ml_features = sl_ml_features.copy("sl_res")
+add = sl_res_ml_features.add
 
-    # add variable instances to config
-    add_dl_ml_variables(self.config_inst)
+# features only used in the non-resonant single lepton channel
+sl_res_ml_features.remove(
+    "mli_b1_btagDeepFlavB", "mli_b2_btagDeepFlavB", "mli_j1_btagDeepFlavB", "mli_j2_btagDeepFlavB",
+    "mli_lt", "mli_mindr_jj", "mli_dphi_wl",
+)
+
+# low-level features
+add("mli_met_eta", lambda ctx: ctx["met"].eta, deps=["met"])
+
+# momenta and directions of all systems
+for system, name in [("hbb", "bb"), ("wjj", "jj"), ("wlnu", "lnu"), ("hww", "jjlnu"), ("hww_vis", "jjl")]:
+    for var in ["pt", "eta", "phi"]:
+        add(f"mli_{var}_{name}", lambda ctx, system=system, var=var: getattr(ctx[system], var), deps=[system])
+
+# NOTE: these angles refer to the MET instead of the lepton
+add("mli_dr_bb_l", lambda ctx: ctx["hbb"].delta_r(ctx["met"]), deps=["hbb", "met"])
+add("mli_dr_jj_l", lambda ctx: ctx["hbb"].delta_r(ctx["met"]), deps=["hbb", "met"])
 
+del add
+
+
+#
+# producers
+#
 
 @producer(
-    uses={
-        prepare_objects,
-        "HbbJet.msoftdrop",
-        "Jet.btagDeepFlavB", "Bjet.btagDeepFlavB", "Lightjet.btagDeepFlavB",
-    } | four_vec(
-        {"Electron", "Muon", "MET", "Jet", "Bjet", "Lightjet", "HbbJet", "VBFJet"},
-    ),
-    # produced columns set in the init function
+    uses={prepare_objects},
+    # used and produced columns set in the init function
+    # registry of all available features
+    feature_registry=None,
+    # names of the features to produce, all features of the registry when None
+    ml_features=None,
+    # function to add the variable instances to the config
+    add_variables=None,
+    # when True, the leading objects and composite systems are computed with padded numpy vectors
+    # instead of padded awkward arrays with coffea behavior
+    padded_vectors=False,
 )
-def sl_res_ml_inputs(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
-
+def ml_inputs_base(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Base producer of the ML input features defined in a :py:class:`MLFeatureRegistry`. Only the
+    requested *ml_features* and the intermediates they depend on are computed.
+    """
     # add behavior and define new collections (e.g. Lepton)
     events = self[prepare_objects](events, **kwargs)
 
-    # object padding
-    events = set_ak_column(events, "Lightjet", ak.pad_none(events.Lightjet, 2))
-    events = set_ak_column(events, "Bjet", ak.pad_none(events.Bjet, 2))
-    # events = set_ak_column(events, "FatJet", ak.pad_none(events.FatJet, 1))
-    events = set_ak_column(events, "HbbJet", ak.pad_none(events.HbbJet, 1))
-    events = set_ak_column(events, "VBFJet", ak.pad_none(events.VBFJet, 2))
-
-    # low-level features
-    # TODO: this could be more generalized
-    for var in ["pt", "eta"]:
-        events = set_ak_column_f32(events, f"mli_b1_{var}", events.Bjet[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_b2_{var}", events.Bjet[:, 1][var])
-        events = set_ak_column_f32(events, f"mli_j1_{var}", events.Lightjet[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_j2_{var}", events.Lightjet[:, 1][var])
-        events = set_ak_column_f32(events, f"mli_lep_{var}", events.Lepton[:, 0][var])
-        events = set_ak_column_f32(events, f"mli_met_{var}", events.MET[var])
-
-    # H->bb FatJet
-    for var in ["pt", "eta", "phi", "mass", "msoftdrop"]:
-        events = set_ak_column_f32(events, f"mli_fj_{var}", events.HbbJet[:, 0][var])
-
-    # jets in general
-    events = set_ak_column_f32(events, "mli_ht", ak.sum(events.Jet.pt, axis=1))
-    events = set_ak_column_f32(events, "mli_n_jet", ak.num(events.Jet.pt, axis=1))
-
-    # all possible jet pairs
-    jet_pairs = ak.combinations(events.Jet, 2)
-    dr = jet_pairs[:, :, "0"].delta_r(jet_pairs[:, :, "1"])
-    events = set_ak_column_f32(events, "mindr_jj", ak.min(dr, axis=1))
-
-    # vbf jet pair features
-    events = set_ak_column_f32(events, "mli_vbf_deta", abs(events.VBFJet[:, 0].eta - events.VBFJet[:, 1].eta))
-    events = set_ak_column_f32(events, "mli_vbf_invmass", (events.VBFJet[:, 0] + events.VBFJet[:, 1]).mass)
-    vbf_tag = ak.sum(events.VBFJet.pt > 0, axis=1) >= 2
-    events = set_ak_column_f32(events, "mli_vbf_tag", vbf_tag)
-
-    # bjets in general
-    wp_med = self.config_inst.x.btag_working_points.deepjet.medium
-    events = set_ak_column_f32(events, "mli_n_deepjet", ak.num(events.Jet[events.Jet.btagDeepFlavB > wp_med], axis=1))
-    events = set_ak_column_f32(events, "mli_deepjetsum", ak.sum(events.Jet.btagDeepFlavB, axis=1))
-    events = set_ak_column_f32(events, "mli_b_deepjetsum", ak.sum(events.Bjet.btagDeepFlavB, axis=1))
-    events = set_ak_column_f32(events, "mli_l_deepjetsum", ak.sum(events.Lightjet.btagDeepFlavB, axis=1))
-
-    # hbb features
-    events = set_ak_column_f32(events, "mli_dr_bb", events.Bjet[:, 0].delta_r(events.Bjet[:, 1]))
-    events = set_ak_column_f32(events, "mli_dphi_bb", abs(events.Bjet[:, 0].delta_phi(events.Bjet[:, 1])))
-
-    hbb = events.Bjet[:, 0] + events.Bjet[:, 1]
-    events = set_ak_column_f32(events, "mli_mbb", hbb.mass)
-    events = set_ak_column_f32(events, "mli_pt_bb", hbb.pt)
-    events = set_ak_column_f32(events, "mli_eta_bb", hbb.eta)
-    events = set_ak_column_f32(events, "mli_phi_bb", hbb.phi)
-
-    mindr_lb = ak.min(events.Bjet.delta_r(events.Lepton[:, 0]), axis=-1)
-    events = set_ak_column_f32(events, "mli_mindr_lb", mindr_lb)
-
-    # wjj features
-    events = set_ak_column_f32(events, "mli_dr_jj", events.Lightjet[:, 0].delta_r(events.Lightjet[:, 1]))
-    events = set_ak_column_f32(events, "mli_dphi_jj", abs(events.Lightjet[:, 0].delta_phi(events.Lightjet[:, 1])))
-
-    wjj = events.Lightjet[:, 0] + events.Lightjet[:, 1]
-    events = set_ak_column_f32(events, "mli_mjj", wjj.mass)
-    events = set_ak_column_f32(events, "mli_pt_jj", wjj.pt)
-    events = set_ak_column_f32(events, "mli_eta_jj", wjj.eta)
-    events = set_ak_column_f32(events, "mli_phi_jj", wjj.phi)
-
-    mindr_lj = ak.min(events.Lightjet.delta_r(events.Lepton[:, 0]), axis=-1)
-    events = set_ak_column_f32(events, "mli_mindr_lj", mindr_lj)
-
-    # wlnu features
-    wlnu = events.MET + events.Lepton[:, 0]
-    events = set_ak_column_f32(events, "mli_dphi_lnu", abs(events.Lepton[:, 0].delta_phi(events.MET)))
-    # NOTE: this column can be set to nan value
-    events = set_ak_column_f32(events, "mli_mlnu", wlnu.mass)
-    events = set_ak_column_f32(events, "mli_pt_lnu", wlnu.pt)
-    events = set_ak_column_f32(events, "mli_eta_lnu", wlnu.eta)
-    events = set_ak_column_f32(events, "mli_phi_lnu", wlnu.phi)
-
-    # hww features
-    hww = wlnu + wjj
-    hww_vis = events.Lepton[:, 0] + wjj
-
-    events = set_ak_column_f32(events, "mli_mjjlnu", hww.mass)
-    events = set_ak_column_f32(events, "mli_pt_jjlnu", hww.pt)
-    events = set_ak_column_f32(events, "mli_phi_jjlnu", hww.phi)
-    events = set_ak_column_f32(events, "mli_eta_jjlnu", hww.eta)
-    events = set_ak_column_f32(events, "mli_mjjl", hww_vis.mass)
-    events = set_ak_column_f32(events, "mli_pt_jjl", hww_vis.pt)
-    events = set_ak_column_f32(events, "mli_eta_jjl", hww_vis.eta)
-    events = set_ak_column_f32(events, "mli_phi_jjl", hww_vis.phi)
-
-    # angles
-    events = set_ak_column_f32(events, "mli_dphi_bb_jjlnu", abs(hbb.delta_phi(hww)))
-    events = set_ak_column_f32(events, "mli_dr_bb_jjlnu", hbb.delta_r(hww))
-
-    events = set_ak_column_f32(events, "mli_dphi_bb_jjl", abs(hbb.delta_phi(hww_vis)))
-    events = set_ak_column_f32(events, "mli_dr_bb_jjl", hbb.delta_r(hww_vis))
-
-    events = set_ak_column_f32(events, "mli_dphi_bb_nu", abs(hbb.delta_phi(events.MET)))
-    events = set_ak_column_f32(events, "mli_dphi_jj_nu", abs(wjj.delta_phi(events.MET)))
-    events = set_ak_column_f32(events, "mli_dr_bb_l", hbb.delta_r(events.MET))
-    events = set_ak_column_f32(events, "mli_dr_jj_l", hbb.delta_r(events.MET))
-
-    # hh features
-    hh = hbb + hww
-    hh_vis = hbb + hww_vis
-
-    events = set_ak_column_f32(events, "mli_mbbjjlnu", hh.mass)
-    events = set_ak_column_f32(events, "mli_mbbjjl", hh_vis.mass)
-
-    s_min = (
-        2 * events.MET.pt * ((hh_vis.mass ** 2 + hh_vis.energy ** 2) ** 0.5 -
-        hh_vis.pt * np.cos(hh_vis.delta_phi(events.MET)) + hh_vis.mass ** 2)
-    ) ** 0.5
-    events = set_ak_column_f32(events, "mli_s_min", s_min)
+    features = self.feature_registry.evaluate(
+        events,
+        self.ml_columns,
+        producer=self,
+        padded_vectors=self.padded_vectors,
+    )
 
-    # fill nan/none values of all produced columns
-    for col in self.ml_columns:
-        events = set_ak_column(events, col, ak.fill_none(ak.nan_to_none(events[col]), ZERO_PADDING_VALUE))
+    # fill nan/none values of all produced columns and attach them all at once
+    # (float64, as the filling used to promote the float32 columns)
+    mli = ColumnBatch(len(events), fill_value=ZERO_PADDING_VALUE)
+    for name in self.ml_columns:
+        mli[name] = features[name]
+    events = mli.attach(events, dtype=np.float64)
 
     return events
 
 
-@sl_res_ml_inputs.init
-def sl_res_ml_inputs_init(self: Producer) -> None:
+@ml_inputs_base.init
+def ml_inputs_base_init(self: Producer) -> None:
+    if self.feature_registry is None:
+        return
+
     # define ML input separately to self.produces
-    self.ml_columns = {
-        "mli_ht", "mli_n_jet", "mli_n_deepjet",
-        "mli_deepjetsum", "mli_b_deepjetsum", "mli_l_deepjetsum",
-        "mli_dr_bb", "mli_dphi_bb", "mli_mbb", "mli_mindr_lb", "mli_dr_jj", "mli_dphi_jj", "mli_mjj", "mli_mindr_lj",
-        "mli_dphi_lnu", "mli_mlnu", "mli_mjjlnu", "mli_mjjl", "mli_dphi_bb_jjlnu", "mli_dr_bb_jjlnu",
-        "mli_dphi_bb_jjl", "mli_dr_bb_jjl", "mli_dphi_bb_nu", "mli_dphi_jj_nu", "mli_dr_bb_l", "mli_dr_jj_l",
-        "mli_mbbjjlnu", "mli_mbbjjl", "mli_s_min",
-        "mli_vbf_deta", "mli_vbf_invmass", "mli_vbf_tag",
-        "mli_pt_jj", "mli_eta_jj", "mli_phi_jj",
-        "mli_pt_lnu", "mli_eta_lnu", "mli_phi_lnu",
-        "mli_pt_jjlnu", "mli_eta_jjlnu", "mli_phi_jjlnu",
-        "mli_pt_jjl", "mli_eta_jjl", "mli_phi_jjl",
-        "mli_pt_bb", "mli_eta_bb", "mli_phi_bb",
-
-    } | set(
-        f"mli_{obj}_{var}"
-        for obj in ["b1", "b2", "j1", "j2", "lep", "met"]
-        for var in ["pt", "eta"]
-    ) | set(
-        f"mli_{obj}_{var}"
-        for obj in ["fj"]
-        for var in ["pt", "eta", "phi", "mass", "msoftdrop"]
-    )
-    self.produces |= self.ml_columns
+    features = self.feature_registry.features if self.ml_features is None else self.ml_features
+    self.ml_columns = [name for name in self.feature_registry.features if name in features]
+    self.uses |= self.feature_registry.uses(features)
+    self.produces |= set(self.ml_columns)
 
     # add variable instances to config
-    add_sl_res_ml_variables(self.config_inst)
+    if self.add_variables:
+        self.add_variables(self.config_inst)
+
+
+sl_ml_inputs = ml_inputs_base.derive("sl_ml_inputs", cls_dict={
+    "feature_registry": sl_ml_features,
+    "add_variables": staticmethod(add_ml_variables),
+})
+dl_ml_inputs = ml_inputs_base.derive("dl_ml_inputs", cls_dict={
+    "feature_registry": dl_ml_features,
+    "add_variables": staticmethod(add_dl_ml_variables),
+})
+sl_res_ml_inputs = ml_inputs_base.derive("sl_res_ml_inputs", cls_dict={
+    "feature_registry": sl_res_ml_features,
+    "add_variables": staticmethod(add_sl_res_ml_variables),
+})
+
+# variants using the padded numpy vector backend
+sl_ml_inputs_padded = sl_ml_inputs.derive("sl_ml_inputs_padded", cls_dict={"padded_vectors": True})
+dl_ml_inputs_padded = dl_ml_inputs.derive("dl_ml_inputs_padded", cls_dict={"padded_vectors": True})
+sl_res_ml_inputs_padded = sl_res_ml_inputs.derive("sl_res_ml_inputs_padded", cls_dict={"padded_vectors": True})
+
+
+def pruned_ml_inputs(producer_name: str, features: Sequence[str]) -> type[Producer]:
+    """
+    Returns a variant of the ML inputs producer *producer_name* that only computes and stores the
+    given *features* (e.g. the *input_features* of an ML model) and the intermediates they depend
+    on. The variant is derived once and named after the producer and a hash of the features.
+    """
+    features = sorted(set(features))
+    name = f"{producer_name}_{law.util.create_hash(features)}"
+    if Producer.has_cls(name):
+        return Producer.get_cls(name)
+
+    base = Producer.get_cls(producer_name)
+    base.feature_registry.resolve(features)
+
+    return base.derive(name, cls_dict={"ml_features": features})
@@ -3,19 +3,23 @@
 Producers for Neutrino reconstruction.
 """
 
+from __future__ import annotations
+
 import functools
+import logging
 
 import law
 
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
-from columnflow.columnar_util import set_ak_column, EMPTY_FLOAT
+from columnflow.columnar_util import set_ak_column
 
 # from cmsdb.constants import m_w
 
-from hbw.util import four_vec
+from hbw.util import four_vec, sanitize_columns
 from hbw.production.prepare_objects import prepare_objects
-from hbw.config.variables import add_neutrino_variables, add_top_reco_variables
+from hbw.production.padded_vectors import leading_values
+from hbw.config.variables import add_neutrino_variables, add_neutrino_solution_variables, add_top_reco_variables
 
 
 np = maybe_import("numpy")
@@ -28,9 +32,101 @@ logger = law.logger.get_logger(__name__)
 set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
 
 
+def neutrino_pz_solutions(
+    pt_l: np.ndarray,
+    eta_l: np.ndarray,
+    phi_l: np.ndarray,
+    mass_l: np.ndarray,
+    pt_nu: np.ndarray,
+    phi_nu: np.ndarray,
+    w_mass: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Closed-form solutions of the W mass constraint for the Neutrino pz on flat numpy arrays, given
+    the lepton four-vector and the Neutrino pt and phi (i.e. MET). For complex solutions, both
+    solutions are set to the real part.
+
+    :return: Tuple of both pz solutions and a mask that is *True* for real solutions.
+    """
+    pz_l = pt_l * np.sinh(eta_l)
+    E_l = np.hypot(pt_l * np.cosh(eta_l), mass_l)
+
+    delta_phi = np.abs((phi_l - phi_nu + np.pi) % (2 * np.pi) - np.pi)
+    mu = w_mass**2 / 2 + pt_nu * pt_l * np.cos(delta_phi)
+
+    # Neutrino pz will be calculated as: pz_nu = A +- sqrt(B-C)
+    A = mu * pz_l / pt_l**2
+    B = mu**2 * pz_l**2 / pt_l**4
+    C = (E_l**2 * pt_nu**2 - mu**2) / pt_l**2
+
+    with np.errstate(invalid="ignore"):
+        real = B - C >= 0
+        sqrt_term = np.sqrt(np.where(real, B - C, 0))
+
+    return A + sqrt_term, A - sqrt_term, real
+
+
+def neutrino_sanity_checks(
+    lepton: dict[str, np.ndarray],
+    met: dict[str, np.ndarray],
+    pz_nu: tuple[np.ndarray, np.ndarray],
+    eta_nu: tuple[np.ndarray, np.ndarray],
+    real: np.ndarray,
+    w_mass: float,
+) -> None:
+    """
+    Sanity checks of the Neutrino reconstruction on flat numpy arrays, see
+    :py:func:`neutrino_reconstruction`.
+    """
+    # Neutrino four-vectors as stored (float32) and lepton four-vector
+    pt_nu = met["pt"].astype(np.float32).astype(np.float64)
+    px_l, py_l = lepton["pt"] * np.cos(lepton["phi"]), lepton["pt"] * np.sin(lepton["phi"])
+    pz_l = lepton["pt"] * np.sinh(lepton["eta"])
+    E_l = np.hypot(lepton["pt"] * np.cosh(lepton["eta"]), lepton["mass"])
+
+    for i, (_pz_nu, _eta_nu) in enumerate(zip(pz_nu, eta_nu), start=1):
+        _eta_nu = _eta_nu.astype(np.float32).astype(np.float64)
+
+        # sanity check: Neutrino pz should be the same as pz_nu within rounding errors
+        pz = pt_nu * np.sinh(_eta_nu)
+        sanity_check_1 = np.sum(np.abs(pz - _pz_nu) > np.abs(pz) / 100)
+        if sanity_check_1:
+            logger.warning(
+                "Number of events with Neutrino.pz that differs from pz_nu by more than 1 percent: "
+                f"{sanity_check_1} (solution {i})",
+            )
+
+        # sanity check: reconstructing W mass should always (if B-C>0) give the input W mass (80.4 GeV)
+        px = px_l + pt_nu * np.cos(met["phi"])
+        py = py_l + pt_nu * np.sin(met["phi"])
+        with np.errstate(invalid="ignore"):
+            w_on_shell_mass = np.sqrt(
+                (E_l + pt_nu * np.cosh(_eta_nu))**2 - px**2 - py**2 - (pz_l + pz)**2,
+            )
+        sanity_check_2 = np.sum(np.abs(np.where(real, w_on_shell_mass, w_mass) - w_mass) > 1)
+        if sanity_check_2:
+            logger.warning(
+                "Number of events with W mass from reconstructed Neutrino (real solutions only) that "
+                f"differs by more than 1 GeV from the input W mass: {sanity_check_2} (solution {i})",
+            )
+
+    # sanity check: for complex solutions, only the real part is considered -> both solutions should be identical
+    sanity_check_3 = np.sum(np.where(~real & ~np.isnan(eta_nu[0]), eta_nu[0] - eta_nu[1], 0))
+    if sanity_check_3:
+        raise Exception(
+            "When finding complex neutrino solutions, both reconstructed Neutrinos should be identical",
+        )
+
+
 @producer(
     uses=prepare_objects,
     produces=four_vec(["Neutrino", "Neutrino1", "Neutrino2"]),
+    # when True, the Neutrino is reconstructed on flat numpy arrays and only the Neutrino columns
+    # (and not both solutions) are produced
+    fast=False,
+    # fraction of events on which the sanity checks are performed in the fast mode, all events
+    # are checked when the logger is in debug mode
+    sanity_check_fraction=0.01,
 )
 def neutrino_reconstruction(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
@@ -43,6 +139,9 @@ def neutrino_reconstruction(self: Producer, events: ak.Array, **kwargs) -> ak.Ar
     # add behavior and define new collections (e.g. Lepton)
     events = self[prepare_objects](events, **kwargs)
 
+    if self.fast:
+        return fast_neutrino_reconstruction(self, events)
+
     # TODO: might be outdated, should be defined in cmsdb
     w_mass = 80.379
 
@@ -122,15 +221,80 @@ def neutrino_reconstruction(self: Producer, events: ak.Array, **kwargs) -> ak.Ar
     return events
 
 
+def fast_neutrino_reconstruction(self: Producer, events: ak.Array) -> ak.Array:
+    """
+    Fast mode of the :py:func:`neutrino_reconstruction`, that solves the W mass constraint on flat
+    numpy arrays and directly picks the solution with smaller absolute eta, without building
+    records for both solutions. The sanity checks are only performed on a sample of the events.
+    """
+    # TODO: might be outdated, should be defined in cmsdb
+    w_mass = 80.379
+
+    # get input variables (assuming that there is only one lepton)
+    lepton = {
+        var: leading_values(events.Lepton[var], 1, dtype=np.float64)[0][:, 0]
+        for var in ("pt", "eta", "phi", "mass")
+    }
+    met = {
+        var: ak.to_numpy(events.MET[var]).astype(np.float64)
+        for var in ("pt", "phi")
+    }
+
+    pz_nu_1, pz_nu_2, real = neutrino_pz_solutions(
+        lepton["pt"], lepton["eta"], lepton["phi"], lepton["mass"], met["pt"], met["phi"], w_mass,
+    )
+
+    # calculate Neutrino eta of both solutions and take the one with smaller absolute eta
+    with np.errstate(divide="ignore", invalid="ignore"):
+        eta_nu_1 = np.arcsinh(pz_nu_1 / met["pt"])
+        eta_nu_2 = np.arcsinh(pz_nu_2 / met["pt"])
+    eta_nu = np.where(np.abs(eta_nu_1) > np.abs(eta_nu_2), eta_nu_2, eta_nu_1)
+
+    # sanity checks on a sample of the events
+    fraction = 1.0 if logger.isEnabledFor(logging.DEBUG) else self.sanity_check_fraction
+    if fraction > 0:
+        sample = slice(None, None, max(1, int(round(1 / fraction))))
+        neutrino_sanity_checks(
+            {var: values[sample] for var, values in lepton.items()},
+            {var: values[sample] for var, values in met.items()},
+            (pz_nu_1[sample], pz_nu_2[sample]),
+            (eta_nu_1[sample], eta_nu_2[sample]),
+            real[sample],
+            w_mass,
+        )
+
+    # store Neutrino 4 vector components (None for events without lepton)
+    has_lepton = ~np.isnan(lepton["pt"])
+    neutrino = ak.zip(
+        {
+            "pt": ak.mask(met["pt"].astype(np.float32), has_lepton),
+            "eta": ak.mask(eta_nu.astype(np.float32), has_lepton),
+            "phi": ak.mask(met["phi"].astype(np.float32), has_lepton),
+            "mass": ak.mask(np.zeros(len(events), dtype=np.float32), has_lepton),
+        },
+        with_name="PtEtaPhiMLorentzVector",
+        behavior=events.behavior,
+    )
+
+    return set_ak_column(events, "Neutrino", neutrino)
+
+
 @neutrino_reconstruction.init
 def neutrino_reconstruction_init(self: Producer) -> None:
-    # add variable instances to config
+    # add variable instances of the produced columns to config
     add_neutrino_variables(self.config_inst)
+    if self.fast:
+        self.produces = four_vec("Neutrino")
+    else:
+        add_neutrino_solution_variables(self.config_inst)
+
+
+neutrino_reconstruction_fast = neutrino_reconstruction.derive("neutrino_reconstruction_fast", cls_dict={"fast": True})
 
 
 @producer(
-    uses={neutrino_reconstruction, prepare_objects} | four_vec("Bjet"),
-    produces={neutrino_reconstruction} | four_vec({"tlep_hyp1", "tlep_hyp2"}),
+    uses={neutrino_reconstruction_fast, prepare_objects} | four_vec("Bjet"),
+    produces={neutrino_reconstruction_fast} | four_vec({"tlep_hyp1", "tlep_hyp2"}),
 )
 def top_reconstruction(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
@@ -140,7 +304,7 @@ def top_reconstruction(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     events = self[prepare_objects](events, **kwargs)
 
     # run the neutrino reconstruction
-    events = self[neutrino_reconstruction](events, **kwargs)
+    events = self[neutrino_reconstruction_fast](events, **kwargs)
 
     # object padding (there are some boosted events that only contain one Jet)
     events = set_ak_column(events, "Bjet", ak.pad_none(events.Bjet, 2))
@@ -162,19 +326,13 @@ def top_reconstruction(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
         events = set_ak_column_f32(events, f"tlep_hyp1.{var}", getattr(tlep_hyp1, var))
         events = set_ak_column_f32(events, f"tlep_hyp2.{var}", getattr(tlep_hyp2, var))
 
-    # fill nan/none values of all produced columns
-    for route in self.produced_columns:
-        # replace nan, none, and inf values with EMPTY_FLOAT
-        col = route.apply(events)
-        col = ak.fill_none(ak.nan_to_none(route.apply(events)), EMPTY_FLOAT)
-        col = ak.where(np.isinf(col), EMPTY_FLOAT, col)
-
-        events = set_ak_column(events, route.string_column, col)
+    # replace nan, none, and inf values of all produced columns with EMPTY_FLOAT
+    events = sanitize_columns(events, self.produced_columns, name=self.cls_name)
 
     return events
 
 
-@neutrino_reconstruction.init
+@top_reconstruction.init
 def top_reconstruction_init(self: Producer) -> None:
     # add variable instances to config
     add_top_reco_variables(self.config_inst)
@@ -8,8 +8,12 @@ from __future__ import annotations
 
 from columnflow.production import Producer, producer
 from columnflow.production.cms.btag import btag_weights
-from columnflow.util import maybe_import, safe_div, InsertableDict
-from columnflow.columnar_util import set_ak_column
+from columnflow.util import maybe_import, InsertableDict
+
+from hbw.selection.stats_arrays import (
+    STATS_AXIS_PREFIX, load_stats_arrays, get_stats_array, dense_label_map, map_labels,
+)
+from hbw.util import set_ak_columns
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -23,34 +27,20 @@ ak = maybe_import("awkward")
     mc_only=True,
 )
 def normalized_btag_weights(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    # rows of the ratio tables and jet multiplicities per event, shared by all weights
+    pid_rows = map_labels(self.pid_row_map, events.process_id)
+    # jet multiplicities above the ones in the stats are mapped to the overflow column of the table
+    n_jets = np.minimum(ak.to_numpy(ak.num(events.Jet.pt, axis=1)), self.ratio_table_njet.shape[2] - 1)
 
-    for weight_name in self[btag_weights].produces:
-        if not weight_name.startswith("btag_weight"):
-            continue
-
-        # create a weight vectors starting with ones for both weight variations, i.e.,
-        # nomalization per pid and normalization per pid and jet multiplicity
-        norm_weight_per_pid = np.ones(len(events), dtype=np.float32)
-        norm_weight_per_pid_njet = np.ones(len(events), dtype=np.float32)
-
-        # fill weights with a new mask per unique process id (mostly just one)
-        for pid in self.unique_process_ids:
-            pid_mask = events.process_id == pid
-            # single value
-            norm_weight_per_pid[pid_mask] = self.ratio_per_pid[weight_name][pid]
-            # lookup table
-            n_jets = ak.num(events[pid_mask].Jet.pt, axis=1)
-            norm_weight_per_pid_njet[pid_mask] = self.ratio_per_pid_njet[weight_name][pid][n_jets]
-
-        # multiply with actual weight
-        norm_weight_per_pid = norm_weight_per_pid * events[weight_name]
-        norm_weight_per_pid_njet = norm_weight_per_pid_njet * events[weight_name]
+    columns = {}
+    for weight_name, i in self.weight_rows.items():
+        weight = ak.to_numpy(events[weight_name])
 
-        # store them
-        events = set_ak_column(events, f"normalized_{weight_name}", norm_weight_per_pid)
-        events = set_ak_column(events, f"normalized_njet_{weight_name}", norm_weight_per_pid_njet)
+        # nomalization per pid and normalization per pid and jet multiplicity, one gather each
+        columns[f"normalized_{weight_name}"] = self.ratio_table[i][pid_rows] * weight
+        columns[f"normalized_njet_{weight_name}"] = self.ratio_table_njet[i][pid_rows, n_jets] * weight
 
-    return events
+    return set_ak_columns(events, columns)
 
 
 @normalized_btag_weights.init
@@ -65,66 +55,61 @@ def normalized_btag_weights_init(self: Producer) -> None:
 
 @normalized_btag_weights.requires
 def normalized_btag_weights_requires(self: Producer, reqs: dict) -> None:
-    from columnflow.tasks.selection import MergeSelectionStats
-    reqs["selection_stats"] = MergeSelectionStats.req(
+    from hbw.tasks.selection import MergeSelectionStatsArrays
+    reqs["selection_stats"] = MergeSelectionStatsArrays.req(
         self.task,
         tree_index=0,
         branch=-1,
-        _exclude=MergeSelectionStats.exclude_params_forest_merge,
+        _exclude=MergeSelectionStatsArrays.exclude_params_forest_merge,
     )
 
 
 @normalized_btag_weights.setup
 def normalized_btag_weights_setup(self: Producer, reqs: dict, inputs: dict, reader_targets: InsertableDict) -> None:
-    # load the selection stats
-    stats = inputs["selection_stats"]["collection"][0]["stats"].load(formatter="json")
-
-    # get the unique process ids in that dataset
-    key = "sum_mc_weight_selected_no_bjet_per_process_and_njet"
-    self.unique_process_ids = list(map(int, stats[key].keys()))
-
-    # get the maximum numbers of jets
-    max_n_jets = max(map(int, sum((list(d.keys()) for d in stats[key].values()), [])))
-
-    # helper to get numerators and denominators
-    def numerator_per_pid(pid):
-        key = "sum_mc_weight_selected_no_bjet_per_process"
-        return stats[key].get(str(pid), 0.0)
-
-    def denominator_per_pid(weight_name, pid):
-        key = f"sum_mc_weight_{weight_name}_selected_no_bjet_per_process"
-        return stats[key].get(str(pid), 0.0)
-
-    def numerator_per_pid_njet(pid, n_jets):
-        key = "sum_mc_weight_selected_no_bjet_per_process_and_njet"
-        d = stats[key].get(str(pid), {})
-        return d.get(str(n_jets), 0.0)
-
-    def denominator_per_pid_njet(weight_name, pid, n_jets):
-        key = f"sum_mc_weight_{weight_name}_selected_no_bjet_per_process_and_njet"
-        d = stats[key].get(str(pid), {})
-        return d.get(str(n_jets), 0.0)
-
-    # extract the ratio per weight and pid
-    self.ratio_per_pid = {
-        weight_name: {
-            pid: safe_div(numerator_per_pid(pid), denominator_per_pid(weight_name, pid))
-            for pid in self.unique_process_ids
-        }
-        for weight_name in self[btag_weights].produces
-        if weight_name.startswith("btag_weight")
-    }
-
-    # extract the ratio per weight, pid and also the jet multiplicity, using the latter as in index
-    # for a lookup table (since it naturally starts at 0)
-    self.ratio_per_pid_njet = {
-        weight_name: {
-            pid: np.array([
-                safe_div(numerator_per_pid_njet(pid, n_jets), denominator_per_pid_njet(weight_name, pid, n_jets))
-                for n_jets in range(max_n_jets + 1)
-            ])
-            for pid in self.unique_process_ids
-        }
-        for weight_name in self[btag_weights].produces
-        if weight_name.startswith("btag_weight")
+    # load the selection stats as dense arrays
+    stats = load_stats_arrays(inputs["selection_stats"]["collection"][0]["stats"])
+
+    # get the unique process ids in that dataset and a dense map to their rows, as well as the jet
+    # multiplicities, the latter used as index of the lookup tables (since it naturally starts at 0)
+    process_ids = stats[f"{STATS_AXIS_PREFIX}process"]
+    self.unique_process_ids = list(map(int, process_ids))
+    self.pid_row_map = dense_label_map(process_ids)
+    n_jets = stats[f"{STATS_AXIS_PREFIX}njet"]
+
+    # only non-negative jet multiplicities can be used as table index
+    njet_valid = n_jets >= 0
+    n_jets = n_jets[njet_valid]
+
+    def safe_ratio(numerator, denominator):
+        return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+    # extract the ratio per weight and pid, and per weight, pid and jet multiplicity into tables,
+    # each with an additional row of ones for process ids that are not part of the stats
+    numerator = get_stats_array(stats, "sum_mc_weight_selected_no_bjet_per_process")
+    numerator_njet = get_stats_array(stats, "sum_mc_weight_selected_no_bjet_per_process_and_njet")
+    self.weight_rows = {
+        weight_name: i
+        for i, weight_name in enumerate(sorted(
+            weight_name
+            for weight_name in self[btag_weights].produces
+            if weight_name.startswith("btag_weight")
+        ))
     }
+    n_pids = len(process_ids)
+    self.ratio_table = np.ones((len(self.weight_rows), n_pids + 1), dtype=np.float32)
+    # one column per jet multiplicity up to the maximum in the stats, followed by an overflow column
+    n_njet_columns = ((n_jets.max() + 1) if len(n_jets) else 0) + 1
+    self.ratio_table_njet = np.ones((len(self.weight_rows), n_pids + 1, n_njet_columns), dtype=np.float32)
+    for weight_name, i in self.weight_rows.items():
+        self.ratio_table[i, :-1] = safe_ratio(
+            numerator,
+            get_stats_array(stats, f"sum_mc_weight_{weight_name}_selected_no_bjet_per_process"),
+        )
+
+        # jet multiplicities without entries in the stats (including the overflow) have a ratio of
+        # zero, except for the default row
+        self.ratio_table_njet[i, :-1] = 0
+        self.ratio_table_njet[i][:-1, n_jets] = safe_ratio(
+            numerator_njet,
+            get_stats_array(stats, f"sum_mc_weight_{weight_name}_selected_no_bjet_per_process_and_njet"),
+        )[:, njet_valid]
@@ -9,8 +9,12 @@ from typing import Iterable, Callable
 import law
 
 from columnflow.production import Producer, producer
-from columnflow.util import maybe_import, safe_div, InsertableDict
-from columnflow.columnar_util import set_ak_column  # , EMPTY_FLOAT
+from columnflow.util import maybe_import, InsertableDict
+
+from hbw.selection.stats_arrays import (
+    STATS_AXIS_PREFIX, load_stats_arrays, get_stats_array, dense_label_map, map_labels,
+)
+from hbw.util import set_ak_columns
 
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
@@ -52,21 +56,17 @@ def normalized_weight_factory(
         if not_reproduced := missing_weights.difference(events.fields):
             logger.info(f"Weight columns {not_reproduced} could not be reproduced")
 
-        for weight_name in self.weight_names.intersection(events.fields):
-            # create a weight vector starting with ones
-            norm_weight_per_pid = np.ones(len(events), dtype=np.float32)
-
-            # fill weights with a new mask per unique process id (mostly just one)
-            for pid in self.unique_process_ids:
-                pid_mask = events.process_id == pid
-                norm_weight_per_pid[pid_mask] = self.ratio_per_pid[weight_name][pid]
-
-            # multiply with actual weight
-            norm_weight_per_pid = norm_weight_per_pid * events[weight_name]
+        # rows of the ratio table per event, looked up once for all weights
+        pid_rows = map_labels(self.pid_row_map, events.process_id)
 
-            # store it
-            norm_weight_per_pid = ak.values_astype(norm_weight_per_pid, np.float32)
-            events = set_ak_column(events, f"normalized_{weight_name}", norm_weight_per_pid)
+        # normalized weights as one gather of the ratio per pid and a multiplication each
+        events = set_ak_columns(events, {
+            f"normalized_{weight_name}": (
+                self.ratio_table[self.weight_rows[weight_name]][pid_rows] *
+                ak.to_numpy(events[weight_name])
+            ).astype(np.float32)
+            for weight_name in sorted(self.weight_names.intersection(events.fields))
+        })
 
         return events
 
@@ -85,39 +85,32 @@ def normalized_weight_factory(
 
     @normalized_weight.requires
     def normalized_weight_requires(self: Producer, reqs: dict) -> None:
-        from columnflow.tasks.selection import MergeSelectionStats
-        reqs["selection_stats"] = MergeSelectionStats.req(
+        from hbw.tasks.selection import MergeSelectionStatsArrays
+        reqs["selection_stats"] = MergeSelectionStatsArrays.req(
             self.task,
             tree_index=0,
             branch=-1,
-            _exclude=MergeSelectionStats.exclude_params_forest_merge,
+            _exclude=MergeSelectionStatsArrays.exclude_params_forest_merge,
         )
 
     @normalized_weight.setup
     def normalized_weight_setup(self: Producer, reqs: dict, inputs: dict, reader_targets: InsertableDict) -> None:
-        # load the selection stats
-        stats = inputs["selection_stats"]["collection"][0]["stats"].load(formatter="json")
-
-        # get the unique process ids in that dataset
-        key = "sum_mc_weight_per_process"
-        self.unique_process_ids = list(map(int, stats[key].keys()))
-
-        # helper to get numerators and denominators
-        def numerator_per_pid(pid):
-            key = "sum_mc_weight_per_process"
-            return stats[key].get(str(pid), 0.0)
-
-        def denominator_per_pid(weight_name, pid):
-            key = f"sum_mc_weight_{weight_name}_per_process"
-            return stats[key].get(str(pid), 0.0)
-
-        # extract the ratio per weight and pid
-        self.ratio_per_pid = {
-            weight_name: {
-                pid: safe_div(numerator_per_pid(pid), denominator_per_pid(weight_name, pid))
-                for pid in self.unique_process_ids
-            }
-            for weight_name in self.weight_names
-        }
+        # load the selection stats as dense arrays
+        stats = load_stats_arrays(inputs["selection_stats"]["collection"][0]["stats"])
+
+        # get the unique process ids in that dataset and a dense map to their rows
+        process_ids = stats[f"{STATS_AXIS_PREFIX}process"]
+        self.unique_process_ids = list(map(int, process_ids))
+        self.pid_row_map = dense_label_map(process_ids)
+
+        # extract the ratio per weight and pid into one table, with an additional row of ones
+        # for process ids that are not part of the stats
+        numerator = get_stats_array(stats, "sum_mc_weight_per_process")
+        self.weight_rows = {weight_name: i for i, weight_name in enumerate(sorted(self.weight_names))}
+        self.ratio_table = np.ones((len(self.weight_rows), len(process_ids) + 1), dtype=np.float32)
+        for weight_name, i in self.weight_rows.items():
+            denominator = get_stats_array(stats, f"sum_mc_weight_{weight_name}_per_process")
+            ratio = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+            self.ratio_table[i, :-1] = ratio
 
     return normalized_weight
@@ -0,0 +1,243 @@
+# coding: utf-8
+
+"""
+Numpy backend for the reconstruction of composite systems from the leading objects of collections.
+The leading objects are extracted into regular (events x k) float32 arrays, padded with NaN, so
+that sums, masses and angles can be computed with plain vectorized numpy, without any jagged
+arrays or coffea behaviors involved.
+"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+from columnflow.util import maybe_import
+
+from hbw.util import flat_offsets
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def leading_values(array: ak.Array, k: int, dtype: type = np.float32) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Helper to extract the values of the leading *k* objects of a jagged *array* (e.g.
+    ``events.Jet.pt``) into a regular (events x k) array of type *dtype*, padded with NaN.
+
+    :return: Tuple of the padded values and the (events x k) validity mask.
+    """
+    content, offsets = flat_offsets(array)
+    positions = np.arange(k)
+    valid = positions < np.diff(offsets)[:, None]
+
+    values = np.full(valid.shape, np.nan, dtype=dtype)
+    values[valid] = content[(offsets[:-1, None] + positions)[valid]]
+
+    return values, valid
+
+
+class PaddedVectors(object):
+    """
+    Lorentz vectors stored as regular numpy arrays of shape (events,) or (events x k), with NaN
+    for missing objects, that mimic the parts of coffea's Lorentz vector behavior used for the
+    reconstruction of composite systems (:py:meth:`__add__`, *pt*, *eta*, *phi*, *mass*, *energy*,
+    :py:meth:`delta_r` and :py:meth:`delta_phi`). Additional per-object *fields* (e.g.
+    ``btagDeepFlavB``) can be accessed via ``vectors[field]``.
+
+    Vectors created from pt, eta, phi and mass keep these values, so that the properties of single
+    objects are returned unchanged, while those of sums are computed from the cartesian components.
+
+    .. code-block:: python
+
+        bjet = PaddedVectors.from_collection(events.Bjet, 2, fields=["btagDeepFlavB"])
+        hbb = bjet[:, 0] + bjet[:, 1]
+        mbb, dr_bb = hbb.mass, bjet[:, 0].delta_r(bjet[:, 1])
+    """
+
+    def __init__(
+        self,
+        px: np.ndarray,
+        py: np.ndarray,
+        pz: np.ndarray,
+        energy: np.ndarray,
+        fields: dict[str, np.ndarray] | None = None,
+        polar: dict[str, np.ndarray] | None = None,
+    ):
+        super().__init__()
+
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.energy = energy
+        self.fields = dict(fields or {})
+
+        # original pt, eta, phi and mass, if any
+        self._polar = dict(polar or {})
+
+    @classmethod
+    def from_ptetaphim(
+        cls,
+        pt: np.ndarray,
+        eta: np.ndarray,
+        phi: np.ndarray,
+        mass: np.ndarray,
+        fields: dict[str, np.ndarray] | None = None,
+    ) -> PaddedVectors:
+        """
+        Creates vectors from *pt*, *eta*, *phi* and *mass*, with the same conversion to cartesian
+        components as coffea's PtEtaPhiMLorentzVector.
+        """
+        return cls(
+            px=pt * np.cos(phi),
+            py=pt * np.sin(phi),
+            pz=pt * np.sinh(eta),
+            energy=np.hypot(pt * np.cosh(eta), mass),
+            fields=fields,
+            polar={"pt": pt, "eta": eta, "phi": phi, "mass": mass},
+        )
+
+    @classmethod
+    def from_collection(
+        cls,
+        collection: ak.Array,
+        k: int,
+        fields: Sequence[str] = (),
+        dtype: type = np.float32,
+    ) -> PaddedVectors:
+        """
+        Creates (events x k) vectors from the leading *k* objects of a jagged *collection* with
+        pt, eta, phi and mass fields, including all additional *fields*.
+        """
+        values = {
+            field: leading_values(collection[field], k, dtype=dtype)[0]
+            for field in ("pt", "eta", "phi", "mass", *fields)
+        }
+        return cls.from_ptetaphim(
+            values.pop("pt"), values.pop("eta"), values.pop("phi"), values.pop("mass"),
+            fields=values,
+        )
+
+    @classmethod
+    def from_record(
+        cls,
+        record: ak.Array,
+        fields: Sequence[str] = (),
+        dtype: type = np.float32,
+    ) -> PaddedVectors:
+        """
+        Creates (events,) vectors from a flat, possibly optional *record* array with one object per
+        event (e.g. ``events.MET``) that provides pt, eta, phi and mass, including all additional
+        *fields*.
+        """
+        def to_numpy(values):
+            values = ak.to_numpy(ak.values_astype(values, dtype), allow_missing=True)
+            return np.asarray(np.ma.filled(values, np.nan), dtype=dtype)
+
+        values = {
+            field: to_numpy(getattr(record, field) if field in ("pt", "eta", "phi", "mass") else record[field])
+            for field in ("pt", "eta", "phi", "mass", *fields)
+        }
+        return cls.from_ptetaphim(
+            values.pop("pt"), values.pop("eta"), values.pop("phi"), values.pop("mass"),
+            fields=values,
+        )
+
+    def __len__(self) -> int:
+        return len(self.px)
+
+    def __getitem__(self, index) -> PaddedVectors | np.ndarray:
+        # field access
+        if isinstance(index, str):
+            if index in self.fields:
+                return self.fields[index]
+            return getattr(self, index)
+
+        # selection of objects and/or events
+        return self.__class__(
+            self.px[index],
+            self.py[index],
+            self.pz[index],
+            self.energy[index],
+            fields={name: values[index] for name, values in self.fields.items()},
+            polar={name: values[index] for name, values in self._polar.items()},
+        )
+
+    def __add__(self, other: PaddedVectors) -> PaddedVectors:
+        return self.__class__(
+            self.px + other.px,
+            self.py + other.py,
+            self.pz + other.pz,
+            self.energy + other.energy,
+        )
+
+    @property
+    def valid(self) -> np.ndarray:
+        return ~np.isnan(self.energy)
+
+    @property
+    def pt(self) -> np.ndarray:
+        if "pt" in self._polar:
+            return self._polar["pt"]
+        return np.sqrt(self.px * self.px + self.py * self.py)
+
+    @property
+    def eta(self) -> np.ndarray:
+        if "eta" in self._polar:
+            return self._polar["eta"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.arcsinh(self.pz / self.pt)
+
+    @property
+    def phi(self) -> np.ndarray:
+        if "phi" in self._polar:
+            return self._polar["phi"]
+        return np.arctan2(self.py, self.px)
+
+    @property
+    def mass(self) -> np.ndarray:
+        if "mass" in self._polar:
+            return self._polar["mass"]
+        with np.errstate(invalid="ignore"):
+            return np.sqrt(
+                self.energy * self.energy - self.px * self.px - self.py * self.py - self.pz * self.pz,
+            )
+
+    def delta_phi(self, other: PaddedVectors) -> np.ndarray:
+        """
+        Difference in phi to *other* within [-pi, pi).
+        """
+        return (self.phi - other.phi + np.pi) % (2 * np.pi) - np.pi
+
+    def delta_r(self, other: PaddedVectors) -> np.ndarray:
+        """
+        Distance to *other* in the (eta, phi) plane.
+        """
+        return np.hypot(self.eta - other.eta, self.delta_phi(other))
+
+    def min_delta_r(self, collection: ak.Array) -> np.ndarray:
+        """
+        Minimum distance in the (eta, phi) plane between these (events,) vectors and all objects of
+        the jagged *collection*, NaN for events without objects or without a valid vector.
+        """
+        eta, offsets = flat_offsets(collection.eta)
+        phi = ak.to_numpy(ak.flatten(collection.phi, axis=1))
+        counts = np.diff(offsets)
+
+        dphi = (phi - np.repeat(self.phi, counts) + np.pi) % (2 * np.pi) - np.pi
+        dr = np.hypot(eta - np.repeat(self.eta, counts), dphi)
+
+        min_dr = np.full(len(counts), np.nan, dtype=dr.dtype)
+        filled = counts > 0
+        min_dr[filled] = np.minimum.reduceat(dr, offsets[:-1][filled]) if len(dr) else []
+        return min_dr
+
+
+def min_delta_r(collection: ak.Array, reference: PaddedVectors | ak.Array) -> np.ndarray | ak.Array:
+    """
+    Minimum distance in the (eta, phi) plane between all objects of the jagged *collection* and a
+    per-event *reference*, which is either given as :py:class:`PaddedVectors` or as an awkward
+    array with coffea behavior, so that it can be used with both backends.
+    """
+    if isinstance(reference, PaddedVectors):
+        return reference.min_delta_r(collection)
+    return ak.min(collection.delta_r(reference), axis=-1)
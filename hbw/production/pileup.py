@@ -4,12 +4,16 @@
 Column production methods related to pileup weights.
 """
 
+from __future__ import annotations
+
 import functools
 
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import, InsertableDict
 from columnflow.columnar_util import set_ak_column
 
+from hbw.util import set_ak_columns
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
@@ -18,40 +22,45 @@ ak = maybe_import("awkward")
 set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
 
 
+# weight columns and the corresponding systematic of the corrector
+pu_weight_columns = (
+    ("pu_weight", "nominal"),
+    ("pu_weight_minbias_xs_up", "up"),
+    ("pu_weight_minbias_xs_down", "down"),
+)
+
+
 @producer(
     uses={"Pileup.nTrueInt"},
-    produces={"pu_weight", "pu_weight_minbias_xs_up", "pu_weight_minbias_xs_down"},
+    produces={column_name for column_name, _ in pu_weight_columns},
     # only run on mc
     mc_only=True,
     # function to determine the correction file
     get_pileup_file=(lambda self, external_files: external_files.pu_sf),
+    # number of lookup indices (nTrueInt - 1) for which the weights are tabulated in the setup
+    n_pu_weight_bins=200,
 )
 def pu_weight_from_correctionlib(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
     Based on the number of primary vertices, assigns each event pileup weights using correctionlib.
+    The corrector is tabulated once in the setup, so that all weights are obtained via a single
+    lookup. Only events with indices outside of the table are evaluated with correctionlib.
     """
     # compute the indices for looking up weights
     indices = events.Pileup.nTrueInt.to_numpy().astype("int32") - 1
 
-    # map the variable names from the corrector to our columns
-    variable_map = {
-        "NumTrueInteractions": indices,
-    }
-
-    for column_name, syst in (
-        ("pu_weight", "nominal"),
-        ("pu_weight_minbias_xs_up", "up"),
-        ("pu_weight_minbias_xs_down", "down"),
-    ):
-        # get the inputs for this type of variation
-        variable_map["weights"] = syst
-        inputs = [variable_map[inp.name] for inp in self.pileup_corrector.inputs]
+    # look up all weights at once, only indices outside of the table (or for which the corrector
+    # could not be tabulated) are evaluated with the corrector
+    in_table = (indices >= 0) & (indices < self.pu_weight_table.shape[1])
+    in_table[in_table] = self.pu_weight_valid[indices[in_table]]
+    pu_weights = self.pu_weight_table[:, np.where(in_table, indices, 0)]
+    if not np.all(in_table):
+        pu_weights[:, ~in_table] = self.evaluate_pu_weights(indices[~in_table])
 
-        # evaluate and store the produced column
-        pu_weight = self.pileup_corrector.evaluate(*inputs)
-        events = set_ak_column(events, column_name, pu_weight, value_type=np.float32)
-
-    return events
+    return set_ak_columns(events, {
+        column_name: pu_weights[i]
+        for i, (column_name, _) in enumerate(pu_weight_columns)
+    })
 
 
 @pu_weight_from_correctionlib.requires
@@ -96,3 +105,33 @@ def pu_weight_from_correctionlib_setup(
     # check versions
     if self.pileup_corrector.version not in (0,):
         raise Exception(f"unsuppprted pileup corrector version {self.pileup_corrector.version}")
+
+    def evaluate_pu_weights(indices: np.ndarray) -> np.ndarray:
+        # evaluate all weights for the lookup *indices* with the corrector
+        weights = np.empty((len(pu_weight_columns), len(indices)), dtype=np.float64)
+        for i, (_, syst) in enumerate(pu_weight_columns):
+            # map the variable names from the corrector to our columns
+            variable_map = {
+                "NumTrueInteractions": indices,
+                "weights": syst,
+            }
+            inputs = [variable_map[inp.name] for inp in self.pileup_corrector.inputs]
+            weights[i] = self.pileup_corrector.evaluate(*inputs)
+        return weights
+
+    self.evaluate_pu_weights = evaluate_pu_weights
+
+    # tabulate the weights for all lookup indices, indices for which the corrector fails
+    # (e.g. due to overflow handling) are marked as invalid and evaluated per chunk instead
+    table_indices = np.arange(self.n_pu_weight_bins, dtype=np.int32)
+    self.pu_weight_valid = np.ones(len(table_indices), dtype=bool)
+    try:
+        table = evaluate_pu_weights(table_indices)
+    except Exception:
+        table = np.full((len(pu_weight_columns), len(table_indices)), np.nan)
+        for index in table_indices:
+            try:
+                table[:, index] = evaluate_pu_weights(table_indices[index:index + 1])[:, 0]
+            except Exception:
+                self.pu_weight_valid[index] = False
+    self.pu_weight_table = table.astype(np.float32)
@@ -97,6 +97,9 @@ def prepare_objects(self: Producer, events: ak.Array, results: SelectionResult =
     """
     Producer that defines objects in a convenient way.
     When used as part of `SelectEvents`, be careful since it may override the original NanoAOD columns.
+
+    Collections that are already present (e.g. when calling prepare_objects on events that were
+    prepared before) are kept as they are and not rebuilt.
     """
     # apply results if given to create new collections
     events = apply_object_results(events, results)
@@ -120,9 +123,10 @@ def prepare_objects(self: Producer, events: ak.Array, results: SelectionResult =
         lepton = ak.concatenate([events.Muon * 1, events.Electron * 1], axis=-1)
         events = set_ak_column(events, "Lepton", lepton[ak.argsort(lepton.pt, ascending=False)])
 
-    # transform MET into 4-vector
-    events["MET"] = set_ak_column(events.MET, "mass", 0)
-    events["MET"] = set_ak_column(events.MET, "eta", 0)
-    events["MET"] = ak.with_name(events["MET"], "PtEtaPhiMLorentzVector")
+    # transform MET into 4-vector, unless already done
+    if ak.parameters(events.MET).get("__record__") != "PtEtaPhiMLorentzVector":
+        events["MET"] = set_ak_column(events.MET, "mass", 0)
+        events["MET"] = set_ak_column(events.MET, "eta", 0)
+        events["MET"] = ak.with_name(events["MET"], "PtEtaPhiMLorentzVector")
 
     return events
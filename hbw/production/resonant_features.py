@@ -5,10 +5,11 @@ Column production method
 """
 
 import functools
-from columnflow.columnar_util import set_ak_column, EMPTY_FLOAT
+from columnflow.columnar_util import set_ak_column
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
-from hbw.util import four_vec
+from hbw.util import four_vec, sanitize_columns
+from hbw.production.padded_vectors import PaddedVectors
 ak = maybe_import("awkward")
 coffea = maybe_import("coffea")
 np = maybe_import("numpy")
@@ -28,6 +29,9 @@ set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
         # TODO: only store objects instead of individual columns
         # "Whadron.*", "Wlepton.*", "Higgs_WW.*", "Higgs_bb.*", "Heavy_Higgs.*",
     },
+    # when True, the systems are computed with padded numpy vectors instead of padded awkward arrays
+    # with coffea behavior, and they are not added to the events
+    padded_vectors=False,
 )
 def resonant_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
 
@@ -51,56 +55,77 @@ def resonant_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     #                                            q'
     #
 
-    # object padding
-    events = set_ak_column(events, "Jet", ak.pad_none(events.Jet, 2))
-    events = set_ak_column(events, "Bjet", ak.pad_none(events.Bjet, 2))
-    events = set_ak_column(events, "FatJet", ak.pad_none(events.FatJet, 1))
-    events = set_ak_column(events, "HbbJet", ak.pad_none(events.HbbJet, 1))
-    events = set_ak_column(events, "Lightjet", ak.pad_none(events.Lightjet, 2))
-
-    if "Whadron" not in events.fields:
-        events = set_ak_column(events, "Whadron", events.Lightjet[:, 0] + events.Lightjet[:, 1])
-    if "Wlepton" not in events.fields:
-        events = set_ak_column(events, "Wlepton", events.Lepton[:, 0] + events.MET[:])
-    if "Higgs_WW" not in events.fields:
-        events = set_ak_column(events, "Higgs_WW", events.Whadron[:] + events.Wlepton[:])
-    if "Higgs_bb" not in events.fields:
-        events = set_ak_column(events, "Higgs_bb", events.Bjet[:, 0] + events.Bjet[:, 1])
-
-    if "Heavy_Higgs" not in events.fields:
-        events = set_ak_column(events, "Heavy_Higgs", events.Higgs_WW + events.Higgs_bb)
+    if self.padded_vectors:
+        # leading objects and systems as padded numpy vectors, so no object padding is needed
+        def get_system(name, build):
+            return PaddedVectors.from_record(events[name]) if name in events.fields else build()
+
+        lightjet = PaddedVectors.from_collection(events.Lightjet, 2)
+        bjet = PaddedVectors.from_collection(events.Bjet, 2)
+        lepton = PaddedVectors.from_collection(events.Lepton, 1)
+        met = PaddedVectors.from_record(events.MET)
+
+        whadron = get_system("Whadron", lambda: lightjet[:, 0] + lightjet[:, 1])
+        wlepton = get_system("Wlepton", lambda: lepton[:, 0] + met)
+        higgs_ww = get_system("Higgs_WW", lambda: whadron + wlepton)
+        higgs_bb = get_system("Higgs_bb", lambda: bjet[:, 0] + bjet[:, 1])
+        heavy_higgs = get_system("Heavy_Higgs", lambda: higgs_ww + higgs_bb)
+    else:
+        # object padding
+        events = set_ak_column(events, "Jet", ak.pad_none(events.Jet, 2))
+        events = set_ak_column(events, "Bjet", ak.pad_none(events.Bjet, 2))
+        events = set_ak_column(events, "FatJet", ak.pad_none(events.FatJet, 1))
+        events = set_ak_column(events, "HbbJet", ak.pad_none(events.HbbJet, 1))
+        events = set_ak_column(events, "Lightjet", ak.pad_none(events.Lightjet, 2))
+
+        if "Whadron" not in events.fields:
+            events = set_ak_column(events, "Whadron", events.Lightjet[:, 0] + events.Lightjet[:, 1])
+        if "Wlepton" not in events.fields:
+            events = set_ak_column(events, "Wlepton", events.Lepton[:, 0] + events.MET[:])
+        if "Higgs_WW" not in events.fields:
+            events = set_ak_column(events, "Higgs_WW", events.Whadron[:] + events.Wlepton[:])
+        if "Higgs_bb" not in events.fields:
+            events = set_ak_column(events, "Higgs_bb", events.Bjet[:, 0] + events.Bjet[:, 1])
+
+        if "Heavy_Higgs" not in events.fields:
+            events = set_ak_column(events, "Heavy_Higgs", events.Higgs_WW + events.Higgs_bb)
+
+        whadron, wlepton, higgs_ww = events.Whadron, events.Wlepton, events.Higgs_WW
+        higgs_bb, heavy_higgs = events.Higgs_bb, events.Heavy_Higgs
+
     # variables of objects (don't forget to describe them in variables.py and features.py in produces)
     # Wlepton
-    events = set_ak_column_f32(events, "pt_Wlepton", events.Wlepton.pt)
-    events = set_ak_column_f32(events, "m_Wlepton", events.Wlepton.mass)
-    events = set_ak_column_f32(events, "phi_Wlepton", events.Wlepton.phi)
-    events = set_ak_column_f32(events, "eta_Wlepton", events.Wlepton.eta)
+    events = set_ak_column_f32(events, "pt_Wlepton", wlepton.pt)
+    events = set_ak_column_f32(events, "m_Wlepton", wlepton.mass)
+    events = set_ak_column_f32(events, "phi_Wlepton", wlepton.phi)
+    events = set_ak_column_f32(events, "eta_Wlepton", wlepton.eta)
     # Whadron
-    events = set_ak_column_f32(events, "pt_Whadron", events.Whadron.pt)
-    events = set_ak_column_f32(events, "m_Whadron", events.Whadron.mass)
-    events = set_ak_column_f32(events, "phi_Whadron", events.Whadron.phi)
-    events = set_ak_column_f32(events, "eta_Whadron", events.Whadron.eta)
+    events = set_ak_column_f32(events, "pt_Whadron", whadron.pt)
+    events = set_ak_column_f32(events, "m_Whadron", whadron.mass)
+    events = set_ak_column_f32(events, "phi_Whadron", whadron.phi)
+    events = set_ak_column_f32(events, "eta_Whadron", whadron.eta)
     # Higgs_WW
-    events = set_ak_column_f32(events, "pt_Higgs_WW", events.Higgs_WW.pt)
-    events = set_ak_column_f32(events, "m_Higgs_WW", events.Higgs_WW.mass)
-    events = set_ak_column_f32(events, "eta_Higgs_WW", events.Higgs_WW.eta)
-    events = set_ak_column_f32(events, "phi_Higgs_WW", events.Higgs_WW.phi)
+    events = set_ak_column_f32(events, "pt_Higgs_WW", higgs_ww.pt)
+    events = set_ak_column_f32(events, "m_Higgs_WW", higgs_ww.mass)
+    events = set_ak_column_f32(events, "eta_Higgs_WW", higgs_ww.eta)
+    events = set_ak_column_f32(events, "phi_Higgs_WW", higgs_ww.phi)
     # Higgs_bb
-    events = set_ak_column_f32(events, "pt_Higgs_bb", events.Higgs_bb.pt)
-    events = set_ak_column_f32(events, "m_Higgs_bb", events.Higgs_bb.mass)
-    events = set_ak_column_f32(events, "eta_Higgs_bb", events.Higgs_bb.eta)
-    events = set_ak_column_f32(events, "phi_Higgs_bb", events.Higgs_bb.phi)
+    events = set_ak_column_f32(events, "pt_Higgs_bb", higgs_bb.pt)
+    events = set_ak_column_f32(events, "m_Higgs_bb", higgs_bb.mass)
+    events = set_ak_column_f32(events, "eta_Higgs_bb", higgs_bb.eta)
+    events = set_ak_column_f32(events, "phi_Higgs_bb", higgs_bb.phi)
     # Heavy_Higgs
-    events = set_ak_column_f32(events, "pt_Heavy_Higgs", events.Heavy_Higgs.pt)
-    events = set_ak_column_f32(events, "m_Heavy_Higgs", events.Heavy_Higgs.mass)
-    events = set_ak_column_f32(events, "eta_Heavy_Higgs", events.Heavy_Higgs.eta)
-    events = set_ak_column_f32(events, "phi_Heavy_Higgs", events.Heavy_Higgs.phi)
-    for col in self.produces:
-        events = set_ak_column(events, col, ak.fill_none(ak.nan_to_none(events[col]), EMPTY_FLOAT))
+    events = set_ak_column_f32(events, "pt_Heavy_Higgs", heavy_higgs.pt)
+    events = set_ak_column_f32(events, "m_Heavy_Higgs", heavy_higgs.mass)
+    events = set_ak_column_f32(events, "eta_Heavy_Higgs", heavy_higgs.eta)
+    events = set_ak_column_f32(events, "phi_Heavy_Higgs", heavy_higgs.phi)
+    # fill none, nan and inf values
+    events = sanitize_columns(events, self.produces, name=self.cls_name)
 
     # undo object padding
-    for obj in ["Jet", "Lightjet", "Bjet", "FatJet"]:
-        events = set_ak_column(events, obj, events[obj][~ak.is_none(events[obj], axis=1)])
+    if not self.padded_vectors:
+        for obj in ["Jet", "Lightjet", "Bjet", "FatJet"]:
+            events = set_ak_column(events, obj, events[obj][~ak.is_none(events[obj], axis=1)])
     return events
 
 
@@ -4,7 +4,9 @@
 Column production methods related to generic event weights.
 """
 
-from columnflow.util import maybe_import
+import law
+
+from columnflow.util import maybe_import, InsertableDict
 from columnflow.columnar_util import set_ak_column, has_ak_column, Route
 from columnflow.selection import SelectionResult
 from columnflow.production import Producer, producer
@@ -19,37 +21,59 @@ from hbw.production.gen_top import gen_parton_top, top_pt_weight
 from hbw.production.gen_v import gen_v_boson, vjets_weight
 from hbw.production.normalized_weights import normalized_weight_factory
 from hbw.production.normalized_btag import normalized_btag_weights
-from hbw.util import has_tag
+from hbw.production.compiled_corrections import compile_correction, derive_compiled_corrector
+from hbw.selection.stats_arrays import STATS_AXIS_PREFIX, load_stats_arrays, weight_sketch_quantile
+from hbw.util import has_tag, set_ak_columns
 
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
+logger = law.logger.get_logger(__name__)
+
 
 @producer(
     produces={"event_weight"},
     mc_only=True,
+    # names of shifts for which additional event weights "event_weight_{shift}" are produced in the
+    # same pass, using the weight columns defined by the column aliases of each shift; when True,
+    # all shifts that the event weights depend on are used
+    weight_shifts=None,
 )
 def event_weight(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
-    Producer that calculates the 'final' event weight (as done in cf.CreateHistograms)
+    Producer that calculates the 'final' event weight (as done in cf.CreateHistograms), as well as
+    the event weights for all *weight_shifts*. The weight columns to multiply are resolved once per
+    dataset (on the first chunk), and all products are computed in float32 on flat buffers, with
+    the product of weight columns that are not affected by any shift being shared.
     """
-    weight = ak.Array(np.ones(len(events)))
-    if self.dataset_inst.is_mc:
-        for column in self.config_inst.x.event_weights:
-            weight = weight * Route(column).apply(events)
-        for column in self.dataset_inst.x("event_weights", []):
-            if has_ak_column(events, column):
-                weight = weight * Route(column).apply(events)
-            else:
-                self.logger.warning_once(
-                    f"missing_dataset_weight_{column}",
-                    f"weight '{column}' for dataset {self.dataset_inst.name} not found",
-                )
-
-    events = set_ak_column(events, "event_weight", weight)
-
-    return events
+    if self.weight_plan is None:
+        self.weight_plan = self.resolve_weight_plan(events)
+
+    # flat buffers of all weight columns
+    weights = {
+        column: ak.to_numpy(Route(column).apply(events))
+        for column in set().union(*self.weight_plan.values())
+    }
+
+    # product of the weight columns that are shared by all event weights
+    shared_columns = [
+        column for column in self.weight_plan["event_weight"]
+        if all(column in weight_columns for weight_columns in self.weight_plan.values())
+    ]
+    shared_weight = np.ones(len(events), dtype=np.float32)
+    for column in shared_columns:
+        np.multiply(shared_weight, weights[column], out=shared_weight)
+
+    columns = {}
+    for weight_name, weight_columns in self.weight_plan.items():
+        weight = shared_weight.copy()
+        for column in weight_columns:
+            if column not in shared_columns:
+                np.multiply(weight, weights[column], out=weight)
+        columns[weight_name] = weight
+
+    return set_ak_columns(events, columns)
 
 
 @event_weight.init
@@ -57,8 +81,57 @@ def event_weight_init(self: Producer) -> None:
     if not getattr(self, "dataset_inst", None):
         return
 
-    self.uses |= set(self.config_inst.x.event_weights.keys())
-    self.uses |= set(self.dataset_inst.x("event_weights", {}).keys())
+    config_weights = self.config_inst.x("event_weights", {})
+    dataset_weights = self.dataset_inst.x("event_weights", {})
+
+    # resolve the weight shifts and their column aliases
+    weight_shifts = self.weight_shifts or []
+    if weight_shifts is True:
+        weight_shifts = sorted(
+            shift_inst.name
+            for shift_insts in (*config_weights.values(), *dataset_weights.values())
+            for shift_inst in shift_insts
+        )
+    self.weight_column_aliases = {
+        "event_weight": {},
+        **{
+            f"event_weight_{shift}": self.config_inst.get_shift(shift).x("column_aliases", {})
+            for shift in weight_shifts
+        },
+    }
+
+    self.uses |= {
+        aliases.get(column, column)
+        for aliases in self.weight_column_aliases.values()
+        for column in (*config_weights.keys(), *dataset_weights.keys())
+    }
+    self.produces |= set(self.weight_column_aliases.keys())
+
+    # the plan of weight columns per event weight, resolved on the first chunk
+    self.weight_plan = None
+
+    def resolve_weight_plan(events: ak.Array) -> dict[str, list[str]]:
+        # all config weights are required, dataset weights are skipped when missing
+        plan = {}
+        missing_columns = set()
+        for weight_name, aliases in self.weight_column_aliases.items():
+            plan[weight_name] = [aliases.get(column, column) for column in config_weights.keys()]
+            for column in map(lambda column: aliases.get(column, column), dataset_weights.keys()):
+                if has_ak_column(events, column):
+                    plan[weight_name].append(column)
+                else:
+                    missing_columns.add(column)
+
+        for column in sorted(missing_columns):
+            logger.warning(f"weight '{column}' for dataset {self.dataset_inst.name} not found")
+
+        return plan
+
+    self.resolve_weight_plan = resolve_weight_plan
+
+
+# event weights for all shifts that the event weights depend on
+event_weight_shifts = event_weight.derive("event_weight_shifts", cls_dict={"weight_shifts": True})
 
 
 # copy of the btag_weights setup, removing the version check
@@ -75,16 +148,36 @@ def btag_weights_setup(
     # create the btag sf corrector
     import correctionlib
     correctionlib.highlevel.Correction.__call__ = correctionlib.highlevel.Correction.evaluate
-    correction_set = correctionlib.CorrectionSet.from_string(
-        self.get_btag_file(bundle.files).load(formatter="gzip").decode("utf-8"),
-    )
+    content = self.get_btag_file(bundle.files).load(formatter="gzip")
+    correction_set = correctionlib.CorrectionSet.from_string(content.decode("utf-8"))
     corrector_name = self.get_btag_config()[0]
-    self.btag_sf_corrector = correction_set[corrector_name]
+    self.btag_sf_corrector = compile_correction(correction_set[corrector_name], content)
+
+
+# lepton and pileup scale factors evaluated with compiled correctors
+hbw_electron_weights = derive_compiled_corrector(
+    electron_weights,
+    "hbw_electron_weights",
+    "electron_sf_corrector",
+    lambda self, files: self.get_electron_file(files),
+)
+hbw_muon_weights = derive_compiled_corrector(
+    muon_weights,
+    "hbw_muon_weights",
+    "muon_sf_corrector",
+    lambda self, files: self.get_muon_file(files),
+)
+hbw_pu_weight = derive_compiled_corrector(
+    pu_weight,
+    "hbw_pu_weight",
+    "pileup_corrector",
+    lambda self, files: self.get_pileup_file(files),
+)
 
 
 @producer(
-    uses={gen_parton_top, gen_v_boson, pu_weight},
-    produces={gen_parton_top, gen_v_boson, pu_weight},
+    uses={gen_parton_top, gen_v_boson, hbw_pu_weight},
+    produces={gen_parton_top, gen_v_boson, hbw_pu_weight},
     mc_only=True,
 )
 def event_weights_to_normalize(self: Producer, events: ak.Array, results: SelectionResult, **kwargs) -> ak.Array:
@@ -102,7 +195,7 @@ def event_weights_to_normalize(self: Producer, events: ak.Array, results: Select
         events = self[gen_v_boson](events, **kwargs)
 
     # compute pu weights
-    events = self[pu_weight](events, **kwargs)
+    events = self[hbw_pu_weight](events, **kwargs)
 
     if not has_tag("skip_btag_weights", self.config_inst, self.dataset_inst, operator=any):
         # compute btag SF weights (for renormalization tasks)
@@ -158,7 +251,7 @@ normalized_pdf_weights = normalized_weight_factory(
 
 normalized_pu_weights = normalized_weight_factory(
     producer_name="normalized_pu_weights",
-    weight_producers={pu_weight},
+    weight_producers={hbw_pu_weight},
 )
 
 
@@ -202,9 +295,9 @@ def event_weights(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
 
     # compute electron and muon SF weights
     if not has_tag("skip_electron_weights", self.config_inst, self.dataset_inst, operator=any):
-        events = self[electron_weights](events, **kwargs)
+        events = self[hbw_electron_weights](events, **kwargs)
     if not has_tag("skip_muon_weights", self.config_inst, self.dataset_inst, operator=any):
-        events = self[muon_weights](events, **kwargs)
+        events = self[hbw_muon_weights](events, **kwargs)
 
     # normalize event weights using stats
     events = self[normalized_pu_weights](events, **kwargs)
@@ -227,12 +320,12 @@ def event_weights_init(self: Producer) -> None:
         return
 
     if not has_tag("skip_electron_weights", self.config_inst, self.dataset_inst, operator=any):
-        self.uses |= {electron_weights}
-        self.produces |= {electron_weights}
+        self.uses |= {hbw_electron_weights}
+        self.produces |= {hbw_electron_weights}
 
     if not has_tag("skip_muon_weights", self.config_inst, self.dataset_inst, operator=any):
-        self.uses |= {muon_weights}
-        self.produces |= {muon_weights}
+        self.uses |= {hbw_muon_weights}
+        self.produces |= {hbw_muon_weights}
 
     if not has_tag("skip_btag_weights", self.config_inst, self.dataset_inst, operator=any):
         self.uses |= {btag_weights, normalized_btag_weights}
@@ -251,6 +344,15 @@ def event_weights_init(self: Producer) -> None:
     uses={"mc_weight"},
     produces={"mc_weight"},
     mc_only=True,
+    # events with absolute weights above *threshold_factor* times the *threshold_quantile* of the
+    # absolute weights are considered unphysical
+    threshold_factor=1000,
+    threshold_quantile=0.5,
+    # either "chunk" (the quantile of each chunk is used) or "dataset" (the quantile of the whole
+    # dataset is obtained from the weight sketch in the selection stats of the *sketch_selector*,
+    # falling back to "chunk" when the stats contain no sketch)
+    threshold_mode="chunk",
+    sketch_selector="weight_sketch",
 )
 def large_weights_killer(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
@@ -259,9 +361,71 @@ def large_weights_killer(self: Producer, events: ak.Array, **kwargs) -> ak.Array
     if self.dataset_inst.is_data:
         raise Exception("large_weights_killer is only callable for MC")
 
+    if not len(events):
+        return events
+
     # TODO: figure out a good threshold when events are considered unphysical
-    median_weight = ak.sort(abs(events.mc_weight))[int(len(events) / 2)]
-    weight_too_large = abs(events.mc_weight) > 1000 * median_weight
-    events = set_ak_column(events, "mc_weight", ak.where(weight_too_large, 0, events.mc_weight))
+    abs_weight = np.abs(ak.to_numpy(events.mc_weight))
+    threshold = self.weight_threshold
+    if threshold is None:
+        # chunk-local quantile via partial sorting
+        k = min(int(self.threshold_quantile * len(abs_weight)), len(abs_weight) - 1)
+        threshold = self.threshold_factor * np.partition(abs_weight, k)[k]
+
+    weight_too_large = abs_weight > threshold
+    events = set_ak_column(events, "mc_weight", np.where(weight_too_large, 0, events.mc_weight))
 
     return events
+
+
+@large_weights_killer.requires
+def large_weights_killer_requires(self: Producer, reqs: dict) -> None:
+    if self.threshold_mode != "dataset" or "selection_stats" in reqs:
+        return
+
+    # the sketch only depends on the mc weights, so it is filled by a dedicated selector without
+    # calibrators, which allows using the dataset threshold within SelectEvents
+    from hbw.tasks.selection import MergeSelectionStatsArrays
+    reqs["selection_stats"] = MergeSelectionStatsArrays.req(
+        self.task,
+        selector=self.sketch_selector,
+        calibrators=(),
+        tree_index=0,
+        branch=-1,
+        _exclude=MergeSelectionStatsArrays.exclude_params_forest_merge,
+    )
+
+
+@large_weights_killer.setup
+def large_weights_killer_setup(self: Producer, reqs: dict, inputs: dict, reader_targets: InsertableDict) -> None:
+    self.weight_threshold = None
+    if self.threshold_mode == "chunk":
+        return
+    if self.threshold_mode != "dataset":
+        raise ValueError(f"unknown threshold_mode '{self.threshold_mode}' of {self.cls_name}")
+
+    # compute the threshold once from the weight sketch of the whole dataset (filled from the
+    # unmodified mc weights)
+    stats = load_stats_arrays(inputs["selection_stats"]["collection"][0]["stats"])
+    sketch_key = "num_events_weight_sketch_per_abs_mc_weight_bin"
+    if sketch_key not in stats:
+        logger.warning(
+            f"selection stats of dataset {self.dataset_inst.name} contain no weight sketch, "
+            f"falling back to chunk-local thresholds in {self.cls_name}",
+        )
+        return
+
+    quantile = weight_sketch_quantile(
+        stats[f"{STATS_AXIS_PREFIX}abs_mc_weight_bin"],
+        stats[sketch_key],
+        self.threshold_quantile,
+    )
+    self.weight_threshold = self.threshold_factor * quantile
+
+
+# variant using a threshold obtained from the whole dataset, used in pre_selection when the config sets
+# large_weights_threshold_mode to "dataset"
+large_weights_killer_dataset = large_weights_killer.derive(
+    "large_weights_killer_dataset",
+    cls_dict={"threshold_mode": "dataset"},
+)
@@ -0,0 +1,63 @@
+# coding: utf-8
+
+"""
+Benchmark of the partial top-k selection in masked_sorted_indices against the full argsort path
+on synthetic jet-like collections. Needs to be run inside the columnar sandbox:
+
+    python hbw/scripts/benchmark_masked_sorted_indices.py --n-events 1000000 --k 2
+"""
+
+import argparse
+import time
+
+import numpy as np
+import awkward as ak
+
+from hbw.selection.common import masked_sorted_indices
+
+
+def synthetic_collection(n_events: int, max_objects: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, max_objects + 1, n_events)
+    n_objects = counts.sum()
+    sort_var = ak.unflatten(rng.exponential(50.0, n_objects).astype(np.float32), counts)
+    mask = ak.unflatten(rng.random(n_objects) > 0.3, counts)
+    return mask, sort_var
+
+
+def best_of(func, n_repeat: int) -> float:
+    timings = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--n-events", type=int, default=1_000_000)
+    parser.add_argument("--max-objects", type=int, default=12)
+    parser.add_argument("--k", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--n-repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    mask, sort_var = synthetic_collection(args.n_events, args.max_objects)
+    print(f"{args.n_events:,} events, {ak.sum(ak.num(sort_var)):,} objects")
+
+    for k in args.k:
+        reference = masked_sorted_indices(mask, sort_var)[:, :k]
+        result = masked_sorted_indices(mask, sort_var, k=k)
+        if not ak.all(ak.flatten(reference) == ak.flatten(result)) or ak.any(ak.num(reference) != ak.num(result)):
+            raise Exception(f"results for k={k} differ from the argsort path")
+
+        t_argsort = best_of(lambda: masked_sorted_indices(mask, sort_var)[:, :k], args.n_repeat)
+        t_top_k = best_of(lambda: masked_sorted_indices(mask, sort_var, k=k), args.n_repeat)
+        print(
+            f"k={k}: argsort {1000 * t_argsort:.1f} ms, top-k {1000 * t_top_k:.1f} ms, "
+            f"speedup {t_argsort / t_top_k:.2f}x",
+        )
+
+
+if __name__ == "__main__":
+    main()
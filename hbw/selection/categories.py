@@ -13,6 +13,8 @@ from columnflow.categorization import Categorizer, categorizer
 from columnflow.selection import SelectionResult
 from columnflow.columnar_util import has_ak_column, optional_column
 
+from hbw.util import flat_offsets
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
@@ -27,6 +29,81 @@ def catid_selection_incl(self: Categorizer, events: ak.Array, **kwargs) -> tuple
 #
 
 
+# pdgIds requested by all gen particle categorizers, which are counted together in a single pass
+gen_particle_pdg_ids = set()
+
+# name of the transient attribute of the events array that the gen particle counts are stored in, so
+# that they are shared by all gen particle categorizers evaluated on the same chunk
+GEN_PARTICLE_COUNTS_ATTR = "@gen_particle_counts"
+
+
+def count_gen_particles(
+    events: ak.Array,
+    results: SelectionResult | None = None,
+    pdg_ids: set[int] | None = None,
+    ignore_charge: bool = True,
+) -> tuple[dict[int, int], np.ndarray]:
+    """
+    Counts the prompt hard-process gen particles per event for all *pdg_ids* and all ids in
+    *gen_particle_pdg_ids* in a single pass over the flat pdgId buffer.
+
+    The result is cached in the transient attributes of *events* (for the same *events* layout and
+    *results* object), so that all gen particle categorizers evaluated on the same chunk share one
+    count matrix, and the cache is released together with the chunk.
+
+    :return: Tuple of a lookup table from pdgId to column and the (events x pdgIds) count matrix.
+    """
+    cache = events.attrs.get(GEN_PARTICLE_COUNTS_ATTR)
+    if not cache or cache["layout"] is not events.layout or cache["results"] is not results:
+        # arrays derived from *events* inherit the attributes, but not the layout
+        cache = events.attrs[GEN_PARTICLE_COUNTS_ATTR] = {"layout": events.layout, "results": results, "counts": {}}
+
+    pdg_ids = set(pdg_ids or ())
+    cached = cache["counts"].get(ignore_charge)
+    if cached and pdg_ids <= cached[0].keys():
+        return cached
+
+    # count all tracked pdgIds at once
+    pdg_ids = sorted(pdg_ids | gen_particle_pdg_ids | (cached[0].keys() if cached else set()))
+
+    if has_ak_column(events, "HardGenPart.pdgId"):
+        gp_id = events.HardGenPart.pdgId
+    else:
+        try:
+            # try to get gp_id column via SelectionResult
+            gp_id = events.GenPart.pdgId[results.objects.GenPart.HardGenPart]
+        except AttributeError:
+            # try to select hard gen particles via status flags
+            gp_id = events.GenPart.pdgId[events.GenPart.hasFlags("isHardProcess")]
+
+    gp_id, offsets = flat_offsets(gp_id)
+    if ignore_charge:
+        gp_id = np.abs(gp_id)
+
+    # lookup table from pdgId to column of the count matrix
+    columns = {pdg_id: i for i, pdg_id in enumerate(pdg_ids)}
+    min_id = min(pdg_ids, default=0)
+    lookup = np.full(max(pdg_ids, default=0) - min_id + 1, -1, dtype=np.int64)
+    lookup[np.array(pdg_ids, dtype=np.int64) - min_id] = np.arange(len(pdg_ids))
+
+    lookup_index = gp_id.astype(np.int64) - min_id
+    in_range = (lookup_index >= 0) & (lookup_index < len(lookup))
+    particle_column = np.full(len(gp_id), -1, dtype=np.int64)
+    particle_column[in_range] = lookup[lookup_index[in_range]]
+    tracked = particle_column >= 0
+
+    # fill the count matrix from the event index and column of all tracked particles
+    n_events = len(offsets) - 1
+    event_index = np.repeat(np.arange(n_events), np.diff(offsets))
+    counts = np.bincount(
+        event_index[tracked] * len(pdg_ids) + particle_column[tracked],
+        minlength=n_events * len(pdg_ids),
+    ).reshape(n_events, len(pdg_ids))
+
+    cache["counts"][ignore_charge] = (columns, counts)
+    return columns, counts
+
+
 @categorizer(
     uses=optional_column("HardGenPart.pdgId", "GenPart.pdgId", "GenPart.statusFlags"),
     gp_dict={},  # dict with (tuple of) pdgId + number of required prompt particles with this pdgId
@@ -48,25 +125,15 @@ def catid_n_gen_particles(
         # for data, always return true mask
         return events, mask
 
-    if has_ak_column(events, "HardGenPart.pdgId"):
-        gp_id = events.HardGenPart.pdgId
-    else:
-        try:
-            # try to get gp_id column via SelectionResult
-            gp_id = events.GenPart.pdgId[results.objects.GenPart.HardGenPart]
-        except AttributeError:
-            # try to select hard gen particles via status flags
-            gp_id = events.GenPart.pdgId[events.GenPart.hasFlags("isHardProcess")]
-
-    if self.ignore_charge:
-        gp_id = abs(gp_id)
+    # shared count matrix of all tracked pdgIds
+    columns, counts = count_gen_particles(events, results, self.pdg_ids, ignore_charge=self.ignore_charge)
 
     for pdgIds, required_n_particles in self.gp_dict.items():
         # make sure that 'pdgIds' is a tuple
         pdgIds = law.util.make_tuple(pdgIds)
 
         # get number of gen particles with requested pdgIds for each event
-        n_particles = sum([ak.sum(gp_id == pdgId, axis=1) for pdgId in pdgIds])
+        n_particles = counts[:, [columns[pdgId] for pdgId in pdgIds]].sum(axis=1)
 
         # compare number of gen particles with required number of particles with requested operator
         this_mask = getattr(n_particles, f"__{self._operator}__")(required_n_particles)
@@ -75,6 +142,16 @@ def catid_n_gen_particles(
     return events, mask
 
 
+@catid_n_gen_particles.init
+def catid_n_gen_particles_init(self: Categorizer) -> None:
+    # register the requested pdgIds, so that they are counted together with those of all other
+    # gen particle categorizers
+    self.pdg_ids = set()
+    for pdgIds in self.gp_dict.keys():
+        self.pdg_ids |= set(law.util.make_tuple(pdgIds))
+    gen_particle_pdg_ids.update(self.pdg_ids)
+
+
 catid_gen_0lep = catid_n_gen_particles.derive("catid_gen_0lep", cls_dict={"gp_dict": {11: 0, 13: 0, 15: 0}})
 catid_gen_1e = catid_n_gen_particles.derive("catid_gen_1e", cls_dict={"gp_dict": {11: 1, 13: 0, 15: 0}})
 catid_gen_1mu = catid_n_gen_particles.derive("catid_gen_1mu", cls_dict={"gp_dict": {11: 0, 13: 1, 15: 0}})
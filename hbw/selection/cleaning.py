@@ -0,0 +1,214 @@
+# coding: utf-8
+
+"""
+Compiled helpers for the Delta R based cleaning and matching of object collections. All kernels
+work on the flat content and offsets of the collections, so no nested (objects x references)
+metric tables are built.
+"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+from columnflow.util import maybe_import
+
+from hbw.util import njit, flat_offsets
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+@njit
+def _delta_r(eta1, phi1, eta2, phi2):
+    # same phi wrapping as coffea's LorentzVector.delta_phi
+    dphi = (phi1 - phi2 + np.pi) % (2 * np.pi) - np.pi
+    deta = eta1 - eta2
+    return np.sqrt(deta * deta + dphi * dphi)
+
+
+@njit
+def _cleaning_mask_kernel(offsets, eta, phi, ref_offsets, ref_eta, ref_phi, min_dr):
+    n_events = len(offsets) - 1
+    n_refs = ref_offsets.shape[0]
+    mask = np.ones(len(eta), dtype=np.bool_)
+
+    for ev in range(n_events):
+        for i in range(offsets[ev], offsets[ev + 1]):
+            for c in range(n_refs):
+                for j in range(ref_offsets[c, ev], ref_offsets[c, ev + 1]):
+                    if not _delta_r(eta[i], phi[i], ref_eta[j], ref_phi[j]) > min_dr[c]:
+                        mask[i] = False
+                        break
+                if not mask[i]:
+                    break
+
+    return mask
+
+
+@njit
+def _separation_kernel(offsets, eta, phi, ref_offsets, ref_eta, ref_phi, inner_dr, outer_dr):
+    n_events = len(offsets) - 1
+    n_inner = np.zeros(len(eta), dtype=np.int32)
+    n_outer = np.zeros(len(eta), dtype=np.int32)
+    max_dr = np.full(len(eta), np.nan, dtype=np.float32)
+
+    for ev in range(n_events):
+        for i in range(offsets[ev], offsets[ev + 1]):
+            for j in range(ref_offsets[ev], ref_offsets[ev + 1]):
+                dr = _delta_r(eta[i], phi[i], ref_eta[j], ref_phi[j])
+                if dr < inner_dr:
+                    n_inner[i] += 1
+                if dr > outer_dr:
+                    n_outer[i] += 1
+                if np.isnan(max_dr[i]) or dr > max_dr[i]:
+                    max_dr[i] = dr
+
+    return n_inner, n_outer, max_dr
+
+
+def delta_r_cleaning_mask(
+    objects: ak.Array,
+    *references: ak.Array,
+    min_dr: float | Sequence[float] = 0.4,
+) -> ak.Array:
+    """
+    Helper to build an object mask that is *True* for all *objects* that are separated by more than
+    *min_dr* from all objects of all *references* collections. Equivalent to
+
+    .. code-block:: python
+
+        mask = ak.all(objects.metric_table(references[0]) > min_dr[0], axis=2) & ...
+
+    but evaluated in a single compiled pass over the flat eta and phi buffers.
+
+    :param objects: Jagged collection with *eta* and *phi* fields that should be cleaned.
+    :param references: Any number of jagged collections with *eta* and *phi* fields.
+    :param min_dr: Minimum Delta R, either one value for all or one value per reference collection.
+    :return: Jagged boolean mask with the same structure as *objects*.
+    """
+    min_dr = np.broadcast_to(np.asarray(min_dr, dtype=np.float64), (len(references),))
+
+    eta, offsets = flat_offsets(objects.eta)
+    phi = ak.to_numpy(ak.flatten(objects.phi, axis=1))
+
+    # concatenate all reference collections into one flat buffer with one row of offsets each
+    ref_eta, ref_phi, ref_offsets = [], [], np.zeros((len(references), len(offsets)), dtype=np.int64)
+    n_ref = 0
+    for c, ref in enumerate(references):
+        _eta, _offsets = flat_offsets(ref.eta)
+        ref_eta.append(_eta)
+        ref_phi.append(ak.to_numpy(ak.flatten(ref.phi, axis=1)))
+        ref_offsets[c] = _offsets + n_ref
+        n_ref += len(_eta)
+
+    mask = _cleaning_mask_kernel(
+        offsets, eta, phi,
+        ref_offsets,
+        np.concatenate(ref_eta) if ref_eta else np.zeros(0, dtype=eta.dtype),
+        np.concatenate(ref_phi) if ref_phi else np.zeros(0, dtype=phi.dtype),
+        min_dr,
+    )
+
+    return ak.unflatten(mask, np.diff(offsets))
+
+
+def delta_r_separation(
+    objects: ak.Array,
+    references: ak.Array,
+    inner_dr: float = 0.8,
+    outer_dr: float = 1.2,
+) -> tuple[ak.Array, ak.Array, ak.Array]:
+    """
+    Helper to summarize the Delta R separation between *objects* and *references* without building
+    the full metric table. For each object, returns the number of references with
+    Delta R < *inner_dr*, the number of references with Delta R > *outer_dr* and the maximum
+    Delta R to any reference (None when the event contains no references), equivalent to
+
+    .. code-block:: python
+
+        dr = objects.metric_table(references)
+        ak.sum(dr < inner_dr, axis=2), ak.sum(dr > outer_dr, axis=2), ak.max(dr, axis=2)
+
+    :return: Tuple of three jagged arrays with the same structure as *objects*.
+    """
+    eta, offsets = flat_offsets(objects.eta)
+    phi = ak.to_numpy(ak.flatten(objects.phi, axis=1))
+    ref_eta, ref_offsets = flat_offsets(references.eta)
+    ref_phi = ak.to_numpy(ak.flatten(references.phi, axis=1))
+
+    n_inner, n_outer, max_dr = _separation_kernel(
+        offsets, eta, phi, ref_offsets, ref_eta, ref_phi, inner_dr, outer_dr,
+    )
+
+    counts = np.diff(offsets)
+    max_dr = ak.mask(max_dr, ~np.isnan(max_dr))
+    return (
+        ak.unflatten(n_inner, counts),
+        ak.unflatten(n_outer, counts),
+        ak.unflatten(max_dr, counts),
+    )
+
+
+@njit
+def _unique_matching_kernel(offsets, eta, phi, pt, ref_eta, ref_phi, ref_pt, max_dr, max_rel_pt_diff):
+    n_events, n_refs = ref_eta.shape
+    match = np.full((n_events, n_refs), -1, dtype=np.int64)
+    n_candidates = np.zeros((n_events, n_refs), dtype=np.int64)
+
+    for ev in range(n_events):
+        start, stop = offsets[ev], offsets[ev + 1]
+        n_objects = stop - start
+
+        # (references x objects) cost matrix, infinite for pairs failing the requirements
+        cost = np.full((n_refs, n_objects), np.inf)
+        for r in range(n_refs):
+            for i in range(n_objects):
+                dr = _delta_r(eta[start + i], phi[start + i], ref_eta[ev, r], ref_phi[ev, r])
+                rel_pt_diff = (pt[start + i] - ref_pt[ev, r]) / ref_pt[ev, r]
+                if dr < max_dr and abs(rel_pt_diff) < max_rel_pt_diff:
+                    cost[r, i] = dr
+                    n_candidates[ev, r] += 1
+
+        # greedy unique assignment in the order of increasing Delta R
+        for _ in range(min(n_refs, n_objects)):
+            best, best_r, best_i = np.inf, -1, -1
+            for r in range(n_refs):
+                for i in range(n_objects):
+                    if cost[r, i] < best:
+                        best, best_r, best_i = cost[r, i], r, i
+            if best_r < 0:
+                break
+            match[ev, best_r] = best_i
+            cost[best_r, :] = np.inf
+            cost[:, best_i] = np.inf
+
+    return match, n_candidates
+
+
+def delta_r_unique_matching(
+    objects: ak.Array,
+    references: Sequence[ak.Array],
+    max_dr: float = 0.4,
+    max_rel_pt_diff: float = 10.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Helper to match each of the *references*, a sequence of flat arrays with one particle per
+    event (e.g. gen-level partons) with *pt*, *eta* and *phi* fields, to at most one of the jagged
+    *objects* (e.g. jets). Pairs are candidates when their Delta R is below *max_dr* and the
+    relative pt difference below *max_rel_pt_diff*. All references of an event are matched at
+    once, greedily in the order of increasing Delta R, so that each object is assigned to at most
+    one reference.
+
+    :return: Tuple of two (events x references) arrays, containing the local index of the matched
+        object (-1 if no object was matched) and the number of candidate objects per reference.
+    """
+    eta, offsets = flat_offsets(objects.eta)
+    phi = ak.to_numpy(ak.flatten(objects.phi, axis=1))
+    pt = ak.to_numpy(ak.flatten(objects.pt, axis=1))
+
+    def stack(field):
+        return np.stack([ak.to_numpy(ref[field]) for ref in references], axis=1).astype(np.float64)
+
+    return _unique_matching_kernel(
+        offsets, eta, phi, pt, stack("eta"), stack("phi"), stack("pt"), max_dr, max_rel_pt_diff,
+    )
@@ -22,9 +22,11 @@ from columnflow.production.categories import category_ids
 from columnflow.production.processes import process_ids
 from columnflow.production.cms.seeds import deterministic_seeds
 
+from hbw.util import njit, flat_offsets
 from hbw.selection.gen import hard_gen_particles
-from hbw.production.weights import event_weights_to_normalize, large_weights_killer
-from hbw.selection.stats import hbw_selection_step_stats, hbw_increment_stats
+from hbw.production.weights import event_weights_to_normalize, large_weights_killer, large_weights_killer_dataset
+from hbw.production.jet_shift_deltas import jet_shifts_from_deltas
+from hbw.selection.stats import hbw_selection_step_stats, hbw_increment_stats, increment_weight_sketch
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -32,12 +34,69 @@ ak = maybe_import("awkward")
 logger = law.logger.get_logger(__name__)
 
 
-def masked_sorted_indices(mask: ak.Array, sort_var: ak.Array, ascending: bool = False) -> ak.Array:
+@njit
+def _is_before(value, other, ascending):
+    # same ordering as ak.argsort: nan values first, then by value (ties are resolved by the caller)
+    if np.isnan(value):
+        return not np.isnan(other)
+    if np.isnan(other):
+        return False
+    return value < other if ascending else value > other
+
+
+@njit
+def _masked_top_k_kernel(offsets, mask, sort_var, k, ascending):
+    n_events = len(offsets) - 1
+    counts = np.zeros(n_events, dtype=np.int64)
+    indices = np.empty(n_events * k, dtype=np.int64)
+
+    pos = 0
+    for ev in range(n_events):
+        start = offsets[ev]
+        n = 0
+        for i in range(start, offsets[ev + 1]):
+            if not mask[i]:
+                continue
+
+            # find the insertion position; objects are visited in index order, so placing them behind
+            # objects with the same value keeps the result identical to a stable argsort
+            p = n
+            while p > 0 and _is_before(sort_var[i], sort_var[start + indices[pos + p - 1]], ascending):
+                p -= 1
+            if p >= k:
+                continue
+
+            # shift worse entries by one, dropping the last one when the buffer is full
+            for q in range(min(n, k - 1), p, -1):
+                indices[pos + q] = indices[pos + q - 1]
+            indices[pos + p] = i - start
+            n = min(n + 1, k)
+
+        counts[ev] = n
+        pos += n
+
+    return indices[:pos], counts
+
+
+def masked_sorted_indices(
+    mask: ak.Array,
+    sort_var: ak.Array,
+    ascending: bool = False,
+    k: int | None = None,
+) -> ak.Array:
     """
-    Helper function to obtain the correct indices of an object mask
+    Helper function to obtain the correct indices of an object mask. When *k* is given, only the
+    indices of the *k* leading objects per event are returned, which is determined via a compiled
+    partial selection instead of sorting the full collections.
     """
-    indices = ak.argsort(sort_var, axis=-1, ascending=ascending)
-    return indices[mask[indices]]
+    if k is None:
+        indices = ak.argsort(sort_var, axis=-1, ascending=ascending)
+        return indices[mask[indices]]
+
+    sort_var, offsets = flat_offsets(sort_var)
+    mask = ak.to_numpy(ak.flatten(mask, axis=1))
+    indices, counts = _masked_top_k_kernel(offsets, mask, sort_var, k, ascending)
+    return ak.unflatten(indices, counts)
 
 
 @selector(
@@ -77,12 +136,12 @@ hbw_met_filters = met_filters.derive("hbw_met_filters", cls_dict=dict(get_met_fi
     uses={
         hbw_met_filters, json_filter, "PV.npvsGood",
         process_ids, attach_coffea_behavior,
-        mc_weight, large_weights_killer,
+        mc_weight, large_weights_killer, jet_shifts_from_deltas,
     },
     produces={
         hbw_met_filters, json_filter,
         process_ids, attach_coffea_behavior,
-        mc_weight, large_weights_killer,
+        mc_weight, large_weights_killer, jet_shifts_from_deltas,
     },
     exposed=False,
 )
@@ -94,6 +153,9 @@ def pre_selection(
 ) -> Tuple[ak.Array, SelectionResult]:
     """ Methods that are called for both SL and DL before calling the selection modules """
 
+    # reconstruct shifted jets when they are stored as deltas
+    events = self[jet_shifts_from_deltas](events, **kwargs)
+
     # temporary fix for optional types from Calibration (e.g. events.Jet.pt --> ?float32)
     # TODO: remove as soon as possible as it might lead to weird bugs when there are none entries in inputs
     events = ak.fill_none(events, EMPTY_FLOAT)
@@ -105,7 +167,12 @@ def pre_selection(
     # mc weight
     if self.dataset_inst.is_mc:
         events = self[mc_weight](events, **kwargs)
-        events = self[large_weights_killer](events, **kwargs)
+
+        # quantile sketch of the absolute mc weights before large weights are removed
+        increment_weight_sketch(stats, events.mc_weight)
+
+        # remove large weights before any stats used for the normalization are incremented
+        events = self[self.large_weights_killer_cls](events, **kwargs)
 
     # create process ids
     events = self[process_ids](events, **kwargs)
@@ -140,6 +207,40 @@ def pre_selection_init(self: Selector) -> None:
         self.uses.add(deterministic_seeds)
         self.produces.add(deterministic_seeds)
 
+    # large weights are either removed with a threshold per chunk or per dataset, the latter requiring the
+    # selection stats of the weight_sketch selector
+    self.large_weights_killer_cls = large_weights_killer
+    if self.config_inst.x("large_weights_threshold_mode", "chunk") == "dataset":
+        self.large_weights_killer_cls = large_weights_killer_dataset
+        self.uses.discard(large_weights_killer)
+        self.produces.discard(large_weights_killer)
+        self.uses.add(large_weights_killer_dataset)
+        self.produces.add(large_weights_killer_dataset)
+
+
+@selector(
+    uses={mc_weight},
+    produces={mc_weight},
+    exposed=True,
+)
+def weight_sketch(
+    self: Selector,
+    events: ak.Array,
+    stats: defaultdict,
+    **kwargs,
+) -> Tuple[ak.Array, SelectionResult]:
+    """
+    Selector that only fills the quantile sketch of the absolute mc weights into the *stats*, from
+    which the dataset-level threshold of :py:obj:`large_weights_killer_dataset` is obtained before
+    running the actual selection. No event is selected.
+    """
+    stats["num_events"] += len(events)
+    if self.dataset_inst.is_mc:
+        events = self[mc_weight](events, **kwargs)
+        increment_weight_sketch(stats, events.mc_weight)
+
+    return events, SelectionResult(event=ak.Array(np.zeros(len(events), dtype=bool)))
+
 
 @selector(
     uses={
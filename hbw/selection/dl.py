@@ -13,6 +13,7 @@ from columnflow.columnar_util import EMPTY_FLOAT
 from columnflow.selection import Selector, SelectionResult, selector
 
 from hbw.selection.common import masked_sorted_indices, pre_selection, post_selection
+from hbw.selection.cleaning import delta_r_cleaning_mask
 from hbw.selection.jet import sl_boosted_jet_selection, vbf_jet_selection
 from hbw.production.weights import event_weights_to_normalize
 from hbw.selection.cutflow_features import cutflow_features
@@ -61,7 +62,7 @@ def dl_jet_selection(
     jet_mask_loose = (events.Jet.pt > 5) & abs(events.Jet.eta < 2.4)
     jet_mask = (
         (events.Jet.pt > 20) & (abs(events.Jet.eta) < 2.4) & (events.Jet.jetId == 6) &
-        ak.all(events.Jet.metric_table(lepton_results.x.lepton) > 0.3, axis=2)
+        delta_r_cleaning_mask(events.Jet, lepton_results.x.lepton, min_dr=0.3)
     )
     events = set_ak_column(events, "cutflow.n_jet", ak.sum(jet_mask, axis=1))
     jet_sel = events.cutflow.n_jet >= 2
@@ -74,7 +75,7 @@ def dl_jet_selection(
     btag_sel = events.cutflow.n_deepjet_med >= 2
 
     # define b-jets as the two b-score leading jets, b-score sorted
-    bjet_indices = masked_sorted_indices(jet_mask, events.Jet.btagDeepFlavB)[:, :2]
+    bjet_indices = masked_sorted_indices(jet_mask, events.Jet.btagDeepFlavB, k=2)
 
     # define lightjets as all non b-jets, pt-sorted
     b_idx = ak.fill_none(ak.pad_none(bjet_indices, 2), -1)
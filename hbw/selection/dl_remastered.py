@@ -12,6 +12,7 @@ from columnflow.selection import Selector, SelectionResult, selector
 
 from hbw.selection.common import masked_sorted_indices, pre_selection, post_selection
 from hbw.selection.lepton import lepton_definition
+from hbw.selection.staging import staged_selection
 from hbw.selection.jet import jet_selection, sl_boosted_jet_selection, vbf_jet_selection
 from hbw.production.weights import event_weights_to_normalize
 
@@ -252,6 +253,18 @@ def dl_lepton_selection_init(self: Selector) -> None:
         jet_selection, dl_lepton_selection,
     },
     exposed=True,
+    # when staged, events failing the steps of a stage are not evaluated by the following steps; the steps
+    # of each stage need to be part of the "all_but_bjet" step; for rejected events, step stats of later
+    # steps are not incremented, they have no jets in the jet_mask (btag_weight 1) and are grouped in the
+    # njet bin -1 of the stats, which is ignored by the btag weight normalization
+    staged=False,
+    stages={
+        "pre_selection": ("cleanup",),
+        "lepton": (
+            "ll_lowmass_veto", "ll_zmass_veto", "TripleLooseLeptonVeto", "Charge",
+            "Dilepton", "Trigger", "TriggerAndLep",
+        ),
+    },
 )
 def dl1(
     self: Selector,
@@ -262,21 +275,53 @@ def dl1(
     # prepare events
     events, results = self[pre_selection](events, stats, **kwargs)
 
-    # lepton selection
-    events, lepton_results = self[dl_lepton_selection](events, stats, **kwargs)
-    results += lepton_results
+    if self.staged:
+        events, results = staged_selection(
+            events,
+            results,
+            [
+                (
+                    "lepton",
+                    lambda events, results: self[dl_lepton_selection](events, stats, **kwargs),
+                    self[dl_lepton_selection].produced_columns,
+                ),
+                (
+                    "jet",
+                    lambda events, results: self[jet_selection](events, results, stats, **kwargs),
+                    # the jet selection also replaces nan b-scores
+                    self[jet_selection].produced_columns | {"Jet.btagDeepFlavB"},
+                ),
+                (
+                    "boosted",
+                    lambda events, results: self[sl_boosted_jet_selection](events, results, results, stats, **kwargs),
+                    self[sl_boosted_jet_selection].produced_columns,
+                ),
+                (
+                    "vbf_jet",
+                    lambda events, results: self[vbf_jet_selection](events, results, stats, **kwargs),
+                    self[vbf_jet_selection].produced_columns,
+                ),
+            ],
+            stages=self.stages,
+            aux_collections={"jet_mask": "Jet"},
+            aux_fill_values={"n_central_jets": -1},
+        )
+    else:
+        # lepton selection
+        events, lepton_results = self[dl_lepton_selection](events, stats, **kwargs)
+        results += lepton_results
 
-    # jet selection
-    events, jet_results = self[jet_selection](events, lepton_results, stats, **kwargs)
-    results += jet_results
+        # jet selection
+        events, jet_results = self[jet_selection](events, lepton_results, stats, **kwargs)
+        results += jet_results
 
-    # boosted selection
-    events, boosted_results = self[sl_boosted_jet_selection](events, lepton_results, jet_results, stats, **kwargs)
-    results += boosted_results
+        # boosted selection
+        events, boosted_results = self[sl_boosted_jet_selection](events, lepton_results, jet_results, stats, **kwargs)
+        results += boosted_results
 
-    # vbf_jet selection
-    events, vbf_jet_results = self[vbf_jet_selection](events, results, stats, **kwargs)
-    results += vbf_jet_results
+        # vbf_jet selection
+        events, vbf_jet_results = self[vbf_jet_selection](events, results, stats, **kwargs)
+        results += vbf_jet_results
 
     results.steps["Resolved"] = (results.steps.nJet1 & results.steps.nBjet1)
     results.steps["ResolvedOrBoosted"] = (
@@ -325,3 +370,7 @@ def dl1_init(self: Selector) -> None:
 
     self.uses.add(event_weights_to_normalize)
     self.produces.add(event_weights_to_normalize)
+
+
+# staged variant of dl1 that only runs the jet selections on events passing the lepton vetoes
+dl1_staged = dl1.derive("dl1_staged", cls_dict={"staged": True})
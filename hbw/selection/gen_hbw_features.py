@@ -4,22 +4,20 @@
 Selectors to set ak columns for gen particles of hh2bbww
 """
 
+import law
+
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column  # , Route, EMPTY_FLOAT
 from columnflow.selection import SelectionResult
 from columnflow.production import Producer, producer
 
 from hbw.config.cutflow_variables import add_gen_variables
+from hbw.selection.cleaning import delta_r_unique_matching
 
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
-
-def masked_sorted_indices(mask: ak.Array, sort_var: ak.Array, ascending: bool = False) -> ak.Array:
-    """
-    Helper function to obtain the correct indices of an object mask
-    """
-    indices = ak.argsort(sort_var, axis=-1, ascending=ascending)
-    return indices[mask[indices]]
+logger = law.logger.get_logger(__name__)
 
 
 @producer(
@@ -51,66 +49,65 @@ def gen_hbw_decay_features_init(self: Producer) -> None:
 
 @producer(
     uses={
-        "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.genJetIdx",
-        "GenJet.pt", "GenJet.eta", "GenJet.phi", "GenJet.mass", "GenJet.partonFlavour", "GenJet.hadronFlavour",
-        "Electron.pt", "Electron.eta", "Electron.phi", "Electron.mass",
-        "Muon.pt", "Muon.eta", "Muon.phi", "Muon.mass",
+        "Jet.pt", "Jet.eta", "Jet.phi",
+        "Electron.pt", "Electron.eta", "Electron.phi",
+        "Muon.pt", "Muon.eta", "Muon.phi",
         "gen_hbw_decay",
     },
+    produces={
+        f"gen_match.{gp}" for gp in ("b1", "b2", "q1", "q2", "sec1", "sec2", "l")
+    },
 )
 def gen_hbw_matching(
         self: Producer, events: ak.Array,
-        results: SelectionResult = None, verbose: bool = True,
+        results: SelectionResult = None, verbose: bool = False,
         dR_req: float = 0.4, ptdiff_req: float = 10.,
         **kwargs,
 ) -> ak.Array:
     """
     Function that matches HH->bbWW decay product gen particles to Reco-level jets and leptons.
+    Each gen particle is matched to at most one object and each object to at most one gen particle
+    (see :py:func:`delta_r_unique_matching`). The column 'gen_match' stores the local index of the
+    matched jet per parton and the index of the matched lepton in the concatenation of muons and
+    electrons, or -1 if no object was matched.
     """
-
     gen_matches = {}
 
-    # jet matching
-    # NOTE: might be nice to remove jets that already have been matched
-    for gp_tag in ("b1", "b2", "q1", "q2", "sec1", "sec2"):
-        gp = events.gen_hbw_decay[gp_tag]
-
-        dr = events.Jet.delta_r(gp)
-        pt_diff = (events.Jet.pt - gp.pt) / gp.pt
-
-        jet_match_mask = (dr < dR_req) & (abs(pt_diff) < ptdiff_req)
-        jet_matches = events.Jet[jet_match_mask]
-
+    # jet matching for all partons at once
+    gp_tags = ("b1", "b2", "q1", "q2", "sec1", "sec2")
+    jet_match, n_candidates = delta_r_unique_matching(
+        events.Jet,
+        [events.gen_hbw_decay[gp_tag] for gp_tag in gp_tags],
+        max_dr=dR_req,
+        max_rel_pt_diff=ptdiff_req,
+    )
+    for i, gp_tag in enumerate(gp_tags):
         if verbose:
-            print(gp_tag, "multiple matches:", ak.sum(ak.num(jet_matches) > 1))
-            print(gp_tag, "no matches:", ak.sum(ak.num(jet_matches) == 0))
+            logger.debug(f"{gp_tag} multiple matches: {np.sum(n_candidates[:, i] > 1)}")
+            logger.debug(f"{gp_tag} no matches: {np.sum(jet_match[:, i] < 0)}")
 
-        # if multiple matches found: choose match with smallest dr
-        jet_match = jet_matches[ak.argsort(jet_matches.delta_r(gp))]
-        gen_matches[gp_tag] = jet_match
+        gen_matches[gp_tag] = jet_match[:, i]
 
     # lepton matching for combined electron and muon
-    lepton_fields = set(events.Muon.fields).intersection(events.Electron.fields)
-
     lepton = ak.concatenate([
-        ak.zip({f: events.Muon[f] for f in lepton_fields}),
-        ak.zip({f: events.Electron[f] for f in lepton_fields}),
+        ak.zip({f: events.Muon[f] for f in ("pt", "eta", "phi")}),
+        ak.zip({f: events.Electron[f] for f in ("pt", "eta", "phi")}),
     ], axis=-1)
-    lepton = ak.with_name(lepton, "PtEtaPhiMLorentzVector")
-
-    gp_lep = events.gen_hbw_decay.l
-    dr = lepton.delta_r(gp_lep)
-    pt_diff = (lepton.pt - gp_lep.pt) / gp_lep.pt
-    lep_match_mask = (dR_req < 0.4) & (abs(pt_diff) < ptdiff_req)
-    lep_matches = lepton[lep_match_mask]
 
+    lep_match, n_candidates = delta_r_unique_matching(
+        lepton,
+        [events.gen_hbw_decay.l],
+        max_dr=dR_req,
+        max_rel_pt_diff=ptdiff_req,
+    )
     if verbose:
-        print("l multiple matches:", ak.sum(ak.num(lep_matches) > 1))
-        print("l no matches:", ak.sum(ak.num(lep_matches) == 0))
+        logger.debug(f"l multiple matches: {np.sum(n_candidates[:, 0] > 1)}")
+        logger.debug(f"l no matches: {np.sum(lep_match[:, 0] < 0)}")
 
-    lep_match = lep_matches[ak.argsort(lep_matches.delta_r(gp_lep))]
-    gen_matches["l"] = lep_match
+    gen_matches["l"] = lep_match[:, 0]
 
     # write matches into events and return them
-    events = set_ak_column(events, "gen_match", ak.zip(gen_matches, depth_limit=1))
+    for gp_tag, match in gen_matches.items():
+        events = set_ak_column(events, f"gen_match.{gp_tag}", match, value_type=np.int32)
+
     return events
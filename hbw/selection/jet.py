@@ -18,6 +18,7 @@ from columnflow.columnar_util import set_ak_column, optional_column as optional
 from columnflow.selection import Selector, SelectionResult, selector
 
 from hbw.selection.common import masked_sorted_indices
+from hbw.selection.cleaning import delta_r_cleaning_mask, delta_r_separation
 from hbw.util import four_vec, call_once_on_config
 
 np = maybe_import("numpy")
@@ -66,9 +67,7 @@ def jet_selection(
         (events.Jet.pt >= 25) &
         (abs(events.Jet.eta) <= 2.4) &
         (events.Jet.jetId >= 2) &  # 1: loose, 2: tight, 4: isolated, 6: tight+isolated
-        # ak.all(events.Jet.metric_table(lepton_results.x.lepton) > 0.4, axis=2)
-        ak.all(events.Jet.metric_table(electron) > 0.4, axis=2) &
-        ak.all(events.Jet.metric_table(muon) > 0.4, axis=2)
+        delta_r_cleaning_mask(events.Jet, electron, muon, min_dr=0.4)
     )
 
     # apply loose Jet puId to jets with pt below 50 GeV (not in Run3 samples so skip this for now)
@@ -99,7 +98,7 @@ def jet_selection(
     steps["nBjet2"] = events.cutflow.n_btag >= 2
 
     # define b-jets as the two b-score leading jets, b-score sorted
-    bjet_indices = masked_sorted_indices(jet_mask, b_score)[:, :2]
+    bjet_indices = masked_sorted_indices(jet_mask, b_score, k=2)
 
     # define lightjets as all non b-jets, pt-sorted
     b_idx = ak.fill_none(ak.pad_none(bjet_indices, 2), -1)
@@ -504,18 +503,19 @@ def sl_boosted_jet_selection(
     ak4_jets = events.Jet[jet_results.objects.Jet.Jet]
 
     # get separation info between FatJets and AK4 Jets
-    dr_fatjet_ak4 = events.FatJet.metric_table(ak4_jets)
-    events = set_ak_column(events, "FatJet.n_subjets", ak.sum(dr_fatjet_ak4 < 0.8, axis=2))
-    events = set_ak_column(events, "FatJet.n_separated_jets", ak.sum(dr_fatjet_ak4 > 1.2, axis=2))
-    events = set_ak_column(events, "FatJet.max_dr_ak4", ak.max(dr_fatjet_ak4, axis=2))
+    n_subjets, n_separated_jets, max_dr_ak4 = delta_r_separation(
+        events.FatJet, ak4_jets, inner_dr=0.8, outer_dr=1.2,
+    )
+    events = set_ak_column(events, "FatJet.n_subjets", n_subjets)
+    events = set_ak_column(events, "FatJet.n_separated_jets", n_separated_jets)
+    events = set_ak_column(events, "FatJet.max_dr_ak4", max_dr_ak4)
 
     # baseline fatjet selection
     fatjet_mask = (
         (events.FatJet.pt > 200) &
         (abs(events.FatJet.eta) < 2.4) &
         (events.FatJet.jetId == 6) &
-        (ak.all(events.FatJet.metric_table(electron) > 0.8, axis=2)) &
-        (ak.all(events.FatJet.metric_table(muon) > 0.8, axis=2))
+        delta_r_cleaning_mask(events.FatJet, electron, muon, min_dr=0.8)
     )
     events = set_ak_column(events, "cutflow.n_fatjet", ak.sum(fatjet_mask, axis=1))
 
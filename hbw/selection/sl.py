@@ -15,6 +15,7 @@ from columnflow.production.processes import process_ids
 
 from hbw.util import four_vec
 from hbw.selection.common import masked_sorted_indices, pre_selection, post_selection
+from hbw.selection.cleaning import delta_r_cleaning_mask
 from hbw.selection.jet import sl_boosted_jet_selection, vbf_jet_selection
 from hbw.production.weights import event_weights_to_normalize
 from hbw.selection.stats import hbw_increment_stats
@@ -49,7 +50,7 @@ def sl_jet_selection(
     jet_mask_loose = (events.Jet.pt > 5) & abs(events.Jet.eta < 2.4)
     jet_mask = (
         (events.Jet.pt > 25) & (abs(events.Jet.eta) < 2.4) & (events.Jet.jetId == 6) &
-        ak.all(events.Jet.metric_table(lepton_results.x.lepton) > 0.4, axis=2)
+        delta_r_cleaning_mask(events.Jet, lepton_results.x.lepton, min_dr=0.4)
     )
     # apply loose Jet puId to jets with pt below 50 GeV (not in Run3 samples so skip this for now)
     if self.config_inst.x.run == 2:
@@ -67,7 +68,7 @@ def sl_jet_selection(
     btag_sel = events.cutflow.n_deepjet_med >= 1
 
     # define b-jets as the two b-score leading jets, b-score sorted
-    bjet_indices = masked_sorted_indices(jet_mask, events.Jet.btagDeepFlavB)[:, :2]
+    bjet_indices = masked_sorted_indices(jet_mask, events.Jet.btagDeepFlavB, k=2)
 
     # define lightjets as all non b-jets, pt-sorted
     b_idx = ak.fill_none(ak.pad_none(bjet_indices, 2), -1)
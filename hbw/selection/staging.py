@@ -0,0 +1,302 @@
+# coding: utf-8
+
+"""
+Helpers to run selection modules in stages. After each stage, only events that passed all stages so
+far are evaluated by the following steps. Their results (steps, object indices and aux arrays) and
+produced columns are scattered back to the full event length, while rejected events get cheap
+defaults (*False* step masks, empty object indices and zero or empty aux arrays).
+"""
+
+from __future__ import annotations
+
+from functools import reduce
+from operator import and_
+from typing import Any, Callable, Iterable, Sequence
+
+import law
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import (
+    Route, EMPTY_FLOAT, EMPTY_INT, get_ak_routes, has_ak_column, set_ak_column,
+)
+from columnflow.selection import SelectionResult
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+def _default_fill_value(dtype: np.dtype, empty: bool = True):
+    if dtype.kind == "b":
+        return False
+    if not empty:
+        return 0
+    return EMPTY_INT if dtype.kind in "iu" else EMPTY_FLOAT
+
+
+def _to_numpy(array: ak.Array) -> np.ndarray:
+    # convert to numpy, replacing missing values (if any) with EMPTY_FLOAT or EMPTY_INT
+    array = ak.to_numpy(array)
+    if isinstance(array, np.ma.MaskedArray):
+        array = array.filled(_default_fill_value(array.dtype))
+    return array
+
+
+def _object_positions(offsets: np.ndarray, indices: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # flat positions of the objects of the events at *indices* (with *counts* objects each) in a
+    # collection with *offsets*
+    starts = np.repeat(offsets[indices] - np.cumsum(counts) + counts, counts)
+    return starts + np.arange(counts.sum())
+
+
+def scatter_array(
+    parts: Sequence[tuple[np.ndarray, ak.Array | None]],
+    n_events: int,
+    counts: np.ndarray | None = None,
+    fill_value=None,
+    base: ak.Array | None = None,
+    empty: bool = True,
+) -> ak.Array:
+    """
+    Scatters arrays, each evaluated on the subset of events at positions *indices* given as a
+    sequence of (indices, array) *parts*, into one array of length *n_events*. Flat arrays are
+    filled with *fill_value* for events not covered by any part. Jagged arrays get empty lists for
+    these events (and for parts whose array is *None*) or, when the per-event *counts* of the full
+    collection are given, the content of *base* (or *fill_value*) for their objects.
+    """
+    arrays = [array for _, array in parts if array is not None]
+    if not arrays:
+        raise ValueError("cannot scatter parts without any array")
+    ndim = arrays[0].ndim
+
+    if ndim == 1:
+        contents = [(indices, _to_numpy(array)) for indices, array in parts if array is not None]
+        dtype = np.result_type(*(content.dtype for _, content in contents))
+        if fill_value is None:
+            fill_value = _default_fill_value(dtype, empty=empty)
+        full = np.full(n_events, fill_value, dtype=dtype)
+        for indices, content in contents:
+            full[indices] = content
+        return ak.Array(full)
+
+    if ndim != 2:
+        raise ValueError(f"cannot scatter array with {ndim} dimensions")
+
+    # per-event counts, either of the full collection or of the parts
+    part_counts = [
+        (indices, ak.to_numpy(ak.num(array, axis=1)) if array is not None else None)
+        for indices, array in parts
+    ]
+    if counts is None:
+        counts = np.zeros(n_events, dtype=np.int64)
+        for indices, _counts in part_counts:
+            if _counts is not None:
+                counts[indices] = _counts
+    offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    contents = [
+        (indices, _counts, _to_numpy(ak.flatten(array, axis=1)))
+        for (indices, _counts), (_, array) in zip(part_counts, parts)
+        if array is not None
+    ]
+    dtype = np.result_type(*(content.dtype for _, _, content in contents))
+    if base is not None:
+        full = _to_numpy(ak.flatten(base, axis=1)).astype(dtype)
+    else:
+        if fill_value is None:
+            fill_value = _default_fill_value(dtype, empty=empty)
+        full = np.full(offsets[-1], fill_value, dtype=dtype)
+    for indices, _counts, content in contents:
+        full[_object_positions(offsets, indices, _counts)] = content
+
+    return ak.unflatten(full, counts)
+
+
+def mask_selection_result(results: SelectionResult, mask: np.ndarray) -> SelectionResult:
+    """
+    Returns a new :py:class:`SelectionResult` with the event *mask* applied to all per-event arrays
+    contained in *results*.
+    """
+    n_events = len(mask)
+
+    def apply_mask(obj):
+        if isinstance(obj, (ak.Array, np.ndarray)) and len(obj) == n_events:
+            return obj[mask]
+        return obj
+
+    def map_struct(struct):
+        return law.util.map_struct(apply_mask, struct, map_dict=True)
+
+    return SelectionResult(
+        event=apply_mask(results.event),
+        steps=map_struct(dict(results.steps)),
+        objects=map_struct(dict(results.objects)),
+        aux=map_struct(dict(results.aux)),
+        **map_struct(dict(results.other)),
+    )
+
+
+def scatter_selection_results(
+    parts: Sequence[tuple[np.ndarray, SelectionResult]],
+    events: ak.Array,
+    aux_collections: dict[str, str] | None = None,
+    aux_fill_values: dict[str, Any] | None = None,
+) -> SelectionResult:
+    """
+    Scatters the :py:class:`SelectionResult` objects of (indices, results) *parts*, each evaluated
+    on the subset of *events* at positions *indices*, into one result of the full event length.
+    For events not covered by any part, step masks are *False*, object indices are empty lists and
+    flat aux arrays are zero, or the value given for their key in *aux_fill_values*. Jagged aux
+    arrays listed in *aux_collections* are aligned to the objects of the mapped collection in
+    *events* (e.g. ``{"jet_mask": "Jet"}``), all other jagged arrays get empty lists.
+    """
+    n_events = len(events)
+    aux_collections = aux_collections or {}
+    aux_fill_values = aux_fill_values or {}
+
+    def is_per_event(values: list) -> bool:
+        return all(
+            isinstance(value, (ak.Array, np.ndarray)) and len(value) == len(indices)
+            for value, (indices, _) in zip(values, parts)
+        )
+
+    def scatter(values: list, counts: np.ndarray | None = None, fill_value=None) -> Any:
+        first = values[0]
+        if isinstance(first, dict):
+            return {key: scatter([value[key] for value in values], counts, fill_value) for key in first}
+        if not is_per_event(values):
+            return first
+        return scatter_array(
+            [(indices, ak.Array(value)) for value, (indices, _) in zip(values, parts)],
+            n_events,
+            counts=counts,
+            fill_value=fill_value,
+            empty=False,
+        )
+
+    results = [part[1] for part in parts]
+
+    aux = {}
+    for key in results[0].aux:
+        counts = None
+        if key in aux_collections:
+            counts = ak.to_numpy(ak.num(events[aux_collections[key]], axis=1))
+        aux[key] = scatter([result.aux[key] for result in results], counts, aux_fill_values.get(key))
+
+    event = None
+    if results[0].event is not None:
+        event = scatter([result.event for result in results])
+
+    return SelectionResult(
+        event=event,
+        steps=scatter([dict(result.steps) for result in results]),
+        objects=scatter([dict(result.objects) for result in results]),
+        aux=aux,
+        **scatter([dict(result.other) for result in results]),
+    )
+
+
+def scatter_events(
+    events: ak.Array,
+    parts: Sequence[tuple[np.ndarray, ak.Array]],
+    routes: Iterable[Route],
+) -> ak.Array:
+    """
+    Writes the *routes* of the (indices, sub_events) *parts*, each covering the events at positions
+    *indices*, back into the full *events*. For objects of events that are not covered by any part,
+    existing columns keep their values and new columns are filled with EMPTY_FLOAT or EMPTY_INT.
+    """
+    n_events = len(events)
+
+    for route in routes:
+        sub_columns = [(indices, route.apply(sub_events)) for indices, sub_events in parts]
+
+        base, counts = None, None
+        if sub_columns[0][1].ndim > 1:
+            parent = Route(route[:-1])
+            if has_ak_column(events, route):
+                base = route.apply(events)
+                counts = ak.to_numpy(ak.num(base, axis=1))
+            elif parent and has_ak_column(events, parent):
+                counts = ak.to_numpy(ak.num(parent.apply(events), axis=1))
+
+        events = set_ak_column(
+            events,
+            route,
+            scatter_array(sub_columns, n_events, counts=counts, base=base),
+        )
+
+    return events
+
+
+def staged_selection(
+    events: ak.Array,
+    results: SelectionResult,
+    selection_steps: Sequence[tuple[str, Callable, set[Route | str]]],
+    stages: dict[str, Sequence[str]],
+    aux_collections: dict[str, str] | None = None,
+    aux_fill_values: dict[str, Any] | None = None,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Runs the *selection_steps*, a sequence of (name, func, produces) tuples where each func is
+    called as ``func(events, results)`` and returns new events and a :py:class:`SelectionResult`,
+    and *produces* are the routes of columns that the step adds or changes.
+    After a step whose name is a key of *stages* (or before the first step, for the key
+    ``"pre_selection"`` referring to the given *results*), events failing any of the listed results
+    steps are rejected and not passed to any of the following steps.
+
+    Results of the following steps are filled with defaults for rejected events (see
+    :py:func:`scatter_selection_results`, using *aux_collections* and *aux_fill_values*). Thus,
+    step masks of later steps only count events that passed all previous stages, and aux arrays
+    (e.g. the jet multiplicity used to group stats) hold the fill values for rejected events. The
+    *produces* routes, as well as all routes that are added by a step, are written back to the full
+    *events*, keeping existing values and filling new columns with EMPTY_FLOAT or EMPTY_INT for
+    rejected events (see :py:func:`scatter_events`).
+    """
+    n_events = len(events)
+
+    # indices, events and results of events passing all stages so far
+    indices, sub_events, sub_results = np.arange(n_events), events, results
+
+    def split(stage: str) -> None:
+        nonlocal indices, sub_events, sub_results
+        stage_mask = reduce(and_, [np.asarray(sub_results.steps[step]) for step in stages[stage]])
+        logger.debug(f"stage '{stage}': {stage_mask.sum()} of {len(stage_mask)} events pass")
+        if stage_mask.all():
+            return
+        indices, sub_events = indices[stage_mask], sub_events[stage_mask]
+        sub_results = mask_selection_result(sub_results, stage_mask)
+
+    if "pre_selection" in stages:
+        split("pre_selection")
+
+    for name, func, produces in selection_steps:
+        patterns = [Route(route).column for route in produces]
+        old_routes = set(get_ak_routes(sub_events))
+        sub_events, step_results = func(sub_events, sub_results)
+        sub_results += step_results
+
+        if len(indices) == n_events:
+            # no event was rejected so far, so sub_results is still the given results instance
+            # and was updated in-place
+            events = sub_events
+        else:
+            # added routes and produced routes that exist after the step
+            routes = [
+                route for route in get_ak_routes(sub_events)
+                if route not in old_routes or law.util.multi_match(route.column, patterns)
+            ]
+            events = scatter_events(events, [(indices, sub_events)], routes)
+            results += scatter_selection_results(
+                [(indices, step_results)],
+                events,
+                aux_collections=aux_collections,
+                aux_fill_values=aux_fill_values,
+            )
+
+        if name in stages:
+            split(name)
+
+    return events, results
@@ -4,7 +4,12 @@
 Stat-related methods.
 """
 
+from __future__ import annotations
+
 from collections import defaultdict, OrderedDict
+from functools import reduce
+from operator import getitem
+from typing import Sequence
 
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.selection.stats import increment_stats
@@ -13,12 +18,133 @@ from hbw.production.weights import event_weights_to_normalize
 from columnflow.columnar_util import optional_column as optional
 
 from columnflow.util import maybe_import
-from hbw.util import has_tag
+from hbw.util import has_tag, njit
+from hbw.selection.stats_arrays import weight_sketch_bins
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+@njit
+def _grouped_sum_kernel(weights, group_index, n_groups):
+    n_weights, n_events = weights.shape
+    sums = np.zeros((n_weights, n_groups), dtype=np.float64)
+    for w in range(n_weights):
+        for i in range(n_events):
+            sums[w, group_index[i]] += weights[w, i]
+    return sums
+
+
+def _nested_defaultdict(dtype: type, depth: int) -> defaultdict:
+    if depth <= 1:
+        return defaultdict(dtype)
+    return defaultdict(lambda: _nested_defaultdict(dtype, depth - 1))
+
+
+def increment_grouped_stats(
+    stats: dict,
+    n_events: int,
+    weight_map: dict[str, ak.Array | tuple[ak.Array, ak.Array]],
+    group_map: dict[str, ak.Array],
+    group_combinations: Sequence[tuple[str]] | None = None,
+) -> None:
+    """
+    Increments *stats* in-place with the same layout as columnflow's :py:class:`increment_stats`,
+    but all entries of the *weight_map* are reduced in a single pass. Each event gets one integer
+    index for its combination of values in *group_map* (mapping group names to per-event values,
+    e.g. ``{"process": events.process_id, "njet": n_jets}``), and all weights are summed into a
+    dense (weights x groups) matrix, that is only converted into the nested stats dictionaries at
+    the end. Each group is stored on its own and in all *group_combinations*.
+
+    Entries in *weight_map* follow the conventions of :py:class:`increment_stats`: "num" entries
+    refer to an event mask (or *Ellipsis*), "sum" entries to weights or a (weights, mask) tuple.
+    """
+    group_names = list(group_map.keys())
+
+    # dense group index per event
+    unique_values, group_indices = [], []
+    for values in group_map.values():
+        _unique, _index = np.unique(np.asarray(values), return_inverse=True)
+        unique_values.append(_unique)
+        group_indices.append(_index.reshape(-1))
+    shape = tuple(len(u) for u in unique_values)
+    group_index = (
+        np.ravel_multi_index(group_indices, shape)
+        if group_names else np.zeros(n_events, dtype=np.int64)
+    )
+
+    # build the masked weight matrix
+    weight_names, weight_types, weight_rows = [], [], []
+    for weight_name, obj in weight_map.items():
+        if weight_name.startswith("num"):
+            if isinstance(obj, (tuple, list)):
+                raise Exception(
+                    f"weight map entry '{weight_name}' should refer to a mask, but found a sequence: {obj}",
+                )
+            weights, mask, dtype = np.ones(n_events), obj, int
+        elif weight_name.startswith("sum"):
+            weights, mask = (tuple(obj) + (Ellipsis,))[:2] if isinstance(obj, (tuple, list)) else (obj, Ellipsis)
+            weights, dtype = np.asarray(weights, dtype=np.float64), float
+        else:
+            raise Exception(
+                f"weight '{weight_name}' starting with unknown operation; should either start with "
+                "'num' or 'sum'",
+            )
+
+        if mask is not Ellipsis:
+            weights = np.where(np.asarray(mask), weights, 0.0)
+
+        weight_names.append(weight_name)
+        weight_types.append(dtype)
+        weight_rows.append(weights)
+
+    if not weight_rows:
+        return
+
+    sums = _grouped_sum_kernel(np.stack(weight_rows), group_index, int(np.prod(shape)))
+    sums = sums.reshape((len(weight_rows),) + shape)
+
+    # treat groups as combinations of a single group
+    group_combinations = [(g,) for g in group_names] + [
+        combination for combination in (group_combinations or [])
+        if len(combination) > 1
+    ]
+
+    # convert the matrix into the nested stats layout
+    for weight_name, dtype, weight_sums in zip(weight_names, weight_types, sums):
+        stats[weight_name] += dtype(weight_sums.sum())
+
+        for combination in group_combinations:
+            # sum over all other groups and bring axes into the order of the combination
+            axes = tuple(i for i, g in enumerate(group_names) if g not in combination)
+            kept = [g for g in group_names if g in combination]
+            combination_sums = weight_sums.sum(axis=axes).transpose([kept.index(g) for g in combination])
+
+            group_key = f"{weight_name}_per_" + "_and_".join(combination)
+            if group_key not in stats:
+                stats[group_key] = _nested_defaultdict(dtype, len(combination))
+
+            combination_values = [unique_values[group_names.index(g)] for g in combination]
+            for index in np.ndindex(combination_sums.shape):
+                str_values = [str(values[i]) for values, i in zip(combination_values, index)]
+                innermost_dict = reduce(getitem, [stats[group_key]] + str_values[:-1])
+                innermost_dict[str_values[-1]] += dtype(combination_sums[index])
+
+
+def increment_weight_sketch(stats: dict, mc_weight: ak.Array) -> None:
+    """
+    Increments the quantile sketch of the absolute *mc_weight* in *stats* in-place, which is used
+    for dataset-level thresholds of the large_weights_killer (see
+    :py:func:`~hbw.selection.stats_arrays.weight_sketch_bins`).
+    """
+    increment_grouped_stats(
+        stats,
+        len(mc_weight),
+        weight_map={"num_events_weight_sketch": Ellipsis},
+        group_map={"abs_mc_weight_bin": weight_sketch_bins(mc_weight)},
+    )
+
+
 @selector(
     uses={increment_stats, optional("mc_weight")},
 )
@@ -52,7 +178,7 @@ def hbw_selection_step_stats(
 
 
 @selector(
-    uses={increment_stats, event_weights_to_normalize},
+    uses={event_weights_to_normalize},
 )
 def hbw_increment_stats(
     self: Selector,
@@ -112,26 +238,19 @@ def hbw_increment_stats(
                 )
 
     group_map = {
-        "process": {
-            "values": events.process_id,
-            "mask_fn": (lambda v: events.process_id == v),
-        },
-        "njet": {
-            "values": results.x.n_central_jets,
-            "mask_fn": (lambda v: n_jets == v),
-        },
+        "process": events.process_id,
+        "njet": n_jets,
     }
 
     group_combinations = [("process", "njet")]
 
-    self[increment_stats](
-        events,
-        results,
+    # reduce all weights in a single pass per (process, njet) group
+    increment_grouped_stats(
         stats,
+        len(events),
         weight_map=weight_map,
         group_map=group_map,
         group_combinations=group_combinations,
-        **kwargs,
     )
 
     return events
@@ -0,0 +1,249 @@
+# coding: utf-8
+
+"""
+Dense array format of the selection stats, with one named array per stats entry and shared labels
+per group axis (e.g. process ids and jet multiplicities), that can be merged and loaded without
+traversing nested dictionaries.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+
+
+# prefix of the entries storing the labels of each group axis in the dense stats format
+STATS_AXIS_PREFIX = "__axis__"
+
+
+def _stats_key_groups(key: str) -> list[str]:
+    # names of the groups of a stats entry, e.g. ["process", "njet"] for "..._per_process_and_njet"
+    if key.startswith(STATS_AXIS_PREFIX) or "_per_" not in key:
+        return []
+    return key.rsplit("_per_", 1)[1].split("_and_")
+
+
+def _stats_labels(values: set[str]) -> np.ndarray:
+    # sorted axis labels, stored as integers when possible (e.g. process ids and jet multiplicities)
+    values = sorted(map(str, values))
+    if all(v.lstrip("-").isdigit() for v in values):
+        return np.array(sorted(map(int, values)), dtype=np.int64)
+    return np.array(values, dtype=str)
+
+
+def stats_to_arrays(stats: dict) -> dict[str, np.ndarray]:
+    """
+    Converts the nested *stats* dictionary, as written by SelectEvents, into a flat dictionary of
+    dense arrays. Entries without groups are stored as 0-dimensional arrays, grouped entries such
+    as ``"sum_mc_weight_per_process_and_njet"`` as arrays with one axis per group. The labels of
+    each group axis (e.g. the process ids) are shared by all entries and stored under the key
+    ``STATS_AXIS_PREFIX + group``. Combinations that are missing in *stats* are filled with zeros.
+    """
+    # collect the labels of all groups, including groups without any entry (e.g. for empty chunks)
+    labels = defaultdict(set)
+
+    def collect(obj: dict, groups: list[str]) -> None:
+        if not groups:
+            return
+        for label, value in obj.items():
+            labels[groups[0]].add(str(label))
+            collect(value, groups[1:])
+
+    for key, obj in stats.items():
+        groups = _stats_key_groups(key)
+        for group in groups:
+            labels.setdefault(group, set())
+        collect(obj, groups)
+
+    axes = {group: _stats_labels(values) for group, values in labels.items()}
+    label_index = {
+        group: {str(label): i for i, label in enumerate(axis)}
+        for group, axis in axes.items()
+    }
+
+    arrays = {f"{STATS_AXIS_PREFIX}{group}": axis for group, axis in axes.items()}
+    for key, obj in stats.items():
+        groups = _stats_key_groups(key)
+        array = np.zeros(
+            tuple(len(axes[group]) for group in groups),
+            dtype=np.int64 if key.startswith("num") else np.float64,
+        )
+
+        def fill(obj, index: tuple) -> None:
+            if len(index) == len(groups):
+                array[index] = obj
+                return
+            group = groups[len(index)]
+            for label, value in obj.items():
+                fill(value, index + (label_index[group][str(label)],))
+
+        fill(obj, ())
+        arrays[key] = array
+
+    return arrays
+
+
+def arrays_to_stats(arrays: dict[str, np.ndarray]) -> dict:
+    """
+    Converts dense stats *arrays* (see :py:func:`stats_to_arrays`) back into the nested dictionary
+    layout with string keys, e.g. to export them as json.
+    """
+    stats = {}
+    for key, array in arrays.items():
+        if key.startswith(STATS_AXIS_PREFIX):
+            continue
+
+        labels = [
+            list(map(str, arrays[f"{STATS_AXIS_PREFIX}{group}"]))
+            for group in _stats_key_groups(key)
+        ]
+
+        def nest(array: np.ndarray, labels: list[list[str]]):
+            if not labels:
+                return array.item()
+            return {label: nest(sub_array, labels[1:]) for label, sub_array in zip(labels[0], array)}
+
+        stats[key] = nest(array, labels)
+
+    return stats
+
+
+def _union_labels(labels1: np.ndarray, labels2: np.ndarray) -> np.ndarray:
+    # sorted union of two axes, where empty axes (of any dtype) are ignored
+    if not len(labels1):
+        return np.asarray(labels2)
+    if not len(labels2):
+        return np.asarray(labels1)
+    return np.union1d(labels1, labels2)
+
+
+def _label_positions(axis: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    # positions of *labels* in the sorted *axis*
+    if not len(labels):
+        return np.zeros(0, dtype=np.int64)
+    return np.searchsorted(axis, labels)
+
+
+def merge_stats_arrays(*arrays_list: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Merges any number of dense stats arrays (see :py:func:`stats_to_arrays`) by building the union
+    of all group axis labels and summing all entries, each with a single vectorized scatter-add.
+    """
+    # union of all axis labels
+    axes = {}
+    for arrays in arrays_list:
+        for key, labels in arrays.items():
+            if not key.startswith(STATS_AXIS_PREFIX):
+                continue
+            group = key[len(STATS_AXIS_PREFIX):]
+            axes[group] = _union_labels(axes[group], labels) if group in axes else np.asarray(labels)
+
+    merged = {f"{STATS_AXIS_PREFIX}{group}": axis for group, axis in axes.items()}
+    for arrays in arrays_list:
+        for key, array in arrays.items():
+            if key.startswith(STATS_AXIS_PREFIX):
+                continue
+
+            groups = _stats_key_groups(key)
+            if key not in merged:
+                merged[key] = np.zeros(tuple(len(axes[group]) for group in groups), dtype=array.dtype)
+
+            # positions of the labels of this input in the merged axes
+            index = np.ix_(*(
+                _label_positions(axes[group], arrays[f"{STATS_AXIS_PREFIX}{group}"])
+                for group in groups
+            ))
+            merged[key][index] += array
+
+    return merged
+
+
+def load_stats_arrays(target) -> dict[str, np.ndarray]:
+    """
+    Loads dense stats arrays from an npz file *target* (or json file, for stats written by
+    SelectEvents), that can directly be used by producers.
+    """
+    if target.path.endswith(".json"):
+        return stats_to_arrays(target.load(formatter="json", cache=False))
+
+    with target.load(formatter="numpy") as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def get_stats_array(arrays: dict[str, np.ndarray], key: str) -> np.ndarray:
+    """
+    Returns the entry *key* of the dense stats *arrays*, or zeros with the shape of its group axes
+    when the entry does not exist.
+    """
+    if key in arrays:
+        return arrays[key]
+    return np.zeros(
+        tuple(len(arrays[f"{STATS_AXIS_PREFIX}{group}"]) for group in _stats_key_groups(key)),
+        dtype=np.float64,
+    )
+
+
+def dense_label_map(labels: np.ndarray) -> np.ndarray:
+    """
+    Builds a dense map from non-negative integer axis *labels* (e.g. process ids) to their
+    positions, to be used with :py:func:`map_labels`. Values that are not part of *labels* are
+    mapped to ``len(labels)``, so that tables with one additional (default) row can be used.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if len(labels) and labels.min() < 0:
+        raise ValueError(f"dense label maps require non-negative labels, got {labels.min()}")
+    label_map = np.full((labels.max() + 2) if len(labels) else 1, len(labels), dtype=np.int64)
+    label_map[labels] = np.arange(len(labels))
+    return label_map
+
+
+def map_labels(label_map: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Returns the positions of the integer *values* in the axis labels of the dense *label_map*
+    (see :py:func:`dense_label_map`), with a single gather.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    in_range = (values >= 0) & (values < len(label_map) - 1)
+    return label_map[np.where(in_range, values, len(label_map) - 1)]
+
+
+# relative accuracy of the logarithmic quantile sketch of absolute weights, i.e., the relative
+# width of its bins, and the bin index reserved for weights of zero
+WEIGHT_SKETCH_ACCURACY = 0.005
+WEIGHT_SKETCH_ZERO_BIN = -(2 ** 31)
+_weight_sketch_gamma = (1 + WEIGHT_SKETCH_ACCURACY) / (1 - WEIGHT_SKETCH_ACCURACY)
+
+
+def weight_sketch_bins(weights: np.ndarray) -> np.ndarray:
+    """
+    Returns the bins of the absolute *weights* in a logarithmic quantile sketch with relative
+    accuracy :py:attr:`WEIGHT_SKETCH_ACCURACY`. Since the bins do not depend on the data, sketches
+    are merged by summing the counts per bin, i.e., they can be stored in the selection stats.
+    """
+    abs_weights = np.abs(np.asarray(weights, dtype=np.float64))
+    bins = np.full(len(abs_weights), WEIGHT_SKETCH_ZERO_BIN, dtype=np.int64)
+    nonzero = abs_weights > 0
+    bins[nonzero] = np.ceil(np.log(abs_weights[nonzero]) / np.log(_weight_sketch_gamma))
+    return bins
+
+
+def weight_sketch_quantile(bins: np.ndarray, counts: np.ndarray, q: float) -> float:
+    """
+    Returns the *q* quantile of the absolute weights in a sketch with *counts* per sorted *bins*
+    (see :py:func:`weight_sketch_bins`), with the same rank as the element at ``int(q * n)`` of the
+    *n* sorted weights, up to the relative accuracy of the sketch.
+    """
+    cumulative_counts = np.cumsum(counts)
+    if not len(counts) or cumulative_counts[-1] <= 0:
+        raise ValueError("cannot compute the quantile of an empty weight sketch")
+
+    rank = min(int(q * cumulative_counts[-1]), cumulative_counts[-1] - 1)
+    bin_index = int(bins[np.searchsorted(cumulative_counts, rank, side="right")])
+    if bin_index == WEIGHT_SKETCH_ZERO_BIN:
+        return 0.0
+
+    # center of the bin with the smallest maximum relative error
+    return 2 * _weight_sketch_gamma ** bin_index / (_weight_sketch_gamma + 1)
@@ -15,6 +15,7 @@ from columnflow.util import maybe_import
 from columnflow.columnar_util import get_ak_routes, update_ak_array
 
 from hbw.tasks.base import HBWTask, ColumnsBaseTask
+from hbw.config.categories import get_leaf_categories, walk_categories
 
 ak = maybe_import("awkward")
 
@@ -49,8 +50,8 @@ class CheckConfig(
         config = self.config_inst
         dataset = self.dataset_inst
         variables = config.variables
-        all_cats = [cat for cat, _, _ in config.walk_categories()]
-        leaf_cats = config.get_leaf_categories()
+        all_cats = [cat for cat, _, _ in walk_categories(config)]
+        leaf_cats = get_leaf_categories(config)
         processes = [proc for proc, _, _ in config.walk_processes()]  # noqa
 
         self.publish_message(
@@ -25,6 +25,7 @@ from columnflow.tasks.framework.decorators import view_output_plots
 from columnflow.tasks.plotting import PlotVariables1D, PlotShiftedVariables1D
 # from columnflow.tasks.framework.remote import RemoteWorkflow
 from hbw.tasks.base import HBWTask
+from hbw.config.categories import get_category
 
 from columnflow.util import dev_sandbox, DotDict, maybe_import
 
@@ -347,7 +348,7 @@ class PlotPostfitShapes(
             if has_category:
                 # TODO: category/variable customization based on inference model?
                 inference_category = self.inference_model_inst.get_category(channel)
-                config_category = self.config_inst.get_category(inference_category.config_category)
+                config_category = get_category(self.config_inst, inference_category.config_category)
                 variable_inst = self.config_inst.get_variable(inference_category.config_variable)
             else:
                 # default to dummy Category and Variable
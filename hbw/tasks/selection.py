@@ -0,0 +1,90 @@
+# coding: utf-8
+
+"""
+Custom tasks related to the selection.
+"""
+
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.framework.mixins import CalibratorsMixin, SelectorMixin
+from columnflow.tasks.selection import SelectEvents
+from columnflow.util import dev_sandbox
+
+from hbw.tasks.base import HBWTask
+
+
+class MergeSelectionStatsArrays(
+    HBWTask,
+    SelectorMixin,
+    CalibratorsMixin,
+    DatasetTask,
+    law.tasks.ForestMerge,
+):
+    """
+    Variant of MergeSelectionStats that stores the selection stats as dense arrays with one axis
+    per group (e.g. process and njet) in an npz file, which are merged in a vectorized way and can
+    be loaded by producers without parsing the nested json. A json export of the merged stats is
+    kept for humans.
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # merge 25 stats files into 1 at every step of the merging cascade
+    merge_factor = 25
+
+    # skip receiving some parameters via req
+    exclude_params_req_get = {"workflow"}
+
+    # upstream requirements
+    reqs = Requirements(
+        SelectEvents=SelectEvents,
+    )
+
+    def create_branch_map(self):
+        # DatasetTask implements a custom branch map, but we want to use the one in ForestMerge
+        return law.tasks.ForestMerge.create_branch_map(self)
+
+    def merge_workflow_requires(self):
+        return self.reqs.SelectEvents.req(self, _exclude={"branches"})
+
+    def merge_requires(self, start_branch, end_branch):
+        return self.reqs.SelectEvents.req(
+            self,
+            branches=((start_branch, end_branch),),
+            workflow="local",
+            _exclude={"branch"},
+        )
+
+    def merge_output(self):
+        return {
+            "stats": self.target("stats.npz"),
+            "stats_json": self.target("stats.json"),
+        }
+
+    def output(self):
+        output = super().output()
+
+        # the json export is only written by the final merge
+        if not self.is_forest() and not self.is_root():
+            output = {"stats": output["stats"]}
+
+        return output
+
+    def trace_merge_inputs(self, inputs):
+        return super().trace_merge_inputs(inputs["collection"].targets.values())
+
+    @law.decorator.log
+    def run(self):
+        return super().run()
+
+    def merge(self, inputs, output):
+        from hbw.selection.stats_arrays import load_stats_arrays, merge_stats_arrays, arrays_to_stats
+
+        # leaves merge the json stats of SelectEvents, all other nodes the arrays of the previous depth
+        merged_stats = merge_stats_arrays(*(load_stats_arrays(inp["stats"]) for inp in inputs))
+
+        # write the output
+        output["stats"].dump(formatter="numpy", **merged_stats)
+        if "stats_json" in output:
+            output["stats_json"].dump(arrays_to_stats(merged_stats), indent=4, formatter="json", cache=False)
@@ -15,12 +15,320 @@ import tracemalloc
 import law
 
 from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, EMPTY_FLOAT, set_ak_column
 
 np = maybe_import("numpy")
+ak = maybe_import("awkward")
+numba = maybe_import("numba")
 
 _logger = law.logger.get_logger(__name__)
 
 
+def njit(func: Callable | None = None, **kwargs) -> Callable:
+    """
+    Decorator that compiles *func* via :py:func:`numba.njit`, passing all *kwargs*. Can be used
+    with and without arguments. When numba is not available (e.g. outside of the columnar sandbox),
+    the undecorated python function is returned, so that modules defining kernels can always be
+    imported.
+    """
+    def decorator(_func: Callable) -> Callable:
+        if not numba:
+            return _func
+        return numba.njit(**kwargs)(_func)
+
+    return decorator(func) if func is not None else decorator
+
+
+def flat_offsets(array: ak.Array) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Helper to obtain the flat numpy content and the offsets (starting at 0) of a jagged array
+    *array* with exactly one jagged dimension, e.g. a column of an object collection.
+
+    :param array: Jagged awkward array of numbers (e.g. ``events.Jet.pt``).
+    :return: Tuple of the flat content and the int64 offsets with length ``len(array) + 1``.
+    """
+    counts = ak.to_numpy(ak.num(array, axis=1))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    content = ak.to_numpy(ak.flatten(array, axis=1))
+    return content, offsets
+
+
+def flat_record_buffers(
+    collection: ak.Array,
+    fields: Iterable[str],
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Helper to obtain the offsets and the flat numpy buffers of some *fields* of a jagged
+    *collection* (e.g. ``events.Jet``) without copying them, as long as the collection is stored
+    as list offsets of records (otherwise it is packed first). The buffers are indexed directly
+    by the offsets, which do not necessarily start at 0. Jagged arrays with the same structure can
+    be built from new buffers via :py:func:`from_flat_buffer`.
+
+    :param collection: Jagged awkward array of records with exactly one jagged dimension.
+    :param fields: Names of the fields whose buffers should be returned.
+    :return: Tuple of the int64 offsets and a dictionary mapping fields to their flat buffers.
+    """
+    def is_flat(layout) -> bool:
+        return (
+            isinstance(layout, ak.contents.ListOffsetArray) and
+            isinstance(layout.content, ak.contents.RecordArray) and
+            all(isinstance(layout.content.content(field), ak.contents.NumpyArray) for field in fields)
+        )
+
+    fields = list(fields)
+    layout = ak.to_layout(collection)
+    if not is_flat(layout):
+        layout = ak.to_layout(ak.to_packed(collection))
+        if not is_flat(layout):
+            raise ValueError(f"cannot obtain flat buffers of fields {fields} of {collection.type}")
+
+    offsets = np.asarray(layout.offsets).astype(np.int64, copy=False)
+    buffers = {
+        field: ak.to_numpy(ak.Array(layout.content.content(field)))
+        for field in fields
+    }
+    return offsets, buffers
+
+
+def from_flat_buffer(offsets: np.ndarray, values: np.ndarray) -> ak.Array:
+    """
+    Helper to build a jagged array from the *offsets* and a flat buffer of *values*, as obtained
+    from :py:func:`flat_record_buffers`, without copying either of them.
+    """
+    return ak.Array(ak.contents.ListOffsetArray(
+        ak.index.Index64(offsets),
+        ak.contents.NumpyArray(values),
+    ))
+
+
+def set_flat_record_fields(
+    collection: ak.Array,
+    offsets: np.ndarray,
+    buffers: dict[str, np.ndarray],
+) -> ak.Array:
+    """
+    Helper to add (or replace) many fields of a jagged *collection* of records at once from flat
+    *buffers* that are indexed by the *offsets*, as obtained from :py:func:`flat_record_buffers` for
+    the same collection. The new record is built directly from the existing contents and the
+    buffers, instead of one :py:func:`set_ak_column` call per field.
+
+    :param collection: Jagged awkward array of records with exactly one jagged dimension.
+    :param offsets: Offsets of the collection, as returned by :py:func:`flat_record_buffers`.
+    :param buffers: Mapping of field names to flat buffers.
+    :raises ValueError: If the *offsets* and *buffers* do not match the collection.
+    :return: New collection with all *buffers* added as fields.
+    """
+    def matches(layout) -> bool:
+        return (
+            isinstance(layout, ak.contents.ListOffsetArray) and
+            isinstance(layout.content, ak.contents.RecordArray) and
+            all(len(values) == layout.content.length for values in buffers.values()) and
+            np.array_equal(np.asarray(layout.offsets), offsets)
+        )
+
+    layout = ak.to_layout(collection)
+    if not matches(layout):
+        layout = ak.to_layout(ak.to_packed(collection))
+        if not matches(layout):
+            raise ValueError(f"offsets and buffers of fields {list(buffers)} do not match {collection.type}")
+
+    record = layout.content
+    contents = {
+        field: record.content(field)
+        for field in record.fields
+        if field not in buffers
+    }
+    contents.update({
+        field: ak.contents.NumpyArray(values)
+        for field, values in buffers.items()
+    })
+
+    return ak.Array(
+        ak.contents.ListOffsetArray(
+            layout.offsets,
+            ak.contents.RecordArray(
+                list(contents.values()),
+                list(contents.keys()),
+                length=record.length,
+                parameters=record.parameters,
+            ),
+            parameters=layout.parameters,
+        ),
+        behavior=collection.behavior,
+    )
+
+
+def set_ak_columns(events: ak.Array, columns: dict[str, ak.Array | np.ndarray]) -> ak.Array:
+    """
+    Helper to set many top-level *columns* of *events* at once. Existing columns with the same
+    names are replaced, all other fields are kept, and the new record is built in a single
+    :py:func:`ak.zip` instead of one :py:func:`set_ak_column` call per column.
+
+    :param events: Awkward array of records (e.g. events).
+    :param columns: Mapping of top-level field names to flat per-event columns.
+    :return: New awkward array with all *columns* added or replaced.
+    """
+    fields = {
+        field: events[field]
+        for field in events.fields
+        if field not in columns
+    }
+    fields.update(columns)
+
+    return ak.zip(
+        fields,
+        depth_limit=1,
+        with_name=ak.parameters(events).get("__record__"),
+        behavior=events.behavior,
+    )
+
+
+class ColumnBatch(object):
+    """
+    Helper to collect many flat per-event columns (e.g. ML input features) as numpy buffers of
+    type *dtype*, that are only attached to the events at the very end via
+    :py:func:`set_ak_columns`. When *fill_value* is set, all missing and NaN values of all columns
+    are replaced with *fill_value* in one go.
+
+    .. code-block:: python
+
+        batch = ColumnBatch(len(events), fill_value=-10)
+        batch["mli_ht"] = ak.sum(events.Jet.pt, axis=1)
+        batch["mli_mbb"] = hbb.mass
+        events = batch.attach(events)
+    """
+
+    def __init__(self, n_events: int, dtype: type = np.float32, fill_value: float | None = None):
+        super().__init__()
+
+        self.n_events = n_events
+        self.dtype = dtype
+        self.fill_value = fill_value
+        self.columns = {}
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def __setitem__(self, name: str, values: ak.Array | np.ndarray | float) -> None:
+        if isinstance(values, ak.Array):
+            values = ak.to_numpy(ak.values_astype(values, self.dtype), allow_missing=True)
+        values = np.asarray(np.ma.filled(values, np.nan), dtype=self.dtype)
+        self.columns[name] = np.broadcast_to(values, (self.n_events,))
+
+    def to_numpy(self) -> np.ndarray:
+        """
+        Returns all columns as a (columns x events) array with missing and NaN values filled.
+        """
+        data = np.empty((len(self.columns), self.n_events), dtype=self.dtype)
+        for i, values in enumerate(self.columns.values()):
+            data[i] = values
+        if self.fill_value is not None:
+            data[np.isnan(data)] = self.fill_value
+        return data
+
+    def attach(self, events: ak.Array, dtype: type | None = None) -> ak.Array:
+        """
+        Attaches all columns to *events*, optionally converted to *dtype*, and returns the new events.
+        """
+        data = self.to_numpy()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return set_ak_columns(events, dict(zip(self.columns.keys(), data)))
+
+
+@njit
+def _sanitize_kernel(values, missing, starts, fill_value):
+    n_columns = len(starts) - 1
+    counts = np.zeros((n_columns, 3), dtype=np.int64)
+
+    for c in range(n_columns):
+        for i in range(starts[c], starts[c + 1]):
+            if missing[i]:
+                counts[c, 0] += 1
+            elif np.isnan(values[i]):
+                counts[c, 1] += 1
+            elif np.isinf(values[i]):
+                counts[c, 2] += 1
+            else:
+                continue
+            values[i] = fill_value
+
+    return counts
+
+
+def sanitize_columns(
+    events: ak.Array,
+    columns: Iterable[Route | str],
+    fill_value: float = EMPTY_FLOAT,
+    dtype: type = np.float32,
+    name: str | None = None,
+) -> ak.Array:
+    """
+    Helper to replace all None, NaN and inf values of many flat or jagged *columns* of *events* with
+    *fill_value*, equivalent to
+
+    .. code-block:: python
+
+        for route in columns:
+            col = ak.fill_none(ak.nan_to_none(route.apply(events)), fill_value)
+            col = ak.where(np.isinf(col), fill_value, col)
+            events = set_ak_column(events, route, col, value_type=dtype)
+
+    but evaluated in a single compiled pass over one flat buffer of type *dtype* holding the
+    content of all columns. The number of replaced values per column is reported to the logger,
+    prefixed with *name* (e.g. the name of the calling producer).
+
+    :return: New awkward array with all *columns* replaced.
+    """
+    routes = [Route(column) for column in columns]
+
+    # gather the flat content, missing values and the structure of all columns
+    contents, masks, structures = [], [], []
+    for route in routes:
+        column = route.apply(events)
+        counts = None
+        if column.ndim > 1:
+            counts = ak.to_numpy(ak.fill_none(ak.num(column, axis=1), 0))
+            column = ak.flatten(column, axis=1)
+        content = ak.to_numpy(column, allow_missing=True)
+        contents.append(content)
+        masks.append(np.ma.getmask(content))
+        structures.append(counts)
+
+    starts = np.zeros(len(routes) + 1, dtype=np.int64)
+    np.cumsum([len(content) for content in contents], out=starts[1:])
+
+    # fill one buffer for all columns and sanitize it in place
+    values = np.empty(starts[-1], dtype=dtype)
+    missing = np.zeros(starts[-1], dtype=np.bool_)
+    for start, stop, content, mask in zip(starts[:-1], starts[1:], contents, masks):
+        values[start:stop] = np.ma.getdata(content)
+        if mask is not np.ma.nomask:
+            missing[start:stop] = mask
+    counts = _sanitize_kernel(values, missing, starts, dtype(fill_value))
+
+    prefix = f"{name}: " if name else ""
+    for route, (n_none, n_nan, n_inf) in zip(routes, counts):
+        if n_none or n_nan or n_inf:
+            _logger.debug(
+                f"{prefix}replaced {n_none} None, {n_nan} NaN and {n_inf} inf values of column "
+                f"{route} with {fill_value}",
+            )
+
+    # write back all columns
+    for route, start, stop, structure in zip(routes, starts[:-1], starts[1:], structures):
+        column = values[start:stop]
+        if structure is not None:
+            column = ak.unflatten(column, structure)
+        events = set_ak_column(events, route, column)
+
+    return events
+
+
 def has_tag(tag, *container, operator: callable = any) -> bool:
     """
     Helper to check multiple container for a certain tag *tag*.
@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""
+unittests for hbw.selection.cleaning
+"""
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hbw.selection.cleaning import delta_r_cleaning_mask, delta_r_separation, delta_r_unique_matching
+from hbw.selection.gen_hbw_features import gen_hbw_matching
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+maybe_import("coffea.nanoevents.methods.nanoaod")
+coffea = maybe_import("coffea")
+
+
+def make_collection(rng, counts, name: str = "Jet", phi_range: tuple = (-np.pi, np.pi)) -> ak.Array:
+    n = counts.sum()
+    return ak.with_name(
+        ak.unflatten(ak.zip({
+            "pt": rng.uniform(20, 200, n),
+            "eta": rng.uniform(-2.5, 2.5, n),
+            "phi": rng.uniform(*phi_range, n),
+            "mass": rng.uniform(0, 10, n),
+        }), counts),
+        name,
+        behavior=coffea.nanoevents.methods.nanoaod.behavior,
+    )
+
+
+class DeltaRCleaningTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        n = 500
+        self.jets = make_collection(rng, rng.integers(0, 8, n))
+        self.references = [
+            make_collection(rng, rng.integers(0, 3, n), "Electron"),
+            make_collection(rng, rng.integers(0, 3, n), "Muon"),
+            # close to phi = +-pi, to test the phi wrap-around
+            make_collection(rng, rng.integers(0, 3, n), "Muon", phi_range=(3.0, np.pi)),
+        ]
+        self.jets_wrapped = make_collection(rng, rng.integers(0, 8, n), phi_range=(-np.pi, -3.0))
+
+    def test_cleaning_mask(self):
+        # contiguous, sliced and empty inputs
+        for jets, sl in [
+            (self.jets, slice(None)),
+            (self.jets_wrapped, slice(None)),
+            (self.jets, slice(7, -5)),
+            (self.jets, slice(0, 0)),
+        ]:
+            jets = jets[sl]
+            references = [ref[sl] for ref in self.references]
+
+            for refs, min_dr in [
+                (references[:1], 0.4),
+                (references, 0.4),
+                (references, [0.3, 0.4, 0.8]),
+                ([], 0.4),
+            ]:
+                mask = delta_r_cleaning_mask(jets, *refs, min_dr=min_dr)
+                expected = ak.ones_like(jets.pt, dtype=bool)
+                for ref, _min_dr in zip(refs, np.broadcast_to(min_dr, (len(refs),))):
+                    expected = expected & ak.all(jets.metric_table(ref) > _min_dr, axis=2)
+                self.assertEqual(mask.tolist(), expected.tolist())
+
+        # the wrap-around actually removes jets, which would be kept with a plain difference in phi
+        mask = delta_r_cleaning_mask(self.jets_wrapped, self.references[2], min_dr=0.4)
+        self.assertTrue(ak.any(~mask))
+
+    def test_separation(self):
+        for jets, refs in [
+            (self.jets, self.references[0]),
+            (self.jets_wrapped, self.references[2]),
+            (self.jets[7:-5], self.references[1][7:-5]),
+            (self.jets[:0], self.references[0][:0]),
+        ]:
+            n_inner, n_outer, max_dr = delta_r_separation(jets, refs, inner_dr=0.8, outer_dr=1.2)
+            dr = jets.metric_table(refs)
+            self.assertEqual(n_inner.tolist(), ak.sum(dr < 0.8, axis=2).tolist())
+            self.assertEqual(n_outer.tolist(), ak.sum(dr > 1.2, axis=2).tolist())
+
+            # maximum Delta R, missing for events without references
+            expected_max_dr = ak.max(dr, axis=2)
+            self.assertEqual(ak.is_none(max_dr, axis=1).tolist(), ak.is_none(expected_max_dr, axis=1).tolist())
+            np.testing.assert_allclose(
+                ak.to_numpy(ak.flatten(ak.fill_none(max_dr, -1.0))),
+                ak.to_numpy(ak.flatten(ak.fill_none(expected_max_dr, -1.0))),
+                rtol=1e-6,
+            )
+
+
+def greedy_matching(objects, references, max_dr, max_rel_pt_diff):
+    # plain python version of the unique matching, iterating over all candidate pairs sorted by Delta R
+    match = np.full((len(objects), len(references)), -1)
+    for ev, objs in enumerate(objects):
+        pairs = []
+        for r, ref in enumerate(references):
+            ref = ref[ev]
+            for i, obj in enumerate(objs):
+                dphi = (obj.phi - ref.phi + np.pi) % (2 * np.pi) - np.pi
+                dr = np.sqrt((obj.eta - ref.eta) ** 2 + dphi ** 2)
+                if dr < max_dr and abs((obj.pt - ref.pt) / ref.pt) < max_rel_pt_diff:
+                    pairs.append((dr, r, i))
+        used_refs, used_objs = set(), set()
+        for dr, r, i in sorted(pairs):
+            if r not in used_refs and i not in used_objs:
+                match[ev, r] = i
+                used_refs.add(r)
+                used_objs.add(i)
+    return match
+
+
+class UniqueMatchingTest(unittest.TestCase):
+
+    @staticmethod
+    def particles(pt, eta, phi):
+        return ak.zip({"pt": np.asarray(pt, float), "eta": np.asarray(eta, float), "phi": np.asarray(phi, float)})
+
+    def test_unique_matching(self):
+        rng = np.random.default_rng(5)
+        n = 300
+        counts = rng.integers(0, 6, n)
+        jets = make_collection(rng, counts)[3:]
+        references = [
+            self.particles(rng.uniform(20, 200, n), rng.uniform(-2.5, 2.5, n), rng.uniform(-np.pi, np.pi, n))[3:]
+            for _ in range(4)
+        ]
+        # place some references close to jets, so that several references compete for the same jets
+        first_jet = ak.firsts(jets)
+        has_jet = ~ak.is_none(first_jet)
+        for r in range(2):
+            references[r] = ak.zip({
+                field: ak.where(has_jet, ak.fill_none(first_jet[field], 0) + 0.1 * (r + 1), references[r][field])
+                for field in ("pt", "eta", "phi")
+            })
+
+        for max_dr, max_rel_pt_diff in [(0.4, 10.0), (0.4, 0.1), (1.5, 10.0)]:
+            match, n_candidates = delta_r_unique_matching(
+                jets, references, max_dr=max_dr, max_rel_pt_diff=max_rel_pt_diff,
+            )
+            self.assertEqual(match.shape, (n - 3, 4))
+            np.testing.assert_array_equal(match, greedy_matching(jets, references, max_dr, max_rel_pt_diff))
+
+            # each jet is matched at most once, and only references with candidates are matched
+            for ev_match in match:
+                matched = ev_match[ev_match >= 0]
+                self.assertEqual(len(matched), len(set(matched)))
+            self.assertTrue(np.all((match >= 0) <= (n_candidates > 0)))
+
+        # the second reference loses the first jet to the closer first reference
+        both = has_jet & (ak.num(jets) > 1)
+        self.assertTrue(np.any(ak.to_numpy(both) & (match[:, 0] == 0) & (match[:, 1] > 0)))
+
+    def test_ties_and_unmatched(self):
+        jets = ak.Array([
+            # two jets with the same Delta R to the first reference
+            [{"pt": 50.0, "eta": 0.1, "phi": 0.0}, {"pt": 50.0, "eta": -0.1, "phi": 0.0}],
+            # a single jet with the same Delta R to both references
+            [{"pt": 50.0, "eta": 0.0, "phi": 0.0}],
+            # a jet beyond max_dr and one with a too large pt difference
+            [{"pt": 50.0, "eta": 0.5, "phi": 0.0}, {"pt": 500.0, "eta": 0.0, "phi": 0.0}],
+            # no jets
+            [],
+        ])
+        references = [
+            self.particles([50.0, 50.0, 50.0, 50.0], [0.0, 0.1, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]),
+            self.particles([50.0, 50.0, 50.0, 50.0], [3.0, -0.1, 3.0, 0.0], [0.0, 0.0, 0.0, 0.0]),
+        ]
+        match, n_candidates = delta_r_unique_matching(jets, references, max_dr=0.4, max_rel_pt_diff=1.0)
+
+        # ties are resolved in favor of the lower jet and reference indices
+        self.assertEqual(match.tolist(), [[0, -1], [0, -1], [-1, -1], [-1, -1]])
+        self.assertEqual(n_candidates.tolist(), [[2, 0], [1, 1], [0, 0], [0, 0]])
+
+    def test_gen_lepton_index(self):
+        # the matched lepton index refers to the concatenation of muons and electrons
+        muon = [{"pt": 30.0, "eta": 1.0, "phi": 1.0}, {"pt": 20.0, "eta": -1.0, "phi": -1.0}]
+        electron = [{"pt": 40.0, "eta": 2.0, "phi": -2.0}]
+        gen_l = [
+            {"pt": 40.0, "eta": 2.0, "phi": -2.0},
+            {"pt": 20.0, "eta": -1.0, "phi": -1.0},
+            {"pt": 40.0, "eta": 0.0, "phi": 3.0},
+        ]
+        gen_parton = {"pt": 50.0, "eta": 0.0, "phi": 0.0}
+        events = ak.Array({
+            "Jet": [[{"pt": 50.0, "eta": 0.05, "phi": 0.0}]] * 3,
+            "Muon": [muon, muon, []],
+            "Electron": [electron, electron, electron],
+            "gen_hbw_decay": [
+                {"l": lepton, **{gp: gen_parton for gp in ("b1", "b2", "q1", "q2", "sec1", "sec2")}}
+                for lepton in gen_l
+            ],
+        })
+        events = gen_hbw_matching()(events)
+
+        self.assertEqual(events.gen_match.l.tolist(), [2, 1, -1])
+        self.assertEqual(events.gen_match.b1.tolist(), [0, 0, 0])
+        self.assertEqual(events.gen_match.b2.tolist(), [-1, -1, -1])
@@ -0,0 +1,163 @@
+# coding: utf-8
+
+"""
+unittests for hbw.production.compiled_corrections
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from columnflow.util import maybe_import
+
+from hbw.production.compiled_corrections import (
+    CompiledCorrection, CompiledCorrectionStack, CorrectionFile, compile_correction,
+)
+
+np = maybe_import("numpy")
+correctionlib = maybe_import("correctionlib")
+
+
+def make_correction(name: str, inputs: list, data: dict) -> dict:
+    return {
+        "name": name,
+        "version": 1,
+        "inputs": [{"name": inp, "type": _type} for inp, _type in inputs],
+        "output": {"name": "sf", "type": "real"},
+        "data": data,
+    }
+
+
+def make_binning(input_name: str, edges, content: list, flow="clamp") -> dict:
+    return {"nodetype": "binning", "input": input_name, "edges": edges, "content": content, "flow": flow}
+
+
+class CompiledCorrectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+
+        eta_edges = [-2.5, -1.5, 0.0, 1.5, 2.5]
+        pt_edges = [10.0, 20.0, 50.0, 100.0]
+        uniform_edges = {"n": 4, "low": 0.0, "high": 2.0}
+
+        def pt_binning(i, flow="clamp"):
+            return make_binning("pt", pt_edges, [0.9 + 0.01 * i, 1.0 + 0.01 * i, 1.1 + 0.01 * i], flow)
+
+        corrections = [
+            # binning with clamp flow, nested (fused into one grid)
+            make_correction("clamp", [("eta", "real"), ("pt", "real")], make_binning(
+                "eta", eta_edges, [pt_binning(i) for i in range(4)],
+            )),
+            # same axes, to be stacked with "clamp"
+            make_correction("clamp2", [("eta", "real"), ("pt", "real")], make_binning(
+                "eta", eta_edges, [pt_binning(10 + i) for i in range(4)],
+            )),
+            # uniform binning with error flow
+            make_correction("error", [("eta", "real"), ("pt", "real")], make_binning(
+                "eta", uniform_edges, [pt_binning(i) for i in range(4)], flow="error",
+            )),
+            # binning with value flow
+            make_correction("value", [("eta", "real"), ("pt", "real")], make_binning(
+                "eta", eta_edges, [pt_binning(i) for i in range(4)], flow=0.5,
+            )),
+            # string and integer categories, with and without default
+            make_correction("category", [("syst", "string"), ("era", "int"), ("pt", "real")], {
+                "nodetype": "category",
+                "input": "syst",
+                "content": [
+                    {"key": syst, "value": {
+                        "nodetype": "category",
+                        "input": "era",
+                        "content": [{"key": era, "value": pt_binning(i + era)} for era in (2016, 2017, 2018)],
+                        **({"default": 1.0} if syst == "nominal" else {}),
+                    }}
+                    for i, syst in enumerate(["nominal", "up", "down"])
+                ],
+            }),
+            # formula nodes are evaluated with correctionlib
+            make_correction("formula", [("eta", "real"), ("pt", "real")], make_binning("eta", eta_edges, [
+                {
+                    "nodetype": "formula",
+                    "expression": f"{i + 1}*x+0.5",
+                    "parser": "TFormula",
+                    "variables": ["pt"],
+                }
+                for i in range(4)
+            ])),
+        ]
+        self.content = json.dumps({"schema_version": 2, "corrections": corrections}).encode("utf-8")
+        self.correction_set = correctionlib.CorrectionSet.from_string(self.content.decode("utf-8"))
+        self.correction_file = CorrectionFile(self.content)
+
+        n = 1000
+        self.eta = self.rng.uniform(-3, 3, n)
+        self.pt = np.concatenate([pt_edges, eta_edges, self.rng.uniform(0, 150, n)])[:n]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def compile(self, name: str):
+        compiled = compile_correction(self.correction_set[name], self.correction_file, cache_dir=self.cache_dir)
+        self.assertIsInstance(compiled, CompiledCorrection)
+        return compiled
+
+    def assert_equal_values(self, name: str, *args):
+        compiled = self.compile(name)
+        expected = self.correction_set[name].evaluate(*args)
+        np.testing.assert_allclose(compiled.evaluate(*args), expected, rtol=1e-12)
+
+    def test_binning(self):
+        self.assert_equal_values("clamp", self.eta, self.pt)
+        self.assert_equal_values("value", self.eta, self.pt)
+        self.assert_equal_values("clamp", 1.0, 25.0)
+
+        # uniform binning in range, and error flow raising the same exception type as correctionlib
+        eta = np.abs(self.eta) * 2 / 3
+        self.assert_equal_values("error", eta[eta < 2], self.pt[eta < 2])
+        for correction in [self.correction_set["error"], self.compile("error")]:
+            with self.assertRaises(RuntimeError):
+                correction.evaluate(np.array([0.5, 2.5]), np.array([20.0, 20.0]))
+
+    def test_category(self):
+        era = self.rng.choice([2016, 2017, 2018], len(self.pt))
+        for syst in ["nominal", "up", "down"]:
+            self.assert_equal_values("category", syst, era, self.pt)
+
+        # default content for unknown integer keys, errors for unknown keys without default
+        self.assert_equal_values("category", "nominal", np.array([2016, 2022]), np.array([20.0, 20.0]))
+        for correction in [self.correction_set["category"], self.compile("category")]:
+            with self.assertRaises(IndexError):
+                correction.evaluate("up", np.array([2016, 2022]), np.array([20.0, 20.0]))
+            with self.assertRaises(IndexError):
+                correction.evaluate("unknown", np.array([2016]), np.array([20.0]))
+
+    def test_formula_fallback(self):
+        self.assert_equal_values("formula", self.eta, self.pt)
+
+    def test_cache(self):
+        compiled = self.compile("clamp")
+        cache_files = os.listdir(self.cache_dir)
+        self.assertEqual(len(cache_files), 1)
+        self.assertTrue(cache_files[0].startswith(self.correction_file.hash))
+
+        # compiling again reads the cache, also for content passed as bytes
+        cached = compile_correction(self.correction_set["clamp"], self.content, cache_dir=self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), cache_files)
+        np.testing.assert_array_equal(cached.evaluate(self.eta, self.pt), compiled.evaluate(self.eta, self.pt))
+
+    def test_stack(self):
+        names = ["clamp", "clamp2", "value", "formula"]
+        stack = CompiledCorrectionStack([self.compile(name) for name in names])
+
+        # grids of constants with the same axes are stacked, grids with flow content and formulas not
+        self.assertEqual([indices.tolist() for indices, _, _ in stack.groups], [[0, 1]])
+        self.assertEqual(stack.unstacked, [2, 3])
+
+        values = stack.evaluate(self.eta, self.pt)
+        self.assertEqual(values.shape, (len(self.eta), len(names)))
+        for i, name in enumerate(names):
+            np.testing.assert_allclose(values[:, i], self.correction_set[name].evaluate(self.eta, self.pt), rtol=1e-12)
@@ -0,0 +1,186 @@
+# coding: utf-8
+
+"""
+unittests for hbw.calibration.jet
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from columnflow.util import maybe_import
+from columnflow.calibration.cms.jets import ak_evaluate
+from columnflow.calibration.util import propagate_met
+
+from hbw.calibration.jet import _jec_shifts_kernel, bjet_regression, bjet_regression_flat
+from hbw.util import flat_record_buffers
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+correctionlib = maybe_import("correctionlib")
+maybe_import("coffea.nanoevents.methods.nanoaod")
+coffea = maybe_import("coffea")
+
+
+class JecShiftsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # small correction file with the uncertainty sources, binned in eta and raw pt
+        eta_edges = [-5.4, -2.5, -1.3, 0.0, 1.3, 2.5, 5.4]
+        pt_edges = [9.0, 20.0, 40.0, 80.0, 200.0, 5000.0]
+        self.sources = ["AbsoluteStat", "FlavorQCD", "Total"]
+        corrections = [
+            {
+                "name": f"Test_V1_MC_{source}_AK4PFchs",
+                "version": 1,
+                "inputs": [{"name": "JetEta", "type": "real"}, {"name": "JetPt", "type": "real"}],
+                "output": {"name": "unc", "type": "real"},
+                "data": {"nodetype": "binning", "input": "JetEta", "edges": eta_edges, "flow": "clamp", "content": [
+                    {
+                        "nodetype": "binning", "input": "JetPt", "edges": pt_edges, "flow": "clamp",
+                        "content": np.round(rng.uniform(0, 0.05, len(pt_edges) - 1), 4).tolist(),
+                    }
+                    for _ in range(len(eta_edges) - 1)
+                ]},
+            }
+            for source in self.sources
+        ]
+        path = os.path.join(self.tmp_dir, "jec.json")
+        with open(path, "w") as f:
+            json.dump({"schema_version": 2, "corrections": corrections}, f)
+        self.correction_set = correctionlib.CorrectionSet.from_file(path)
+
+        # jets with raw pt, and MET
+        n = 200
+        counts = rng.integers(0, 8, n)
+        n_jets = counts.sum()
+        pt_raw = (rng.exponential(40, n_jets) + 8).astype(np.float32)
+        jets = ak.zip({
+            "pt": (pt_raw * rng.uniform(1.0, 1.2, n_jets)).astype(np.float32),
+            "eta": rng.uniform(-5, 5, n_jets).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, n_jets).astype(np.float32),
+            "mass": (pt_raw * 0.1).astype(np.float32),
+            "pt_raw": pt_raw,
+        })
+        self.events = ak.zip({
+            "Jet": ak.with_name(ak.unflatten(jets, counts), "Jet", behavior=coffea.nanoevents.methods.nanoaod.behavior),
+            "MET": ak.zip({
+                "pt": rng.exponential(50, n).astype(np.float32),
+                "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+            }),
+        }, depth_limit=1)[3:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_jec_shifts_kernel(self):
+        events = self.events
+        met_prop_mask = (events.Jet.pt_raw > 15) & (abs(events.Jet.eta) < 5.2)
+        jetsum = events.Jet[met_prop_mask].sum(axis=1)
+        evaluators = [self.correction_set[f"Test_V1_MC_{source}_AK4PFchs"] for source in self.sources]
+
+        # compiled pass over the flat jet buffers
+        offsets, buffers = flat_record_buffers(events.Jet, ["pt", "eta", "phi", "mass", "pt_raw"])
+        start, stop = offsets[0], offsets[-1]
+        eta, pt_raw = buffers["eta"][start:stop], buffers["pt_raw"][start:stop]
+        unc = np.stack([evaluator.evaluate(eta, pt_raw) for evaluator in evaluators], axis=1)
+        jet_shifts, met_shifts = _jec_shifts_kernel(
+            offsets,
+            buffers["pt"],
+            buffers["mass"],
+            buffers["phi"],
+            (pt_raw > 15) & (np.abs(eta) < 5.2),
+            unc,
+            ak.to_numpy(events.MET.pt),
+            ak.to_numpy(events.MET.phi),
+        )
+
+        # same as in the uncertainty loop of columnflow's jec calibrator
+        for s, evaluator in enumerate(evaluators):
+            jec_uncertainty = ak_evaluate(evaluator, events.Jet.eta, events.Jet.pt_raw)
+            for d, sign in enumerate((1.0, -1.0)):
+                jet_pt = ak.values_astype(events.Jet.pt * (1.0 + sign * jec_uncertainty), np.float32)
+                jet_mass = ak.values_astype(events.Jet.mass * (1.0 + sign * jec_uncertainty), np.float32)
+                np.testing.assert_array_equal(jet_shifts[s, d, start:stop], ak.flatten(jet_pt))
+                np.testing.assert_array_equal(jet_shifts[s, 2 + d, start:stop], ak.flatten(jet_mass))
+
+                met_pt, met_phi = propagate_met(
+                    jetsum.pt,
+                    jetsum.phi,
+                    jet_pt[met_prop_mask],
+                    events.Jet[met_prop_mask].phi,
+                    events.MET.pt,
+                    events.MET.phi,
+                )
+                np.testing.assert_allclose(met_shifts[s, d], met_pt, rtol=1e-3, atol=1e-3)
+                dphi = np.abs(met_shifts[s, 2 + d] - ak.to_numpy(met_phi))
+                np.testing.assert_array_less(np.minimum(dphi, 2 * np.pi - dphi), 1e-3)
+
+
+class BjetRegressionTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        n = 300
+        counts = rng.integers(0, 8, n)
+        n_jets = counts.sum()
+        btag = rng.uniform(0, 1, n_jets).astype(np.float32)
+        btag[rng.uniform(0, 1, n_jets) < 0.05] = np.nan
+        pt = rng.exponential(40, n_jets).astype(np.float32)
+        pt[:5] = 20.0
+        self.events = ak.zip({
+            "Jet": ak.unflatten(ak.zip({
+                "pt": pt,
+                "mass": (pt * rng.uniform(0.05, 0.2, n_jets)).astype(np.float32),
+                "btagDeepFlavB": btag,
+                "bRegCorr": rng.uniform(0.8, 1.4, n_jets).astype(np.float32),
+            }), counts),
+        }, depth_limit=1)
+        self.jet_mask = ak.unflatten(rng.uniform(0, 1, n_jets) < 0.7, counts)
+
+    def get_calibrators(self, btag_wp):
+        cls_dict = {"btag_wp": btag_wp}
+        calib = bjet_regression.derive(f"test_bjet_regression_{btag_wp}", cls_dict=cls_dict)()
+        flat_calib = bjet_regression_flat.derive(f"test_bjet_regression_flat_{btag_wp}", cls_dict=cls_dict)()
+        flat_calib.setup_func({}, {}, {})
+        return calib, flat_calib
+
+    def assert_same_jets(self, events, expected_events):
+        for field in ("pt", "mass"):
+            self.assertEqual(ak.num(events.Jet[field]).tolist(), ak.num(expected_events.Jet[field]).tolist())
+            values = ak.to_numpy(ak.flatten(events.Jet[field]))
+            self.assertEqual(values.dtype, np.float32)
+            np.testing.assert_array_equal(values, ak.flatten(expected_events.Jet[field]))
+
+    def test_bjet_regression_flat(self):
+        for btag_wp in (0.3, None):
+            calib, flat_calib = self.get_calibrators(btag_wp)
+
+            # contiguous and sliced inputs, the latter with offsets not starting at 0
+            for events in (self.events, self.events[7:-5]):
+                self.assert_same_jets(flat_calib(events), calib(events))
+
+            # jet mask, which bjet_regression combines with the default mask
+            for sl in (slice(None), slice(7, -5)):
+                events, jet_mask = self.events[sl], self.jet_mask[sl]
+                mask = jet_mask & (events.Jet.pt > 20)
+                if btag_wp:
+                    mask = mask & (events.Jet.btagDeepFlavB > btag_wp)
+                expected_events = ak.zip({"Jet": ak.zip({
+                    field: ak.values_astype(
+                        ak.where(mask, events.Jet[field] * events.Jet.bRegCorr, events.Jet[field]), np.float32,
+                    )
+                    for field in ("pt", "mass")
+                })}, depth_limit=1)
+                self.assert_same_jets(flat_calib(events, jet_mask=jet_mask), expected_events)
+
+        # without working point, jets with nan scores are regressed as well
+        events = flat_calib(self.events)
+        nan_btag = np.isnan(ak.to_numpy(ak.flatten(self.events.Jet.btagDeepFlavB)))
+        regressed = ak.to_numpy(ak.flatten(events.Jet.pt)) != ak.to_numpy(ak.flatten(self.events.Jet.pt))
+        self.assertTrue(np.any(nan_btag & regressed))
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+"""
+unittests for hbw.production.prepare_objects
+"""
+
+import unittest
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column
+
+from hbw.production.prepare_objects import prepare_objects
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def make_chunk(seed: int, n: int = 100) -> ak.Array:
+    rng = np.random.default_rng(seed)
+
+    def collection(*fields):
+        counts = rng.integers(0, 4, n)
+        return ak.unflatten(ak.zip({
+            "pt": rng.uniform(10, 100, counts.sum()),
+            "eta": rng.uniform(-2.5, 2.5, counts.sum()),
+            "phi": rng.uniform(-np.pi, np.pi, counts.sum()),
+            "mass": rng.uniform(0, 10, counts.sum()),
+            **{field: rng.uniform(0, 1, counts.sum()) for field in fields},
+        }), counts)
+
+    return ak.Array({
+        "Electron": collection(),
+        "Muon": collection(),
+        "Jet": collection("btagDeepFlavB"),
+        "MET": ak.zip({"pt": rng.uniform(0, 100, n), "phi": rng.uniform(-np.pi, np.pi, n)}),
+    })
+
+
+class PrepareObjectsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prepare_objects = prepare_objects()
+
+    def test_present_collections(self):
+        events = make_chunk(1)
+        prepared = self.prepare_objects(events)
+        self.assertEqual(
+            prepared.Lepton.pt.tolist(),
+            ak.sort(ak.concatenate([events.Muon.pt, events.Electron.pt], axis=1), ascending=False).tolist(),
+        )
+        self.assertEqual(prepared.MET.mass.tolist(), [0] * len(events))
+
+        # preparing again keeps the prepared collections
+        reprepared = self.prepare_objects(prepared)
+        for name in ("Bjet", "Lepton", "MET"):
+            self.assertEqual(reprepared[name].pt.tolist(), prepared[name].pt.tolist())
+
+        # collections changed by the caller are not replaced
+        lepton = prepared.Lepton[:, :1]
+        bjet = prepared.Bjet[:, :1]
+        modified = set_ak_column(set_ak_column(prepared, "Lepton", lepton), "Bjet", bjet)
+        modified = self.prepare_objects(modified)
+        self.assertEqual(modified.Lepton.pt.tolist(), lepton.pt.tolist())
+        self.assertEqual(modified.Bjet.pt.tolist(), bjet.pt.tolist())
+
+        # another chunk is prepared from its own sources
+        other = make_chunk(2)
+        prepared_other = self.prepare_objects(other)
+        self.assertEqual(
+            prepared_other.Lepton.pt.tolist(),
+            ak.sort(ak.concatenate([other.Muon.pt, other.Electron.pt], axis=1), ascending=False).tolist(),
+        )
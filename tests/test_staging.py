@@ -0,0 +1,175 @@
+# coding: utf-8
+
+"""
+unittests for hbw.selection.staging
+"""
+
+import unittest
+from collections import defaultdict
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column
+from columnflow.selection import SelectionResult
+
+from hbw.selection.staging import mask_selection_result, staged_selection
+from hbw.selection.stats import increment_grouped_stats
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def lepton_step(events, results):
+    electron_mask = events.Electron.pt > 20
+    events = set_ak_column(events, "cutflow.n_electron", ak.sum(electron_mask, axis=1))
+    return events, SelectionResult(
+        steps={"Lepton": events.cutflow.n_electron == 1, "Trigger": events.trigger},
+        objects={"Electron": {"Electron": ak.local_index(events.Electron)[electron_mask]}},
+    )
+
+
+def jet_step(events, results):
+    events = set_ak_column(events, "Jet.btag", ak.fill_none(ak.nan_to_none(events.Jet.btag), 0.0))
+    n_electrons = ak.num(results.objects.Electron.Electron, axis=1)
+    jet_mask = events.Jet.pt > 25 + 5 * n_electrons
+    jet_indices = ak.argsort(events.Jet.pt, ascending=False)
+    jet_indices = jet_indices[jet_mask[jet_indices]]
+    events = set_ak_column(events, "Jet.local_index", ak.local_index(events.Jet))
+    return events, SelectionResult(
+        steps={"nJet3": ak.num(jet_indices) >= 3, "nBjet1": ak.sum(jet_mask & (events.Jet.btag > 0.5), axis=1) >= 1},
+        objects={"Jet": {"Jet": jet_indices}},
+        aux={"jet_mask": jet_mask, "n_central_jets": ak.num(jet_indices)},
+    )
+
+
+def vbf_step(events, results):
+    jets = events.Jet[results.objects.Jet.Jet]
+    vbf_jets = jets[abs(jets.eta) > 2]
+    events = set_ak_column(events, "VBFJet", vbf_jets)
+    return events, SelectionResult(
+        steps={"VBFJetPair": ak.num(vbf_jets) >= 2},
+        objects={"Jet": {"VBFJet": vbf_jets.local_index}},
+    )
+
+
+class StagingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        n = 2000
+        n_jets = rng.integers(0, 8, n)
+        n_electrons = rng.integers(0, 3, n)
+        btag = rng.uniform(0, 1, n_jets.sum())
+        btag[rng.uniform(0, 1, len(btag)) < 0.05] = np.nan
+        self.events = ak.Array({
+            "process_id": rng.integers(1, 4, n),
+            "mc_weight": rng.normal(1, 0.5, n),
+            "trigger": rng.uniform(0, 1, n) < 0.8,
+            "Jet": ak.unflatten(ak.zip({
+                "pt": rng.exponential(40, n_jets.sum()),
+                "eta": rng.uniform(-4.7, 4.7, n_jets.sum()),
+                "btag": btag,
+            }), n_jets),
+            "Electron": ak.unflatten(ak.zip({"pt": rng.exponential(25, n_electrons.sum())}), n_electrons),
+        })
+        self.results = SelectionResult(steps={"cleanup": rng.uniform(0, 1, n) < 0.9})
+        self.steps = [
+            ("lepton", lepton_step, {"cutflow.n_electron"}),
+            ("jet", jet_step, {"Jet.btag"}),
+            ("vbf_jet", vbf_step, set()),
+        ]
+        self.stages = {"pre_selection": ("cleanup",), "lepton": ("Lepton", "Trigger")}
+
+    def run_selection(self, staged):
+        events, results = self.events, self.results + None
+        if staged:
+            return staged_selection(
+                events,
+                results,
+                self.steps,
+                self.stages,
+                aux_collections={"jet_mask": "Jet"},
+                aux_fill_values={"n_central_jets": -1},
+            )
+
+        for _, func, _ in self.steps:
+            events, step_results = func(events, results)
+            results += step_results
+        return events, results
+
+    def get_stats(self, events, results):
+        # same weight and group maps as in hbw_selection_step_stats and hbw_increment_stats
+        weight_map = {"num_events": Ellipsis, "sum_mc_weight": events.mc_weight}
+        for step, mask in results.steps.items():
+            weight_map[f"num_events_step_{step}"] = mask
+            weight_map[f"sum_mc_weight_step_{step}"] = (events.mc_weight, mask)
+
+        stats = defaultdict(float)
+        increment_grouped_stats(
+            stats,
+            len(events),
+            weight_map=weight_map,
+            group_map={"process": events.process_id, "njet": results.x.n_central_jets},
+            group_combinations=[("process", "njet")],
+        )
+        return stats
+
+    def test_staged_selection(self):
+        # record the number of events that each step is called with
+        n_calls = defaultdict(list)
+
+        def record(name, func):
+            def wrapper(events, results):
+                n_calls[name].append(len(events))
+                return func(events, results)
+            return wrapper
+
+        self.steps = [(name, record(name, func), produces) for name, func, produces in self.steps]
+
+        events, results = self.run_selection(staged=False)
+        staged_events, staged_results = self.run_selection(staged=True)
+
+        cleanup = np.asarray(self.results.steps.cleanup)
+        passed = cleanup & np.asarray(results.steps.Lepton & results.steps.Trigger)
+
+        # steps after a stage are only called once, with the events passing all stages so far
+        self.assertEqual(n_calls["lepton"], [len(cleanup), cleanup.sum()])
+        self.assertEqual(n_calls["jet"], [len(passed), passed.sum()])
+        self.assertEqual(n_calls["vbf_jet"], [len(passed), passed.sum()])
+
+        # steps, aux arrays and columns are identical for events passing all stages
+        self.assertEqual(set(results.steps), set(staged_results.steps))
+        for step in results.steps:
+            self.assertEqual(results.steps[step][passed].tolist(), staged_results.steps[step][passed].tolist())
+        for key in ("jet_mask", "n_central_jets"):
+            self.assertEqual(results.aux[key][passed].tolist(), staged_results.aux[key][passed].tolist())
+        for column in ("cutflow", "Jet", "VBFJet"):
+            self.assertEqual(events[column][passed].tolist(), staged_events[column][passed].tolist())
+        for coll in ("Electron", "Jet", "VBFJet"):
+            route = ("Electron", "Electron") if coll == "Electron" else ("Jet", coll)
+            indices, staged_indices = results.objects[route[0]][route[1]], staged_results.objects[route[0]][route[1]]
+            self.assertEqual(indices[passed].tolist(), staged_indices[passed].tolist())
+
+        # rejected events get defaults: false step masks, no objects, aux fill values and empty columns
+        for step in ("Lepton", "Trigger"):
+            self.assertFalse(ak.any(staged_results.steps[step][~cleanup]))
+        for step in ("nJet3", "nBjet1", "VBFJetPair"):
+            self.assertFalse(ak.any(staged_results.steps[step][~passed]))
+        self.assertEqual(ak.sum(ak.num(staged_results.objects.Jet.Jet[~passed])), 0)
+        self.assertEqual(ak.num(staged_results.x.jet_mask).tolist(), ak.num(self.events.Jet).tolist())
+        self.assertFalse(ak.any(staged_results.x.jet_mask[~passed]))
+        self.assertTrue(ak.all(staged_results.x.n_central_jets[~passed] == -1))
+        self.assertEqual(ak.sum(ak.num(staged_events.VBFJet[~passed])), 0)
+        np.testing.assert_array_equal(
+            ak.flatten(staged_events.Jet.btag[~passed]), ak.flatten(self.events.Jet.btag[~passed]),
+        )
+
+        # stats of events passing all stages are identical, rejected events are grouped in njet -1
+        stats = self.get_stats(events[passed], mask_selection_result(results, passed))
+        staged_stats = self.get_stats(staged_events, staged_results)
+        self.assertEqual(staged_stats["num_events"], len(cleanup))
+        self.assertEqual(sum(staged_stats["num_events_per_njet"].values()), len(cleanup))
+        self.assertEqual(staged_stats["num_events_per_njet"]["-1"], (~passed).sum())
+        for njet, value in stats["num_events_per_njet"].items():
+            self.assertEqual(staged_stats["num_events_per_njet"][njet], value)
+        for step in ("nJet3", "nBjet1", "VBFJetPair"):
+            self.assertEqual(staged_stats[f"num_events_step_{step}"], stats[f"num_events_step_{step}"])
@@ -0,0 +1,105 @@
+# coding: utf-8
+
+"""
+unittests for hbw.selection.stats_arrays
+"""
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hbw.selection.stats_arrays import (
+    STATS_AXIS_PREFIX, WEIGHT_SKETCH_ACCURACY, stats_to_arrays, arrays_to_stats, merge_stats_arrays,
+    weight_sketch_bins, weight_sketch_quantile,
+)
+
+np = maybe_import("numpy")
+
+
+class StatsArraysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats1 = {
+            "num_events": 3,
+            "sum_mc_weight": 1.5,
+            "num_events_per_process": {"1": 2, "5": 1},
+            "sum_mc_weight_per_process_and_njet": {"1": {"0": 0.5, "2": 1.5}, "5": {"-1": -0.5}},
+        }
+        self.stats2 = {
+            "num_events": 2,
+            "sum_mc_weight": 2.0,
+            "num_events_per_process": {"3": 1, "5": 1},
+            "sum_mc_weight_per_process_and_njet": {"3": {"1": 1.0}, "5": {"2": 1.0}},
+        }
+        self.empty_stats = {
+            "num_events": 0,
+            "sum_mc_weight": 0.0,
+            "num_events_per_process": {},
+            "sum_mc_weight_per_process_and_njet": {},
+        }
+
+    def test_round_trip(self):
+        arrays = stats_to_arrays(self.stats1)
+
+        self.assertEqual(arrays[f"{STATS_AXIS_PREFIX}process"].tolist(), [1, 5])
+        self.assertEqual(arrays[f"{STATS_AXIS_PREFIX}njet"].tolist(), [-1, 0, 2])
+        self.assertEqual(arrays["sum_mc_weight_per_process_and_njet"].tolist(), [[0, 0.5, 1.5], [-0.5, 0, 0]])
+
+        # missing combinations are filled with zeros
+        stats = arrays_to_stats(arrays)
+        self.assertEqual(stats["num_events_per_process"], self.stats1["num_events_per_process"])
+        self.assertEqual(
+            stats["sum_mc_weight_per_process_and_njet"],
+            {"1": {"-1": 0.0, "0": 0.5, "2": 1.5}, "5": {"-1": -0.5, "0": 0.0, "2": 0.0}},
+        )
+
+    def test_merge(self):
+        merged = arrays_to_stats(merge_stats_arrays(stats_to_arrays(self.stats1), stats_to_arrays(self.stats2)))
+
+        self.assertEqual(merged["num_events"], 5)
+        self.assertEqual(merged["sum_mc_weight"], 3.5)
+        self.assertEqual(merged["num_events_per_process"], {"1": 2, "3": 1, "5": 2})
+        self.assertEqual(merged["sum_mc_weight_per_process_and_njet"]["5"], {"-1": -0.5, "0": 0.0, "1": 0.0, "2": 1.0})
+
+    def test_empty(self):
+        arrays = stats_to_arrays(self.empty_stats)
+
+        self.assertEqual(arrays[f"{STATS_AXIS_PREFIX}process"].tolist(), [])
+        self.assertEqual(arrays[f"{STATS_AXIS_PREFIX}njet"].tolist(), [])
+        self.assertEqual(arrays["sum_mc_weight_per_process_and_njet"].shape, (0, 0))
+        self.assertEqual(arrays_to_stats(arrays), self.empty_stats)
+
+        # merging with empty stats in any order gives the same result
+        arrays1 = stats_to_arrays(self.stats1)
+        for merged in [merge_stats_arrays(arrays, arrays1), merge_stats_arrays(arrays1, arrays, arrays)]:
+            self.assertEqual(arrays_to_stats(merged), arrays_to_stats(arrays1))
+        self.assertEqual(arrays_to_stats(merge_stats_arrays(arrays, arrays)), self.empty_stats)
+
+    def test_weight_sketch(self):
+        rng = np.random.default_rng(1)
+        weights = rng.normal(0, 1, 10000) * rng.lognormal(0, 2, 10000)
+        weights[:100] = 0
+        abs_weights = np.abs(weights)
+
+        bins, counts = np.unique(weight_sketch_bins(weights), return_counts=True)
+        for q in [0.0, 0.01, 0.5, 0.9, 0.999, 1.0]:
+            k = min(int(q * len(weights)), len(weights) - 1)
+            expected = np.partition(abs_weights, k)[k]
+            quantile = weight_sketch_quantile(bins, counts, q)
+            if expected == 0:
+                self.assertEqual(quantile, 0.0)
+            else:
+                self.assertLessEqual(abs(quantile - expected), WEIGHT_SKETCH_ACCURACY * expected)
+
+        # sketches of parts are merged by summing counts per bin
+        bins1, counts1 = np.unique(weight_sketch_bins(weights[:3000]), return_counts=True)
+        bins2, counts2 = np.unique(weight_sketch_bins(weights[3000:]), return_counts=True)
+        merged = merge_stats_arrays(*(
+            {f"{STATS_AXIS_PREFIX}abs_mc_weight_bin": _bins, "num_events_per_abs_mc_weight_bin": _counts}
+            for _bins, _counts in [(bins1, counts1), (bins2, counts2)]
+        ))
+        self.assertEqual(merged[f"{STATS_AXIS_PREFIX}abs_mc_weight_bin"].tolist(), bins.tolist())
+        self.assertEqual(merged["num_events_per_abs_mc_weight_bin"].tolist(), counts.tolist())
+
+        with self.assertRaises(ValueError):
+            weight_sketch_quantile(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0.5)
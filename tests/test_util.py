@@ -8,7 +8,10 @@ import unittest
 
 from columnflow.util import maybe_import
 
-from hbw.util import build_param_product, round_sig, dict_diff, four_vec, call_once_on_config
+from hbw.util import (
+    build_param_product, round_sig, dict_diff, four_vec, call_once_on_config, flat_offsets,
+    ColumnBatch, sanitize_columns, flat_record_buffers, from_flat_buffer, set_flat_record_fields,
+)
 
 import order as od
 
@@ -83,6 +86,55 @@ class HbwUtilTest(unittest.TestCase):
         )
         self.assertEqual(four_vec("MET"), {"MET.pt", "MET.phi"})
 
+    def test_flat_offsets(self):
+        array = ak.Array([[1.0, 2.0], [], [3.0]])
+        content, offsets = flat_offsets(array)
+
+        self.assertEqual(content.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(offsets.tolist(), [0, 2, 2, 3])
+        self.assertEqual(offsets.dtype, np.int64)
+
+    def test_flat_record_buffers(self):
+        jets = ak.Array([[{"pt": 1.0, "eta": 0.1}], [], [{"pt": 2.0, "eta": 0.2}, {"pt": 3.0, "eta": 0.3}]])[1:]
+        offsets, buffers = flat_record_buffers(jets, ["pt"])
+
+        self.assertEqual(buffers["pt"][offsets[0]:offsets[-1]].tolist(), [2.0, 3.0])
+        self.assertEqual(from_flat_buffer(offsets, 2 * buffers["pt"]).tolist(), [[], [4.0, 6.0]])
+
+        jets = set_flat_record_fields(jets, offsets, {"pt": 2 * buffers["pt"], "pt_up": 3 * buffers["pt"]})
+        self.assertEqual(jets.fields, ["eta", "pt", "pt_up"])
+        self.assertEqual(jets.pt_up.tolist(), [[], [6.0, 9.0]])
+        with self.assertRaises(ValueError):
+            set_flat_record_fields(jets, offsets, {"pt": np.zeros(1)})
+
+    def test_column_batch(self):
+        events = ak.Array({"x": [1, 2, 3], "a": [0.0, 0.0, 0.0]})
+
+        batch = ColumnBatch(len(events), fill_value=-10)
+        batch["a"] = ak.Array([1.5, None, np.nan])
+        batch["b"] = ak.Array([True, False, True])
+        batch["c"] = 2.0
+        events = batch.attach(events)
+
+        self.assertEqual(events.fields, ["x", "a", "b", "c"])
+        self.assertEqual(events.a.tolist(), [1.5, -10.0, -10.0])
+        self.assertEqual(events.b.tolist(), [1.0, 0.0, 1.0])
+        self.assertEqual(events.c.tolist(), [2.0, 2.0, 2.0])
+        self.assertEqual(events.a.type.content.primitive, "float32")
+
+    def test_sanitize_columns(self):
+        events = ak.Array({
+            "a": [1.5, None, np.nan],
+            "b": [np.inf, 2.0, -np.inf],
+            "Jet": {"pt": [[1.0, np.nan], [], [None]]},
+        })
+        events = sanitize_columns(events, ["a", "b", "Jet.pt"], fill_value=-1)
+
+        self.assertEqual(events.a.tolist(), [1.5, -1.0, -1.0])
+        self.assertEqual(events.b.tolist(), [-1.0, 2.0, -1.0])
+        self.assertEqual(events.Jet.pt.tolist(), [[1.0, -1.0], [], [-1.0]])
+        self.assertEqual(events.a.type.content.primitive, "float32")
+
     def test_call_once_on_config(self):
         @call_once_on_config()
         def some_config_function(config: od.Config) -> str: